@@ -24,3 +24,6 @@ __version__ = "0.3"
 
 def download_directory():
     return DownloadManager.base_directory
+
+def open_sink(name, archive=None, prefix="", identity=None):
+    return DownloadManager.open_sink(name, archive=archive, prefix=prefix, identity=identity)
@@ -16,20 +16,41 @@
 # You should have received a copy of the GNU General Public License
 # along with mindl. If not, see <http://www.gnu.org/licenses/>.
 
+import threading
 import logging
 import datetime
 import sys
 
 from .progress_bar import StdoutStreamHandler
+from . import log_listener
 
 # If an option key starts with this, make it a required option.
 REQUIRED_MAGIC = "@"
 
+# Default directory names handed out so far. Downloads can run in parallel, so two of them
+# could otherwise end up with the same timestamp.
+_claimed_directories = set()
+_claimed_directories_lock = threading.Lock()
+
 class BasePlugin():
     name = "N/A"
     options = tuple()
     _logger = None
     _debug_logger = False
+    # If True, plugins that log in should hold on to their sessions and reuse them for later instances.
+    keep_sessions = False
+    # True if the instance only downloads part of the book (e.g. a range of pages), so it's not added to the library.
+    partial = False
+    # Counts what the download fetches and writes. Set by the DownloadManager running the plugin.
+    stats = None
+    # True if the plugin counts the bytes it receives in self.stats itself. Otherwise the
+    # size of every file it yields is counted instead.
+    reports_received = False
+    # The URL being downloaded, for events. Set by the DownloadManager running the plugin.
+    source_url = None
+    # Returns a function telling whether a previous run already stored a file, by filename, so that
+    # it can be skipped, or None if there's nothing to pick up. Set by the DownloadManager running the plugin.
+    resume_check = None
 
     def __iter__(self):
         if hasattr(self, "options"):
@@ -69,14 +90,52 @@ class BasePlugin():
 
         return False
 
+    @classmethod
+    def content_id(cls, url):
+        """
+        Something that identifies the book at 'url', used to tell whether it's already been
+        downloaded before creating an instance. Different URLs for the same book should
+        give the same ID if possible.
+
+        """
+        return url
+
     def progress(self):
         return None
 
+    def resumed(self):
+        """The number of files skipped because a previous run had already downloaded them."""
+        return 0
+
+    def file_index(self, filename):
+        """The index of the page or item a file belongs to, if the plugin knows it."""
+        return None
+
+    def fetch_time(self, filename):
+        """How many seconds it took to fetch a file, if the plugin knows it. Only asked once per file."""
+        return None
+
     def directory(self):
         if not hasattr(self, "_directory"):
-            self._directory = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S_") + self.name
+            base = datetime.datetime.now().strftime("%Y-%m-%d_%H-%M-%S_") + self.name
+            with _claimed_directories_lock:
+                name = base
+                i = 2
+                while name in _claimed_directories:
+                    name = "{}_{}".format(base, i)
+                    i += 1
+                _claimed_directories.add(name)
+            self._directory = name
         return self._directory
 
+    def sink(self):
+        """
+        Where downloaded files should go, e.g. a ZipSink. Called once the first file has been downloaded.
+        Return None to have them written to the plugin's directory.
+
+        """
+        return None
+
     def has_valid_options(self):
         is_valid = True
         for opt in self:
@@ -112,6 +171,7 @@ class BasePlugin():
                     sys.exit(1)
         elif unset_keys:
             logger.info("Set this plugin's options:")
+            log_listener.flush()
             for opt in cls.options:
                 # If we set options through the command line, skip them.
                 if opt.key.lower() not in unset_keys:
@@ -129,12 +189,41 @@ class BasePlugin():
                 else:
                     opt.value = got
             
+    @classmethod
+    def configured(cls, options):
+        """
+        Return a subclass with its own copy of the options, set to the ones passed. Options are
+        normally set on the class itself, so this allows instances with different options to
+        coexist. Raises ValueError if a required option ends up not being set.
+
+        """
+        cls.process_options()
+        opts = [Option(opt.key, opt.value, required=opt.required) for opt in cls.options]
+        for key, value in options.items():
+            for opt in opts:
+                if key.lower() == opt.key.lower():
+                    opt.value = value
+
+        for opt in opts:
+            if not opt.valid:
+                raise ValueError("The option '{}' is required.".format(opt.key))
+
+        return type(cls.__name__, (cls,), {"options": opts, "__module__": cls.__module__})
+
     def can_handle(url):
         raise NotImplementedError("The base plugin doesn't handle any URLs.")
 
     def downloader(self):
         raise NotImplementedError("'downloader' generator needs to be implemented.")
 
+    def cancel(self):
+        """
+        Stop downloading as soon as possible. Called from another thread. The DownloadManager
+        stops taking files either way, but downloads with threads of their own should stop them.
+
+        """
+        pass
+
     def handle_exception(self, e):
         # Return False to tell the manager to raise it and let it go uncaught.
         # Return True to tell the manager to silently stop, assuming the plugin dealt with it.
@@ -152,14 +241,12 @@ class BasePlugin():
             # If it's already been configured by another instance, adding another handler
             # will just make it print stuff multiple times, so we skip it.
             if not logger.hasHandlers():
-                logger.setLevel(logging.DEBUG)
-
                 # Console
                 console_fmt = logging.Formatter("(%(asctime)s %(levelname)s) [%(name)s] %(message)s", "%H:%M")
                 console_handler = StdoutStreamHandler()
                 console_handler.setLevel(logging.DEBUG if self._debug_logger else logging.INFO)
                 console_handler.setFormatter(console_fmt)
-                logger.addHandler(console_handler)
+                log_listener.add_handler(logger, console_handler)
 
             self._logger = logger
             self.__class__._logger = logger
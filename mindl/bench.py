@@ -0,0 +1,368 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import http.server
+import subprocess
+import threading
+import argparse
+import tempfile
+import random
+import shutil
+import json
+import time
+import sys
+import io
+import os
+
+from collections import namedtuple
+from urllib.parse import urlsplit, parse_qs
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows, where peak RSS isn't measured.
+    resource = None
+
+"""
+Benchmarks mindl end to end with 'mindl bench', against stand-ins for the sites it
+downloads from running locally, so that changes to the downloading, descrambling or
+storage code can be checked for performance regressions.
+
+Every scenario runs in a fresh process, which downloads from a stand-in server running
+in this one, and reports how many pages and megabytes it stored per second, its peak RSS
+and the CPU time it used. Results can be saved as a baseline and later runs compared to
+it: anything that got worse by more than the tolerance counts as a regression and makes
+'mindl bench' exit with an error. Baselines only mean something on the machine they were
+saved on.
+
+"""
+
+Scenario = namedtuple("Scenario", ["name", "description", "server", "books", "pages", "page_size", "jobs"])
+
+SCENARIOS = (
+    Scenario("binb-sbc", "a BinB book whose pages go through the SBC API", "sbc", 1, 30, (480, 640), 1),
+    Scenario("binb-static", "a BinB book whose pages come straight from the CDN", "static", 1, 30, (480, 640), 1),
+    Scenario("small-books", "a batch of many small BinB books, several at once", "sbc", 20, 3, (320, 448), 4),
+    Scenario("dummy-flood", "files generated as fast as they can be stored, with nothing to download", None, 1,
+             5000, None, 1),
+)
+
+# Whether a higher value of each metric is better or worse.
+METRICS = (("pages_per_sec", "pages/s", True), ("mb_per_sec", "MB/s", True),
+           ("peak_rss_mb", "peak RSS MB", False), ("cpu_seconds", "CPU s", False))
+
+BASELINE_FILENAME = "bench-baseline.json"
+
+# Every page is scrambled with the same keys: 4x4 pieces, shuffled with a fixed seed.
+_PIECES = list(range(16))
+random.Random(16).shuffle(_PIECES)
+CTBL = ["=4-4+0-DDDDDDDD" + "".join(chr(ord("A") + i) for i in _PIECES)] * 8
+PTBL = ["=4-4-0-DDDDDDDD" + "".join(chr(ord("A") + i) for i in range(16))] * 8
+
+def encrypt_descramble_data(data, cid, k):
+    """The opposite of BinBApi._decrypt_descramble_data()."""
+    from .plugins.binb import descramble_data_key
+    key = descramble_data_key(cid, k)
+    res = ""
+    for char in json.dumps(data):
+        key = (key >> 1) ^ (-(key & 1) & 0x48200004)
+        res += chr((ord(char) - 0x20 - key) % 0x5E + 0x20)
+
+    return res
+
+class StandIn:
+    """
+    A local stand-in for a BinB reader API and the CDN behind it. Book IDs are
+    '{server}_{pages}_{width}x{height}_{n}', where 'server' is 'sbc' or 'static', so one
+    server can serve any book a scenario asks for. Every page waits 'latency' seconds
+    before it's sent, to make it a bit more like a real server.
+
+    """
+    latency = 0.01
+    # How many different images to serve, so that pages aren't all identical.
+    variants = 4
+
+    def __init__(self):
+        self._images = {}
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+        self._server.daemon_threads = True
+        self._server.stand_in = self
+        self.url = "http://127.0.0.1:{}/".format(self._server.server_address[1])
+        threading.Thread(target=self._server.serve_forever, name="bench-server", daemon=True).start()
+
+    def book_url(self, scenario, n):
+        cid = "{}_{}_{}x{}_{}".format(scenario.server, scenario.pages, *scenario.page_size, n)
+        return self.url + "bib/#" + cid
+
+    def image(self, size, page):
+        """A JPEG of random noise. Only a few are made for each size, and only once."""
+        key = (size, page % self.variants)
+        with self._lock:
+            if key not in self._images:
+                from PIL import Image
+                noise = Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3))
+                data = io.BytesIO()
+                noise.save(data, format="JPEG", quality=90)
+                self._images[key] = data.getvalue()
+            return self._images[key]
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, body, content_type="application/json"):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def _ttx(pages):
+        # The reader's page list, which for whatever reason repeats itself.
+        return "".join('<t-img src="pages/{:04d}.jpg">'.format(i + 1) for i in range(pages)) * 2
+
+    def do_GET(self):
+        stand_in = self.server.stand_in
+        url = urlsplit(self.path)
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = url.path.strip("/").split("/")
+
+        if parts == ["bib", "bibGetCntntInfo.php"]:
+            cid = query["cid"]
+            server = cid.split("_")[0]
+            contents = stand_in.url + ("sbc/" if server == "sbc" else "static/{}/".format(cid))
+            self._send(json.dumps({"result": 1, "items": [{"Title": "Bench {}".format(cid), "ServerType":
+                0 if server == "sbc" else 1, "p": "bench", "ContentsServer": contents,
+                "ctbl": encrypt_descramble_data(CTBL, cid, query["k"]),
+                "ptbl": encrypt_descramble_data(PTBL, cid, query["k"])}]}))
+            return
+
+        cid = query.get("cid") or (parts[1] if len(parts) > 1 else "")
+        try:
+            server, pages, size, n = cid.split("_")
+            pages = int(pages)
+            size = tuple(int(x) for x in size.split("x"))
+        except ValueError:
+            self.send_error(404)
+            return
+
+        if parts == ["sbc", "sbcGetCntnt.php"]:
+            self._send(json.dumps({"result": 1, "ttx": self._ttx(pages)}))
+        elif parts[:1] == ["static"] and parts[2:] == ["content.js"]:
+            self._send("DataGet_Content({})".format(json.dumps({"ttx": self._ttx(pages)})), "text/javascript")
+        elif parts == ["sbc", "sbcGetImg.php"] or (parts[:1] == ["static"] and parts[-1] == "M_H.jpg"):
+            # Either ?src=pages/0001.jpg, or /static/<cid>/pages/0001.jpg/M_H.jpg.
+            src = query["src"] if "src" in query else "/".join(parts[2:4])
+            time.sleep(stand_in.latency)
+            self._send(stand_in.image(size, int(src[len("pages/"):-len(".jpg")])), "image/jpeg")
+        else:
+            self.send_error(404)
+
+def _plugin_class(scenario):
+    """The plugin, with its options set, that a scenario downloads with."""
+    if scenario.server is None:
+        from .plugins.dummy import dummy
+        return dummy.configured({"n": scenario.pages, "length": 0, "threads": 4, "size": "4k-64k", "seed": 1,
+            "chatter": 0, "cleanup": 1})
+
+    from .plugins.utils.binb_plugin import BinBPlugin
+
+    class bench(BinBPlugin):
+        name = "Bench"
+
+        def __init__(self, url):
+            bib, _, cid = url.partition("#")
+            super().__init__(bib, cid, login=False)
+
+    return bench.configured({})
+
+def run_scenario(scenario, urls, directory):
+    """Download 'urls' as 'scenario' says to, storing them under 'directory'. Returns the results."""
+    from .cli import init_logger
+    from .download_manager import DownloadManager
+    from .library import Library
+    from .scheduler import BookScheduler
+    from .transfer_stats import TransferStats
+
+    init_logger()
+    DownloadManager.base_directory = directory
+    Library.enabled = False
+    plugin = _plugin_class(scenario)
+
+    cpu = time.process_time()
+    started = time.monotonic()
+    with BookScheduler(jobs=scenario.jobs) as scheduler:
+        for url in urls:
+            scheduler.submit(plugin, url)
+    elapsed = time.monotonic() - started
+    cpu = time.process_time() - cpu
+
+    stats = TransferStats.total
+    expected = scenario.books * scenario.pages
+    if stats.written_files != expected:
+        raise RuntimeError("Only {} of {} pages were stored.".format(stats.written_files, expected))
+
+    peak_rss = None
+    if resource is not None:
+        # ru_maxrss is in kilobytes on Linux, but in bytes on macOS.
+        unit = 1024 ** 2 if sys.platform == "darwin" else 1024
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+
+    return {"pages_per_sec": stats.written_files / elapsed,
+            "mb_per_sec": stats.written_bytes / elapsed / 1e6,
+            "peak_rss_mb": peak_rss,
+            "cpu_seconds": cpu}
+
+def measure(scenario, stand_in):
+    """Run a scenario in a fresh process, so that its peak RSS and CPU time are its own."""
+    urls = [stand_in.book_url(scenario, n) if scenario.server else "dummy://bench/{}".format(n)
+            for n in range(scenario.books)]
+    directory = tempfile.mkdtemp(prefix="mindl-bench-")
+    try:
+        result_path = os.path.join(directory, "result.json")
+        process = subprocess.run([sys.executable, "-m", "mindl.bench", "--child", scenario.name, result_path,
+            os.path.join(directory, "downloads")] + urls, capture_output=True, text=True)
+        if process.returncode != 0 or not os.path.exists(result_path):
+            output = (process.stdout + process.stderr).strip().splitlines()
+            raise RuntimeError("The scenario '{}' failed:\n{}".format(scenario.name, "\n".join(output[-20:])))
+        with open(result_path, encoding="utf-8") as f:
+            return json.load(f)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+def median(values):
+    """The median, or None if any of the values is missing."""
+    if None in values:
+        return None
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def compare(results, baseline, tolerance):
+    """
+    Compare results to a baseline. Returns a list of (scenario, metric label, value,
+    baseline value or None, relative change or None, whether it regressed).
+
+    """
+    rows = []
+    for name, metrics in results.items():
+        base = baseline.get(name, {})
+        for key, label, higher_is_better in METRICS:
+            value = metrics[key]
+            if value is None or not base.get(key):
+                rows.append((name, label, value, None, None, False))
+                continue
+            change = value / base[key] - 1
+            worse = -change if higher_is_better else change
+            rows.append((name, label, value, base[key], change, worse > tolerance))
+    return rows
+
+def configure_parser():
+    parser = argparse.ArgumentParser(prog="mindl bench", description="Benchmark mindl end to end against local "
+                                     "stand-ins and compare the results to a baseline.")
+    parser.add_argument("scenario", nargs="*", metavar="SCENARIO",
+                        help="the scenarios to run (all of them by default): {}".format(
+                        ", ".join(s.name for s in SCENARIOS)))
+    parser.add_argument("-l", "--list", action="store_true", help="list the scenarios and exit")
+    parser.add_argument("-b", "--baseline", default=BASELINE_FILENAME, metavar="PATH",
+                        help="the baseline to compare to ({} by default)".format(BASELINE_FILENAME))
+    parser.add_argument("-s", "--save", action="store_true",
+                        help="save the results as the baseline instead of comparing to it")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.15, metavar="RATIO",
+                        help="how much worse than the baseline a result can be before it counts as a regression "
+                        "(0.15 by default, for 15%%)")
+    parser.add_argument("-r", "--repeat", type=int, default=3, metavar="N",
+                        help="how many times to run each scenario. The median of each metric is used (3 by default)")
+    parser.add_argument("--latency", type=float, default=StandIn.latency, metavar="SECONDS",
+                        help="how long the stand-in server takes to send each page ({:g} by default)".format(
+                        StandIn.latency))
+    parser.add_argument("--child", nargs="+", help=argparse.SUPPRESS)
+
+    return parser
+
+def main(argv=None):
+    args = configure_parser().parse_args(argv)
+    if args.child:
+        name, result_path, directory = args.child[:3]
+        scenario = next(s for s in SCENARIOS if s.name == name)
+        result = run_scenario(scenario, args.child[3:], directory)
+        with open(result_path, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        return
+
+    if args.list:
+        for scenario in SCENARIOS:
+            print("{:<14} {}".format(scenario.name, scenario.description))
+        return
+
+    scenarios = [s for s in SCENARIOS if not args.scenario or s.name in args.scenario]
+    unknown = set(args.scenario) - {s.name for s in SCENARIOS}
+    if unknown:
+        print("Unknown scenario(s): {}. Use --list to see them.".format(", ".join(sorted(unknown))))
+        sys.exit(2)
+
+    StandIn.latency = args.latency
+    stand_in = StandIn()
+    results = {}
+    try:
+        for scenario in scenarios:
+            print("Running {} ({})...".format(scenario.name, scenario.description), flush=True)
+            runs = [measure(scenario, stand_in) for i in range(max(1, args.repeat))]
+            results[scenario.name] = {key: median([run[key] for run in runs]) for key, label, better in METRICS}
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    finally:
+        stand_in.close()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f).get("scenarios", {})
+
+    if args.save:
+        # Scenarios that weren't run keep their old baseline.
+        baseline.update(results)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "saved": time.time(), "scenarios": baseline}, f, indent=4,
+                sort_keys=True)
+        print("Saved the results as the baseline in '{}'.".format(args.baseline))
+        baseline = {}
+
+    regressions = 0
+    print("{:<14} {:<12} {:>10} {:>10} {:>8}".format("scenario", "metric", "result", "baseline", "change"))
+    for name, label, value, base, change, regressed in compare(results, baseline, args.tolerance):
+        regressions += regressed
+        print("{:<14} {:<12} {:>10} {:>10} {:>8}{}".format(name, label, "-" if value is None else "{:.2f}".format(value),
+            "-" if base is None else "{:.2f}".format(base), "-" if change is None else "{:+.1%}".format(change),
+            "  REGRESSION" if regressed else ""))
+
+    if regressions:
+        print("{} result(s) got worse than the baseline by more than {:.0%}.".format(regressions, args.tolerance))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
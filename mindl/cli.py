@@ -16,53 +16,42 @@
 # You should have received a copy of the GNU General Public License
 # along with mindl. If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import contextlib
 import argparse
 import logging
+import os
 import sys
 
+from . import limits, log_listener, events, memory_profile, metrics, trace
+from .dedup import DedupStore, format_size
+from .library import Library
 from .download_manager import DownloadManager
+from .manifest import Manifest
 from .plugin_manager import PluginManager
-from .progress_bar import StdoutStreamHandler
+from .progress_bar import LineReservePrinter, StdoutStreamHandler, watch_resize
+from .scheduler import BookScheduler
+from .shard import Shard, shard_key
+from .transfer_stats import TransferStats
+from .url_feed import UrlFeed
 
 from collections import namedtuple
 
 ArgumentOption = namedtuple("ArgumentOption", ["plugin", "key", "value"])
 
-class UrlListParseAction(argparse.Action):
-    """
-    Custom action to avoid having the --file argument overwrite regular URLs, or vice versa.
-    Instead, this action will simply merge regular URLs with file URLs.
-    """
-    def __call__(self, parser, namespace, urls, option_string=None):
-        dest = getattr(namespace, self.dest)
-        if dest is urls:
-            return
-        
-        for url in urls:
-            dest.append(url)
-
-class UrlListFileParseAction(argparse.Action):
-    """Custom action to append all the URLs in a file into its destination list."""
-    def __call__(self, parser, namespace, file, option_string=None):
-        dest = getattr(namespace, self.dest)
-        if dest is None:
-            dest = []
-            setattr(namespace, self.dest, dest)
-        
-        for line in [l.strip() for l in file.readlines() if l.strip()]:
-            dest.append(line)
+# Plugins whose options have already been set during this run.
+_configured_plugins = set()
 
 def init_logger(debug=False):
     logger = logging.getLogger("mindl")
     logger.propagate = False
-    logger.setLevel(logging.DEBUG)
 
     # Console
     console_fmt = logging.Formatter("(%(asctime)s %(levelname)s) %(message)s", "%H:%M")
     console_handler = StdoutStreamHandler()
     console_handler.setLevel(logging.DEBUG if debug else logging.INFO)
     console_handler.setFormatter(console_fmt)
-    logger.addHandler(console_handler)
+    log_listener.add_handler(logger, console_handler)
 
     return logger
 
@@ -81,9 +70,15 @@ def configure_parser():
             plugin, key = split
         
         return ArgumentOption(plugin, key, value)
+
+    def shard_parse(text):
+        try:
+            return Shard.parse(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
     
     parser = argparse.ArgumentParser(description='A plugin-based downloader.', prog="mindl")
-    parser.add_argument("url", metavar="URL", nargs="*", help="the URL to download from", default=[], action=UrlListParseAction)
+    parser.add_argument("url", metavar="URL", nargs="*", help="the URL to download from", default=[])
     parser.add_argument("-o", "--option", dest="options", metavar="KEY=VALUE", type=key_value_parse, default=[], action="append",
                         help="a key-value pair to be passed to the plugin to define its options")
     parser.add_argument("-v", "--verbose", action="store_true", help="makes the logger output debugging strings")
@@ -91,14 +86,86 @@ def configure_parser():
                         help="makes the plugin use default values for options if it can instead of prompting")
     parser.add_argument("-p", "--plugin", help="explicitly set which plugin should handle the URL in the case where "
                         "two or more plugins can handle the same URL")
-    parser.add_argument("-f", "--file", help="the path to a text file containing URLs to be processed, separated by lines",
-                        metavar="PATH", type=argparse.FileType("r", encoding="UTF-8"), dest="url", action=UrlListFileParseAction)
+    parser.add_argument("-f", "--file", help="the path to a text file containing URLs to be processed, separated by lines, "
+                        "or '-' to read them from stdin as they come in", metavar="PATH", dest="files", default=[], action="append")
+    parser.add_argument("--dedup", action="store_true", help="skip URLs that have already been passed")
     parser.add_argument("-D", "--directory", help="the directory in which the downloads will go to ('downloads' by default)",
                         default="downloads")
+    parser.add_argument("--writers", type=int, default=DownloadManager.writer_threads, metavar="N",
+                        help="the number of threads writing downloaded files to disk ({} by default)".format(DownloadManager.writer_threads))
+    parser.add_argument("--fsync-every", type=int, default=DownloadManager.fsync_every, metavar="N",
+                        help="sync written files to disk in batches of N files, or never if 0 (the default)")
+    parser.add_argument("--archive", choices=("zip", "tar"),
+                        help="store each download in an archive of this format instead of a directory, "
+                        "unless the plugin decides for itself")
+    parser.add_argument("--s3", metavar="URL", help="upload downloads to an S3-compatible object store "
+                        "instead of writing them to disk, e.g. 's3://bucket/prefix'")
+    parser.add_argument("--s3-endpoint", metavar="URL", help="the endpoint of the object store "
+                        "(AWS_ENDPOINT_URL or AWS by default)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, metavar="N",
+                        help="the number of URLs to download at the same time (1 by default)")
+    parser.add_argument("--prefetch", type=int, default=1, metavar="N",
+                        help="the number of upcoming URLs to prepare (e.g. log in and get the page list) while "
+                        "downloading (1 by default)")
+    parser.add_argument("--max-connections", type=int, default=0, metavar="N",
+                        help="the maximum number of requests in flight across all downloads (unlimited by default)")
+    parser.add_argument("--cpu-workers", type=int, default=0, metavar="N",
+                        help="the maximum number of threads doing CPU heavy work like descrambling across all "
+                        "downloads (unlimited by default)")
+    parser.add_argument("--link-duplicates", action="store_true",
+                        help="hardlink files identical to ones already in the download directory instead of writing them again. "
+                        "Only applies to downloads stored in directories")
+    parser.add_argument("--force", action="store_true",
+                        help="download books again even if the library says they've already been downloaded")
+    parser.add_argument("--fps", type=float, default=LineReservePrinter.fps, metavar="N",
+                        help="how many times per second progress is redrawn ({} by default). If the output isn't "
+                        "a terminal, progress is printed every {:g} seconds instead".format(LineReservePrinter.fps,
+                        LineReservePrinter.summary_interval))
+    parser.add_argument("--events", metavar="TARGET",
+                        help="send events as lines of JSON to a file, an open file descriptor ('fd:N'), or a "
+                        "socket ('unix:PATH' or 'tcp:HOST:PORT')")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="record what every thread is doing and write it to FILE in the trace event format, "
+                        "to be opened in chrome://tracing or Perfetto")
+    parser.add_argument("--profile-memory", action="store_true",
+                        help="account for memory used by each stage of the download and each page, and report it "
+                        "along with the biggest allocation sites at the end. Makes downloads slower")
+    parser.add_argument("--metrics", metavar="HOST:PORT",
+                        help="serve Prometheus metrics at http://HOST:PORT/metrics")
+    parser.add_argument("--metrics-file", metavar="PATH",
+                        help="write Prometheus metrics to a file every few seconds, e.g. for node_exporter's "
+                        "textfile collector")
+    parser.add_argument("--no-resume", action="store_true",
+                        help="download everything again instead of skipping files a previous run already downloaded")
+    parser.add_argument("--shard", metavar="I/N", type=shard_parse,
+                        help="only download the URLs that belong to shard I of N (e.g. 2/4), so that several "
+                        "instances can split the same list of URLs between them")
+    parser.add_argument("--route", action="store_true",
+                        help="print which plugin would handle each URL instead of downloading anything")
+    parser.add_argument("--coordinator", action="store_true",
+                        help="hand out the URLs to workers started with --worker instead of downloading them, "
+                        "listening on the address given by --listen")
+    parser.add_argument("--worker", metavar="URL", help="download whatever the coordinator at URL hands out")
+    parser.add_argument("--worker-id", metavar="NAME", help="the name of this worker (hostname and PID by default)")
+    parser.add_argument("--split-pages", type=int, default=0, metavar="N",
+                        help="have the coordinator split books with more than N pages into jobs of N pages each")
+    parser.add_argument("--heartbeat-timeout", type=float, default=30.0, metavar="SECONDS",
+                        help="give a job to another worker if its worker hasn't been heard from in this long (30 by default)")
+    parser.add_argument("--daemon", action="store_true",
+                        help="keep running and take download jobs through a local HTTP API instead of the command line")
+    parser.add_argument("--listen", default="127.0.0.1:8734", metavar="HOST:PORT",
+                        help="the address the daemon listens on (127.0.0.1:8734 by default)")
+    parser.add_argument("--socket", metavar="PATH", help="make the daemon listen on a Unix socket instead")
     
     return parser
 
 def main():
+    # 'mindl bench' has its own arguments.
+    if sys.argv[1:2] == ["bench"]:
+        from .bench import main as bench
+        bench(sys.argv[2:])
+        sys.exit()
+
     parser = configure_parser()
     if len(sys.argv) < 2:
         parser.print_help()
@@ -109,49 +176,210 @@ def main():
 
     # Set the base download directory. Defaults to "downloads".
     DownloadManager.base_directory = args.directory
+    Manifest.enabled = not args.no_resume
+    Library.enabled = not args.force
+    LineReservePrinter.fps = args.fps
+    # Progress lines might be drawn from other threads (e.g. the daemon's), which can't set signal handlers.
+    watch_resize()
+    DownloadManager.writer_threads = args.writers
+    DownloadManager.fsync_every = args.fsync_every
+    DownloadManager.archive = args.archive
+    DownloadManager.dedup = args.link_duplicates
+    if args.link_duplicates and (args.archive or args.s3):
+        logger.warning("--link-duplicates only applies to downloads stored in directories, so it does nothing with {}."
+            .format("--archive" if args.archive else "--s3"))
+    if args.s3:
+        from .s3 import S3Client
+        try:
+            DownloadManager.object_store, DownloadManager.object_store_prefix = S3Client.from_url(args.s3,
+                endpoint=args.s3_endpoint, jobs=args.jobs)
+        except ValueError as e:
+            logger.critical(str(e))
+            sys.exit(1)
+    if args.events:
+        try:
+            events.start(args.events)
+        except (OSError, ValueError) as e:
+            logger.critical("Could not send events to '{}': {}".format(args.events, e))
+            sys.exit(1)
+    if args.trace:
+        trace.start(args.trace)
+    if args.profile_memory:
+        memory_profile.start()
+    try:
+        if args.metrics:
+            metrics.serve(parse_address(args.metrics))
+        if args.metrics_file:
+            metrics.write_periodically(args.metrics_file)
+    except OSError as e:
+        logger.critical("Could not export metrics: {}".format(e))
+        sys.exit(1)
     
-    if not args.url:
+    if args.daemon:
+        run_daemon(args)
+        sys.exit()
+    elif args.worker:
+        run_worker(args)
+        sys.exit()
+    elif args.coordinator:
+        run_coordinator(args)
+        sys.exit()
+
+    if not args.url and not args.files:
         logger.info("Nothing to do, as no URLs were passed. Use the -h argument to see the usage.")
         sys.exit()
-    
+
+    # URLs from files are read as they're needed rather than all at once.
+    urls = UrlFeed(args.url, args.files, dedup=args.dedup)
+    if args.route:
+        route(PluginManager(), urls)
+        sys.exit()
+
+    limits.connections.set(args.max_connections)
+    limits.cpu.set(args.cpu_workers)
+
     pm = PluginManager()
-    for url in args.url:
-        # If we're dealing with multiple URLs, log which one is being dealt with.
-        if len(args.url) > 1:
-            logger.info("Processing URL: " + url)
-
-        eligible = pm.find_handlers(url)
-
-        # If --plugin is used, only allow the plugin with that particular name.
-        if args.plugin:
-            new_eligible = []
-            for p, v in eligible:
-                if p.name.lower() == args.plugin.lower():
-                    new_eligible.append((p, v))
-                    break
-            if not new_eligible:
-                logger.critical("The explicitly set plugin '{}' was not not found in the list of plugins that"
-                                "were eligible to deal with the URL.".format(args.plugin))
-                sys.exit(1)
-            
-            eligible = new_eligible
-
-        if eligible:
-            if len(eligible) > 1:
-                plugin, version = pm.select_plugin(url, eligible)
-            else:
-                plugin, version = eligible[0]
-            
-            logger.info("URL is being handled by plugin: {} v{}".format(plugin.name, version))
-            plugin.process_options()
-            # If options as key-value pairs were passed using arguments, we allow the user to explicitly set the plugin
-            # the option will apply for, so we need to filter them out if that is the case.
-            options = dict([(o.key, o.value) for o in args.options if o.plugin is None or o.plugin.lower() == plugin.name.lower()])
-            # Let the plugin manager set the key-value pairs if any, then ask for manual input if needed.
+    library = Library.open(args.directory)
+    skipped = 0
+    other_shards = 0
+    with BookScheduler(jobs=args.jobs, prefetch=args.prefetch) as scheduler:
+        # Don't hold back what's already been submitted while waiting on a slow source of URLs, e.g. a pipe.
+        urls.on_idle = scheduler.run_pending
+        for url in urls:
+            if args.shard is not None and not args.shard.owns(shard_key(pm, url)):
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug("Skipping URL that belongs to another shard: " + url)
+                other_shards += 1
+                continue
+
+            # If we're dealing with multiple URLs, log which one is being dealt with.
+            if urls.many:
+                logger.info("Processing URL: " + url)
+
+            plugin = resolve_plugin(pm, url, args, prompting=scheduler.prompting)
+            if plugin is None:
+                continue
+
+            if library.has(plugin, url):
+                logger.info("Skipping '{}', as it's already been downloaded to '{}'. Use --force to download it again."
+                    .format(url, library.find(plugin, url)["path"]))
+                skipped += 1
+                continue
+
+            scheduler.submit(plugin, url)
+
+    events.emit("summary", urls=urls.count, duplicates=urls.duplicates, other_shards=other_shards, skipped=skipped,
+        stats=TransferStats.total.to_dict())
+    if urls.duplicates:
+        logger.info("Skipped {} duplicate URLs.".format(urls.duplicates))
+    if other_shards:
+        logger.info("Left {} URLs to the other shards.".format(other_shards))
+    if skipped and urls.many:
+        logger.info("Skipped {} books that had already been downloaded.".format(skipped))
+    if args.link_duplicates and urls.many:
+        store = DedupStore.open(args.directory)
+        logger.info("Linked a total of {} duplicate files, saving {}.".format(store.linked_files,
+            format_size(store.saved_bytes)))
+    if scheduler.failed:
+        sys.exit(1)
+
+def route(pm, urls):
+    """Print the plugins that would handle each URL, tab-separated, followed by a summary."""
+    logger = logging.getLogger("mindl")
+    counts = collections.Counter()
+    for url, entries in pm.route(urls):
+        names = ",".join(entry.name for entry in entries) or "-"
+        counts[names] += 1
+        print("{}\t{}".format(names, url))
+
+    logger.info("Routed {} URLs: {}".format(sum(counts.values()),
+        ", ".join("{} {}".format(count, names) for names, count in counts.most_common())))
+
+def parse_address(text):
+    host, _, port = text.rpartition(":")
+    try:
+        return host or "127.0.0.1", int(port)
+    except ValueError:
+        logger = logging.getLogger("mindl")
+        logger.critical("The address '{}' is not in the right format. Please use 'host:port'.".format(text))
+        sys.exit(1)
+
+def run_coordinator(args):
+    from .cluster import Coordinator, JobQueue
+    queue = JobQueue(os.path.join(args.directory, ".mindl_queue.sqlite"))
+    # With no URLs to begin with, keep running and wait for jobs to be added through the API.
+    coordinator = Coordinator(queue, split_pages=args.split_pages, heartbeat_timeout=args.heartbeat_timeout,
+        exit_when_done=bool(args.url or args.files))
+    coordinator.feed(UrlFeed(args.url, args.files, dedup=args.dedup), plugin=args.plugin)
+    coordinator.serve(parse_address(args.listen))
+    queue.close()
+
+def run_worker(args):
+    from .cluster import Worker
+    limits.connections.set(args.max_connections)
+    limits.cpu.set(args.cpu_workers)
+    Worker(args.worker, PluginManager(), worker_id=args.worker_id, jobs=args.jobs, options=args.options).run()
+
+def run_daemon(args):
+    from .daemon import Daemon
+    address = parse_address(args.listen)
+
+    limits.connections.set(args.max_connections)
+    limits.cpu.set(args.cpu_workers)
+
+    # Options passed as arguments are the defaults for every job, but jobs can override them.
+    daemon = Daemon(PluginManager(), jobs=args.jobs, prefetch=args.prefetch, options=args.options)
+    try:
+        daemon.serve(address, socket_path=args.socket)
+    except OSError as e:
+        logger = logging.getLogger("mindl")
+        logger.critical("Could not start the daemon: {}".format(e))
+        sys.exit(1)
+
+def resolve_plugin(pm, url, args, prompting=contextlib.nullcontext):
+    """
+    Find the plugin that should handle the URL and set its options. Returns None if there is none.
+    Input is asked for inside 'prompting()', so downloads already running don't draw over it.
+
+    """
+    logger = logging.getLogger("mindl")
+    eligible = pm.find_handlers(url)
+
+    # If --plugin is used, only allow the plugin with that particular name.
+    if args.plugin:
+        new_eligible = []
+        for p, v in eligible or []:
+            if p.name.lower() == args.plugin.lower():
+                new_eligible.append((p, v))
+                break
+        if not new_eligible:
+            logger.critical("The explicitly set plugin '{}' was not not found in the list of plugins that"
+                            "were eligible to deal with the URL.".format(args.plugin))
+            sys.exit(1)
+        
+        eligible = new_eligible
+
+    if not eligible:
+        logger.error("No plugins can handle the passed URL: {}".format(url))
+        return None
+
+    if len(eligible) > 1:
+        with prompting():
+            plugin, version = pm.select_plugin(url, eligible)
+    else:
+        plugin, version = eligible[0]
+    
+    logger.info("URL is being handled by plugin: {} v{}".format(plugin.name, version))
+    plugin.process_options()
+    # If options as key-value pairs were passed using arguments, we allow the user to explicitly set the plugin
+    # the option will apply for, so we need to filter them out if that is the case.
+    options = dict([(o.key, o.value) for o in args.options if o.plugin is None or o.plugin.lower() == plugin.name.lower()])
+    # Let the plugin manager set the key-value pairs if any, then ask for manual input if needed.
+    # Options are set on the class, so there's no need to ask again for every URL the plugin handles.
+    if plugin not in _configured_plugins:
+        with prompting():
             plugin.input_options(options, defaults=args.defaults)
-            plugin._debug_logger = args.verbose
-            dm = DownloadManager(plugin(url))
-            dm.start_download()
-            dm.finalize()
-        else:
-            logger.error("No plugins can handle the passed URL: {}".format(url))
+        _configured_plugins.add(plugin)
+    plugin._debug_logger = args.verbose
+
+    return plugin
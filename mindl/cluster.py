@@ -0,0 +1,590 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import urllib.request
+import urllib.error
+import threading
+import hashlib
+import logging
+import zipfile
+import sqlite3
+import socket
+import json
+import time
+import os
+import re
+
+from .base_plugin import BasePlugin
+from .daemon import JsonRequestHandler, ThreadingHTTPServer
+from .download_manager import DownloadManager
+from .library import Library
+from .scheduler import BookScheduler, BookStatus
+from .writer_pool import TEMP_SUFFIX
+
+"""
+Spreads downloads over several processes, on the same machine or others on the network.
+
+The coordinator keeps a queue of jobs in an SQLite database, so nothing is lost if it's
+restarted, and hands them out to workers over HTTP. Each job is a URL, optionally limited
+to a range of pages. If splitting is enabled, a worker that gets a book with more pages
+than that asks the coordinator to split it into ranges instead of downloading it, so that
+huge books are spread over several workers as well.
+
+Once every part of a split book is done, the worker that finished the last one puts the
+book back together: parts stored in the same directory are simply recorded in the library,
+and archives of each part are merged into one, as long as they're all on that machine.
+
+Workers send heartbeats for the jobs they're working on. If a job hasn't had one in a
+while, its worker is assumed to be dead and the job goes back in the queue, and when the
+worker hears about it, it stops downloading. Workers run jobs the same way the command
+line does, through a BookScheduler.
+
+The coordinator doesn't authenticate anyone, so it listens on localhost unless told
+otherwise, and jobs can only set the plugin options in JOB_OPTIONS.
+
+    POST /jobs      {"url": "...", "plugin": "...", "options": {...}}  Queue a job.
+    GET  /jobs      List every job.
+    POST /lease     {"worker": "..."}  Get a job to work on, if there are any.
+    POST /heartbeat {"worker": "...", "jobs": {"<id>": [files, total]}}
+    POST /split     {"worker": "...", "job": <id>, "pages": <total>}
+    POST /complete  {"worker": "...", "job": <id>, "files": <files>, "path": "...", "error": "..." or null}
+
+"""
+
+# Job states.
+QUEUED = "queued"
+ASSIGNED = "assigned"
+DONE = "done"
+FAILED = "failed"
+SPLIT = "split"
+
+COLUMNS = ("id", "url", "plugin", "options", "page_start", "page_end", "state", "worker", "heartbeat",
+           "attempts", "files", "total", "error", "parent", "path")
+
+# The only plugin options a job can set. Anything else (e.g. additional_zip_content, which
+# reads local files) has to be given to the worker itself with -o.
+JOB_OPTIONS = ("lossless", "metadata", "zip_it", "threads")
+
+# The page range BinB plugins add to the names of parts of a book.
+RE_PART = re.compile(r" \(p\d+-\d+\)(?=\.\w+$|$)")
+
+def check_options(options):
+    """Raises ValueError if a job's options has any that aren't allowed."""
+    if not isinstance(options, dict):
+        raise ValueError("The options need to be an object.")
+    refused = sorted(key for key in options if key not in JOB_OPTIONS)
+    if refused:
+        raise ValueError("Jobs can't set these options: {}".format(", ".join(refused)))
+
+class JobQueue:
+    """A durable queue of jobs in an SQLite database. Every method is thread-safe."""
+    def __init__(self, path, max_attempts=3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, url TEXT, plugin TEXT, options TEXT, "
+            "page_start INTEGER, page_end INTEGER, state TEXT, worker TEXT, heartbeat REAL, attempts INTEGER DEFAULT 0, "
+            "files INTEGER DEFAULT 0, total INTEGER DEFAULT -1, error TEXT, parent INTEGER, path TEXT)")
+        # Queues made before parts of split books were put back together.
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]
+        for column, kind in (("parent", "INTEGER"), ("path", "TEXT")):
+            if column not in columns:
+                self._db.execute("ALTER TABLE jobs ADD COLUMN {} {}".format(column, kind))
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_url ON jobs (url)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent)")
+        self._db.commit()
+
+    def _row(self, row):
+        job = dict(zip(COLUMNS, row))
+        job["options"] = json.loads(job["options"] or "{}")
+        return job
+
+    def add(self, url, plugin=None, options=None, page_start=None, page_end=None, unique=False):
+        """Queue a job and return its ID. If 'unique' is True and the URL has already been queued, returns None."""
+        with self._lock:
+            if unique and self._db.execute("SELECT 1 FROM jobs WHERE url = ? AND page_start IS NULL", (url,)).fetchone():
+                return None
+            cursor = self._db.execute("INSERT INTO jobs (url, plugin, options, page_start, page_end, state) "
+                "VALUES (?, ?, ?, ?, ?, ?)", (url, plugin, json.dumps(options or {}), page_start, page_end, QUEUED))
+            self._db.commit()
+            return cursor.lastrowid
+
+    def jobs(self):
+        with self._lock:
+            return [self._row(row) for row in self._db.execute("SELECT {} FROM jobs ORDER BY id".format(
+                ", ".join(COLUMNS)))]
+
+    def lease(self, worker):
+        """Assign the oldest queued job to 'worker' and return it, or None if there are none."""
+        with self._lock:
+            row = self._db.execute("SELECT {} FROM jobs WHERE state = ? ORDER BY id LIMIT 1".format(
+                ", ".join(COLUMNS)), (QUEUED,)).fetchone()
+            if row is None:
+                return None
+
+            job = self._row(row)
+            self._db.execute("UPDATE jobs SET state = ?, worker = ?, heartbeat = ?, attempts = attempts + 1 "
+                "WHERE id = ?", (ASSIGNED, worker, time.time(), job["id"]))
+            self._db.commit()
+            return job
+
+    def heartbeat(self, worker, job_id, files, total):
+        """Returns False if the job isn't assigned to the worker anymore."""
+        with self._lock:
+            cursor = self._db.execute("UPDATE jobs SET heartbeat = ?, files = ?, total = ? "
+                "WHERE id = ? AND worker = ? AND state = ?", (time.time(), files, total, job_id, worker, ASSIGNED))
+            self._db.commit()
+            return cursor.rowcount == 1
+
+    def complete(self, worker, job_id, files, error=None, path=None):
+        """Returns False if the job isn't assigned to the worker anymore, in which case nothing changes."""
+        with self._lock:
+            if error is not None:
+                # Put it back in the queue unless it's been tried enough times already.
+                attempts = self._db.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                state = FAILED if attempts is None or attempts[0] >= self.max_attempts else QUEUED
+            else:
+                state = DONE
+            cursor = self._db.execute("UPDATE jobs SET state = ?, files = ?, error = ?, worker = ?, path = ? "
+                "WHERE id = ? AND worker = ? AND state = ?", (state, files, error,
+                None if state == QUEUED else worker, path, job_id, worker, ASSIGNED))
+            self._db.commit()
+            return cursor.rowcount == 1
+
+    def finish_split(self, job_id):
+        """
+        If 'job_id' was the last unfinished part of a split job, mark the split job done and
+        return every part, in order. Otherwise return None.
+
+        """
+        with self._lock:
+            row = self._db.execute("SELECT parent FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row[0] is None:
+                return None
+
+            parent = row[0]
+            parts = [self._row(row) for row in self._db.execute("SELECT {} FROM jobs WHERE parent = ? "
+                "ORDER BY page_start".format(", ".join(COLUMNS)), (parent,))]
+            if any(part["state"] != DONE for part in parts):
+                return None
+
+            cursor = self._db.execute("UPDATE jobs SET state = ?, files = ? WHERE id = ? AND state = ?",
+                (DONE, sum(part["files"] for part in parts), parent, SPLIT))
+            self._db.commit()
+            # Only whoever got here first puts the book together.
+            return parts if cursor.rowcount == 1 else None
+
+    def split(self, worker, job_id, pages, pages_per_job):
+        """Replace a job with one job per range of 'pages_per_job' pages. Returns the number of new jobs."""
+        with self._lock:
+            row = self._db.execute("SELECT {} FROM jobs WHERE id = ? AND worker = ? AND state = ?".format(
+                ", ".join(COLUMNS)), (job_id, worker, ASSIGNED)).fetchone()
+            if row is None:
+                return 0
+
+            job = self._row(row)
+            count = 0
+            for start in range(1, pages + 1, pages_per_job):
+                self._db.execute("INSERT INTO jobs (url, plugin, options, page_start, page_end, state, parent) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)", (job["url"], job["plugin"], json.dumps(job["options"]), start,
+                    min(pages, start + pages_per_job - 1), QUEUED, job_id))
+                count += 1
+            self._db.execute("UPDATE jobs SET state = ?, total = ? WHERE id = ?", (SPLIT, pages, job_id))
+            self._db.commit()
+            return count
+
+    def requeue_stale(self, timeout):
+        """Put jobs back in the queue if their workers haven't sent a heartbeat in 'timeout' seconds."""
+        with self._lock:
+            stale = self._db.execute("SELECT id, worker, attempts FROM jobs WHERE state = ? AND heartbeat < ?",
+                (ASSIGNED, time.time() - timeout)).fetchall()
+            for job_id, worker, attempts in stale:
+                state = FAILED if attempts >= self.max_attempts else QUEUED
+                self._db.execute("UPDATE jobs SET state = ?, worker = NULL, error = ? WHERE id = ?",
+                    (state, "Lost contact with worker '{}'.".format(worker), job_id))
+            self._db.commit()
+            return stale
+
+    def counts(self):
+        with self._lock:
+            return dict(self._db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+def merge_archives(paths, destination):
+    """
+    Merge the zip archives of the parts of a book into one, in order. Files that are in
+    more than one (e.g. metadata) are only kept once. Returns the SHA-1 of every file.
+
+    """
+    hashes = {}
+    with zipfile.ZipFile(destination + TEMP_SUFFIX, "w") as merged:
+        for path in paths:
+            with zipfile.ZipFile(path) as part:
+                for info in part.infolist():
+                    if info.filename in hashes:
+                        continue
+                    data = part.read(info)
+                    merged.writestr(info, data)
+                    hashes[info.filename] = hashlib.sha1(data).hexdigest()
+    os.replace(destination + TEMP_SUFFIX, destination)
+
+    return hashes
+
+class Coordinator:
+    def __init__(self, queue, split_pages=0, heartbeat_timeout=30.0, exit_when_done=True):
+        self.logger = logging.getLogger("mindl")
+        self.queue = queue
+        self.split_pages = split_pages
+        self.heartbeat_timeout = heartbeat_timeout
+        self.exit_when_done = exit_when_done
+        self._server = None
+        self._stop = threading.Event()
+        self._feeding = threading.Event()
+
+    @property
+    def done(self):
+        counts = self.queue.counts()
+        return not self._feeding.is_set() and not counts.get(QUEUED) and not counts.get(ASSIGNED)
+
+    def feed(self, urls, plugin=None):
+        """Queue URLs on a background thread, skipping ones that were already queued by a previous run."""
+        def run():
+            try:
+                added = sum(1 for url in urls if self.queue.add(url, plugin, unique=True) is not None)
+                self.logger.info("Queued {} new jobs.".format(added))
+            finally:
+                self._feeding.clear()
+
+        self._feeding.set()
+        threading.Thread(target=run, name="feed", daemon=True).start()
+
+    def _reaper(self):
+        drained_since = None
+        while not self._stop.wait(min(5.0, self.heartbeat_timeout / 2)):
+            for job_id, worker, attempts in self.queue.requeue_stale(self.heartbeat_timeout):
+                self.logger.warning("Lost contact with worker '{}', so job {} goes back in the queue.".format(
+                    worker, job_id))
+
+            # Give workers a chance to find out there's nothing left before going away.
+            if self.exit_when_done and self.done:
+                drained_since = drained_since or time.time()
+                if time.time() - drained_since > Worker.poll_interval * 3:
+                    self._server.shutdown()
+                    return
+            else:
+                drained_since = None
+
+    def serve(self, address):
+        self._server = ThreadingHTTPServer(address, CoordinatorHandler)
+        self._server.coordinator = self
+        self.logger.info("Coordinating {} jobs on {}:{}.".format(sum(self.queue.counts().values()),
+            *self._server.server_address[:2]))
+
+        reaper = threading.Thread(target=self._reaper, name="reaper", daemon=True)
+        reaper.start()
+        try:
+            self._server.serve_forever()
+        except KeyboardInterrupt:
+            self.logger.info("Shutting down. Unfinished jobs stay in the queue for next time.")
+        finally:
+            self._stop.set()
+            self._server.server_close()
+
+        counts = self.queue.counts()
+        self.logger.info("Jobs: " + ", ".join("{} {}".format(n, state) for state, n in sorted(counts.items())))
+
+class CoordinatorHandler(JsonRequestHandler):
+    def do_GET(self):
+        if self._path_parts() != ["jobs"]:
+            return self._send_json(404, {"error": "Not found."})
+
+        self._send_json(200, self.server.coordinator.queue.jobs())
+
+    def do_POST(self):
+        coordinator = self.server.coordinator
+        queue = coordinator.queue
+        parts = self._path_parts()
+        try:
+            request = self._read_json()
+            if parts == ["jobs"]:
+                check_options(request.get("options") or {})
+                job_id = queue.add(request["url"], request.get("plugin"), request.get("options"))
+                return self._send_json(201, {"id": job_id})
+            elif parts == ["lease"]:
+                job = queue.lease(request["worker"])
+                if job is not None:
+                    coordinator.logger.info("Job {} ({}) goes to worker '{}'.".format(job["id"], job["url"],
+                        request["worker"]))
+                return self._send_json(200, {"job": job, "done": job is None and coordinator.done,
+                    "split_pages": coordinator.split_pages, "heartbeat": coordinator.heartbeat_timeout / 3})
+            elif parts == ["heartbeat"]:
+                lost = [job_id for job_id, (files, total) in request.get("jobs", {}).items()
+                        if not queue.heartbeat(request["worker"], int(job_id), files, total)]
+                return self._send_json(200, {"lost": lost})
+            elif parts == ["split"]:
+                count = queue.split(request["worker"], request["job"], int(request["pages"]), coordinator.split_pages)
+                if count:
+                    coordinator.logger.info("Split job {} into {} jobs.".format(request["job"], count))
+                return self._send_json(200 if count else 409, {"jobs": count})
+            elif parts == ["complete"]:
+                ok = queue.complete(request["worker"], request["job"], request.get("files", 0), request.get("error"),
+                    request.get("path"))
+                if ok and request.get("error"):
+                    coordinator.logger.error("Job {} failed on worker '{}': {}".format(request["job"],
+                        request["worker"], request["error"]))
+                split_parts = queue.finish_split(request["job"]) if ok and not request.get("error") else None
+                if split_parts:
+                    coordinator.logger.info("Every part of job {} is done. Worker '{}' puts it back together."
+                        .format(split_parts[0]["parent"], request["worker"]))
+                return self._send_json(200 if ok else 409, {"ok": ok, "parts": split_parts})
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send_json(400, {"error": str(e)})
+
+        self._send_json(404, {"error": "Not found."})
+
+class WorkerJob(BookStatus):
+    """Reports the progress of a job to the coordinator."""
+    def __init__(self, worker, job):
+        self.worker = worker
+        self.job = job
+        self.dm = None
+
+    def started(self, dm):
+        self.dm = dm
+
+    def current(self):
+        if self.dm is None:
+            return 0, -1
+
+        return self.dm.progress()
+
+    def finished(self, dm, error=None):
+        self.dm = dm
+        self.worker._finished(self, error)
+
+    def lost(self):
+        """The job has been given to someone else, so stop working on it."""
+        if self.dm is not None:
+            self.dm.cancel()
+
+class Worker:
+    # Seconds between asking for jobs when there aren't any, and between heartbeats.
+    poll_interval = 2.0
+    heartbeat_interval = 5.0
+
+    def __init__(self, coordinator_url, plugin_manager, worker_id=None, jobs=1, options=None):
+        self.logger = logging.getLogger("mindl")
+        self.url = coordinator_url.rstrip("/")
+        if "://" not in self.url:
+            self.url = "http://" + self.url
+        self.pm = plugin_manager
+        self.id = worker_id or "{}-{}".format(socket.gethostname(), os.getpid())
+        self.jobs = max(1, jobs)
+        # Default options for every job, as (plugin, key, value) tuples where 'plugin' can be None.
+        self.options = options or []
+        self._active = {}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.jobs)
+        self._stop = threading.Event()
+
+    def _post(self, path, obj):
+        request = urllib.request.Request(self.url + path, data=json.dumps(obj).encode("utf-8"),
+            headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as r:
+                return json.loads(r.read().decode("utf-8"))
+        except urllib.error.HTTPError as e:
+            # Conflicts still come with an answer.
+            if e.code == 409:
+                return json.loads(e.read().decode("utf-8"))
+            raise
+
+    def _heartbeats(self):
+        while not self._stop.wait(self.heartbeat_interval):
+            with self._lock:
+                jobs = dict((job_id, status.current()) for job_id, status in self._active.items())
+            if not jobs:
+                continue
+            try:
+                lost = self._post("/heartbeat", {"worker": self.id, "jobs": jobs}).get("lost", [])
+            except OSError as e:
+                self.logger.warning("Failed to send a heartbeat: {}".format(e))
+                continue
+            for job_id in lost:
+                self.logger.warning("Job {} has been given to another worker. Stopping it.".format(job_id))
+                with self._lock:
+                    status = self._active.get(int(job_id))
+                if status is not None:
+                    status.lost()
+
+    def _finished(self, status, error):
+        files = status.dm.count if status.dm is not None else 0
+        path = status.dm.path if status.dm is not None else None
+        if path is not None and "://" not in path:
+            path = os.path.abspath(path)
+        message = None if error is None else str(error) or type(error).__name__
+        try:
+            response = self._post("/complete", {"worker": self.id, "job": status.job["id"], "files": files,
+                "path": path, "error": message})
+            if response.get("parts"):
+                self._join_parts(status.dm.plugin, status.job["url"], response["parts"])
+        except OSError as e:
+            # The heartbeats stop either way, so the coordinator will give it to someone else.
+            self.logger.error("Failed to tell the coordinator job {} is over: {}".format(status.job["id"], e))
+        finally:
+            with self._lock:
+                self._active.pop(status.job["id"], None)
+            self._slots.release()
+
+    def _join_parts(self, plugin, url, parts):
+        """Put a book that was split into several jobs back together, and record it in the library."""
+        paths = [part["path"] for part in parts]
+        pages = sum(part["files"] for part in parts)
+        if any(path is None for path in paths):
+            self.logger.error("Not every part of '{}' was stored, so it can't be put back together.".format(url))
+            return
+
+        if len(set(paths)) == 1:
+            # Every part went in the same directory, so the book is already whole.
+            path = paths[0]
+            hashes = {}
+        elif all(path.endswith(".zip") and os.path.isfile(path) for path in paths):
+            path = RE_PART.sub("", paths[0])
+            try:
+                hashes = merge_archives(paths, path)
+            except (OSError, zipfile.BadZipFile) as e:
+                self.logger.error("Failed to merge the parts of '{}': {}".format(url, e))
+                return
+            for part in paths:
+                # Parts whose names don't have a page range are merged into the first one.
+                if part != path:
+                    os.remove(part)
+            self.logger.info("Merged {} parts of '{}' into '{}'.".format(len(paths), url, path))
+        else:
+            self.logger.warning("The parts of '{}' are neither in one directory nor all archives on this machine, "
+                "so they're left as they are: {}".format(url, ", ".join(paths)))
+            return
+
+        try:
+            Library.open(DownloadManager.base_directory).record(plugin, url, pages, path, hashes)
+        except Exception:
+            self.logger.exception("Failed to add '{}' to the library.".format(url))
+
+    def _plugin(self, job):
+        """The plugin class for a job, set up with the job's options and page range. Raises ValueError if there is none."""
+        eligible = self.pm.find_handlers(job["url"]) or []
+        if job["plugin"]:
+            eligible = [(p, v) for p, v in eligible if p.name.lower() == job["plugin"].lower()]
+        if len(eligible) != 1:
+            raise ValueError("{} plugins can handle the URL: {}".format("No" if not eligible else "Several", job["url"]))
+
+        plugin = eligible[0][0]
+        options = dict([(k, v) for p, k, v in self.options if p is None or p.lower() == plugin.name.lower()])
+        # Whoever queued the job isn't trusted with anything else.
+        options.update((k, v) for k, v in job["options"].items() if k in JOB_OPTIONS)
+        if job["page_start"] is not None:
+            plugin.process_options()
+            if not all(any(opt.key == key for opt in plugin.options) for key in ("page_start", "page_end")):
+                raise ValueError("The plugin '{}' can't download ranges of pages.".format(plugin.name))
+            options["page_start"] = str(job["page_start"])
+            options["page_end"] = str(job["page_end"])
+
+        return plugin.configured(options)
+
+    def _prepare(self, job, split_pages):
+        """
+        Create the plugin instance for a job, or split the job and return None if it's too big.
+        Raises whatever the plugin raises if it can't be created.
+
+        """
+        plugin = self._plugin(job)(job["url"])
+        if split_pages and job["page_start"] is None and not plugin.partial:
+            progress = plugin.progress()
+            if progress and progress[1] > split_pages and "page_start" in plugin:
+                if self._post("/split", {"worker": self.id, "job": job["id"], "pages": progress[1]}).get("jobs"):
+                    self.logger.info("Split job {} with {} pages into smaller jobs.".format(job["id"], progress[1]))
+                    return None
+
+        return plugin
+
+    def run(self):
+        BasePlugin.keep_sessions = True
+        self.logger.info("Working for {} as '{}'.".format(self.url, self.id))
+        heartbeats = threading.Thread(target=self._heartbeats, name="heartbeats", daemon=True)
+        heartbeats.start()
+        try:
+            with BookScheduler(jobs=self.jobs, prefetch=0, threaded=True) as scheduler:
+                self._loop(scheduler)
+        finally:
+            self._stop.set()
+
+    def _loop(self, scheduler):
+        failures = 0
+        while True:
+            self._slots.acquire()
+            try:
+                response = self._post("/lease", {"worker": self.id})
+                failures = 0
+            except OSError as e:
+                self._slots.release()
+                failures += 1
+                if failures > 5:
+                    self.logger.error("Giving up on reaching the coordinator: {}".format(e))
+                    return
+                time.sleep(self.poll_interval * failures)
+                continue
+
+            # Make sure heartbeats come often enough for the coordinator's liking.
+            self.heartbeat_interval = min(Worker.heartbeat_interval, response.get("heartbeat", Worker.heartbeat_interval))
+            job = response.get("job")
+            if job is None:
+                self._slots.release()
+                if response.get("done"):
+                    self.logger.info("Nothing left to do.")
+                    return
+                time.sleep(self.poll_interval)
+                continue
+
+            status = WorkerJob(self, job)
+            with self._lock:
+                self._active[job["id"]] = status
+            try:
+                plugin = self._prepare(job, response.get("split_pages", 0))
+            except (Exception, SystemExit) as e:
+                self.logger.exception("Failed to start job {}: {}".format(job["id"], job["url"]))
+                self._finished(status, e)
+                continue
+
+            if plugin is None:
+                with self._lock:
+                    self._active.pop(job["id"], None)
+                self._slots.release()
+                continue
+
+            self.logger.info("Starting job {}: {}".format(job["id"], job["url"]))
+            # The instance already exists, so hand it over as is.
+            scheduler.submit(lambda url, plugin=plugin: plugin, job["url"], status=status)
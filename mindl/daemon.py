@@ -0,0 +1,340 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import http.server
+import socketserver
+import itertools
+import threading
+import logging
+import socket
+import queue
+import stat
+import json
+import time
+import os
+
+from .base_plugin import BasePlugin
+from .download_manager import DownloadCancelled
+from .scheduler import BookScheduler, BookStatus
+
+"""
+A long-running process that accepts download jobs through a small HTTP API, either on
+localhost or on a Unix socket. Plugins are only loaded once, and plugins that log in
+keep their sessions around for later jobs.
+
+    POST /jobs              {"url": "...", "plugin": "...", "options": {"key": "value"}}
+                            Queue a job. "plugin" and "options" are optional. Returns the job.
+    GET  /jobs              List every job.
+    GET  /jobs/<id>         Get a single job.
+    GET  /jobs/<id>/events  Stream the job as a line of JSON every time it changes, until it's over.
+
+Only the most recently finished jobs are kept around, up to Daemon.keep_finished of them.
+Older ones are forgotten as new jobs come in.
+
+"""
+
+# Job states.
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+class Job(BookStatus):
+    _ids = itertools.count(1)
+
+    def __init__(self, url, plugin):
+        self.id = next(self._ids)
+        self.url = url
+        self.plugin = plugin
+        self.state = QUEUED
+        self.files = 0
+        self.total = -1
+        self.error = None
+        self.submitted = time.time()
+        self.started_at = None
+        self.finished_at = None
+        # The download's TransferStats.to_dict(), once it's started.
+        self.stats = None
+        # Bumped every time the job changes, so that followers know when to send an update.
+        self.version = 0
+        self._cond = threading.Condition()
+
+    def _changed(self):
+        with self._cond:
+            self.version += 1
+            self._cond.notify_all()
+
+    def started(self, dm):
+        self.state = RUNNING
+        self.started_at = time.time()
+        self._changed()
+
+    def progress(self, dm):
+        self.files, self.total = dm.progress()
+        self.stats = dm.stats.to_dict(dm.remaining())
+        self._changed()
+
+    def finished(self, dm, error=None):
+        if dm is not None:
+            self.files, self.total = dm.progress()
+            self.stats = dm.stats.to_dict()
+        if error is None:
+            self.state = DONE
+        else:
+            self.state = CANCELLED if isinstance(error, DownloadCancelled) else FAILED
+        self.error = None if error is None else str(error) or type(error).__name__
+        self.finished_at = time.time()
+        self._changed()
+
+    @property
+    def over(self):
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    def wait(self, version, timeout=None):
+        """Wait for the job to change from the given version. Returns the current version."""
+        with self._cond:
+            if self.version == version and not self.over:
+                self._cond.wait(timeout)
+            return self.version
+
+    def to_dict(self):
+        return {"id": self.id, "url": self.url, "plugin": self.plugin.name, "state": self.state,
+                "files": self.files, "total": self.total, "error": self.error, "submitted": self.submitted,
+                "started": self.started_at, "finished": self.finished_at, "stats": self.stats}
+
+class Daemon:
+    # How many finished jobs to remember.
+    keep_finished = 100
+
+    def __init__(self, plugin_manager, jobs=1, prefetch=1, options=None):
+        self.logger = logging.getLogger("mindl")
+        self.pm = plugin_manager
+        # Default options for every job, as (plugin, key, value) tuples where 'plugin' can be None.
+        self.options = options or []
+        self.jobs = {}
+        self._jobs_lock = threading.Lock()
+        # The scheduler blocks while it's busy, so jobs go through our own queue first.
+        self._queue = queue.Queue()
+        self._scheduler = BookScheduler(jobs=jobs, prefetch=prefetch, threaded=True)
+        self._server = None
+
+        BasePlugin.keep_sessions = True
+
+    def submit(self, url, plugin_name=None, options=None):
+        """Queue a new job. Raises ValueError if no plugin can take it."""
+        eligible = self.pm.find_handlers(url) or []
+        if plugin_name:
+            eligible = [(p, v) for p, v in eligible if p.name.lower() == plugin_name.lower()]
+        if not eligible:
+            raise ValueError("No plugins can handle the URL: {}".format(url))
+        elif len(eligible) > 1:
+            raise ValueError("Several plugins can handle the URL, so pick one of: {}"
+                .format(", ".join(p.name for p, v in eligible)))
+
+        plugin = eligible[0][0]
+        merged = dict([(k, v) for p, k, v in self.options if p is None or p.lower() == plugin.name.lower()])
+        merged.update(options or {})
+        # Jobs might use different options for the same plugin, so each one gets its own copy.
+        configured = plugin.configured(merged)
+
+        job = Job(url, configured)
+        with self._jobs_lock:
+            self.jobs[job.id] = job
+            self._evict()
+        self._queue.put(job)
+        self.logger.info("Queued job {}: {}".format(job.id, url))
+
+        return job
+
+    def _evict(self):
+        """Forget the finished jobs beyond the 'keep_finished' most recent. Call with _jobs_lock held."""
+        finished = sorted((job for job in self.jobs.values() if job.over), key=lambda job: job.finished_at)
+        for job in finished[:max(0, len(finished) - self.keep_finished)]:
+            del self.jobs[job.id]
+
+    def _dispatch(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            self._scheduler.submit(job.plugin, job.url, status=job)
+
+    def serve(self, address=("127.0.0.1", 8734), socket_path=None):
+        if socket_path is not None:
+            remove_stale_socket(socket_path)
+            self._server = UnixHTTPServer(socket_path, RequestHandler)
+            self.logger.info("Listening on '{}'.".format(socket_path))
+        else:
+            self._server = ThreadingHTTPServer(address, RequestHandler)
+            self.logger.info("Listening on {}:{}.".format(*self._server.server_address[:2]))
+        self._server.daemon = self
+
+        dispatcher = threading.Thread(target=self._dispatch, name="dispatcher", daemon=True)
+        with self._scheduler:
+            dispatcher.start()
+            try:
+                self._server.serve_forever()
+            except KeyboardInterrupt:
+                self.logger.info("Shutting down. Waiting for running jobs to finish...")
+            finally:
+                self._server.server_close()
+                self._shut_down(dispatcher)
+
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+    def _shut_down(self, dispatcher):
+        """Cancel every job that hasn't started yet and stop the dispatcher, leaving the running ones be."""
+        cancelled = 0
+        while True:
+            try:
+                job = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            job.finished(None, DownloadCancelled("The daemon shut down before the job started."))
+            cancelled += 1
+        self._queue.put(None)
+
+        # The dispatcher might be waiting for the scheduler to take a job, which shouldn't start either.
+        while dispatcher.is_alive():
+            cancelled += self._scheduler.drop_pending()
+            dispatcher.join(0.1)
+        cancelled += self._scheduler.drop_pending()
+        if cancelled:
+            self.logger.info("Cancelled {} jobs that hadn't started yet.".format(cancelled))
+
+def remove_stale_socket(path):
+    """
+    Remove the Unix socket at 'path' if nothing is listening on it, e.g. if it was left behind by
+    a daemon that didn't shut down cleanly. Raises OSError if it's not a socket, or if it's in use.
+
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise OSError("'{}' already exists and isn't a socket.".format(path))
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except ConnectionRefusedError:
+            os.remove(path)
+            return
+    raise OSError("Something is already listening on '{}'.".format(path))
+
+class JsonRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Base for request handlers that speak JSON."""
+    server_version = "mindl"
+
+    def log_message(self, format, *args):
+        logger = logging.getLogger("mindl")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("API: " + format % args)
+
+    def _send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        """Read the body as a JSON object. Raises ValueError if it isn't one."""
+        length = int(self.headers.get("Content-Length", 0))
+        obj = json.loads(self.rfile.read(length).decode("utf-8")) if length else {}
+        if not isinstance(obj, dict):
+            raise ValueError("Expected a JSON object.")
+
+        return obj
+
+    def _path_parts(self):
+        return [p for p in self.path.split("?", 1)[0].split("/") if p]
+
+class RequestHandler(JsonRequestHandler):
+
+    def _job(self, job_id):
+        try:
+            return self.server.daemon.jobs.get(int(job_id))
+        except ValueError:
+            return None
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        parts = self._path_parts()
+        if parts == ["jobs"]:
+            with daemon._jobs_lock:
+                jobs = [job.to_dict() for job in daemon.jobs.values()]
+            return self._send_json(200, jobs)
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self._job(parts[1])
+            if job is None:
+                return self._send_json(404, {"error": "No such job."})
+            if len(parts) == 2:
+                return self._send_json(200, job.to_dict())
+            elif parts[2] == "events":
+                return self._stream(job)
+
+        self._send_json(404, {"error": "Not found."})
+
+    def _stream(self, job):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        version = -1
+        while True:
+            current = job.wait(version, timeout=15)
+            # Send something every now and then even if nothing changed, so dead clients are noticed.
+            self.wfile.write((json.dumps(job.to_dict(), ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+            if job.over:
+                return
+            version = current
+
+    def do_POST(self):
+        daemon = self.server.daemon
+        if self._path_parts() != ["jobs"]:
+            return self._send_json(404, {"error": "Not found."})
+
+        try:
+            request = self._read_json()
+            job = daemon.submit(request["url"], request.get("plugin"), request.get("options"))
+        except (ValueError, KeyError, TypeError) as e:
+            return self._send_json(400, {"error": str(e)})
+
+        self._send_json(201, job.to_dict())
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+if hasattr(socketserver, "UnixStreamServer"):
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+        def get_request(self):
+            # Unix sockets have no client address, which the request handler expects.
+            request, address = super().get_request()
+            return request, ("local", 0)
+else:
+    UnixHTTPServer = None
@@ -0,0 +1,120 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import sqlite3
+import os.path
+import os
+
+DEDUP_FILENAME = ".mindl_dedup.sqlite"
+
+def format_size(size):
+    """Format a number of bytes for humans."""
+    if size < 1024:
+        return "{} B".format(size)
+    for unit in ("KiB", "MiB", "GiB"):
+        size /= 1024
+        if size < 1024 or unit == "GiB":
+            return "{:.1f} {}".format(size, unit)
+
+class DedupStore:
+    """
+    Keeps track of the content of every file written under a directory, so that a file
+    identical to one that's already on disk (e.g. the same ad or credits page in every
+    volume of a series) can be hardlinked to it instead of being written again.
+
+    Files are identified by the SHA-256 of their content. The index is an SQLite database
+    with the hash as its primary key, so lookups stay fast no matter how many files there
+    are. Files that have been deleted or changed since they were indexed are noticed when
+    linking to them fails or their size is off, and are then dropped from the index.
+
+    Only files written to directories (by a DirectorySink) are linked and indexed. Files in
+    archives or object stores can't be linked to, so they're left out entirely.
+
+    Use DedupStore.open() so that every download under the same directory shares one store.
+
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, DEDUP_FILENAME)
+        # Totals for every file linked through this store.
+        self.linked_files = 0
+        self.saved_bytes = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        # Losing the last few entries in a crash only means a few files get written instead of linked.
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS files (sha256 TEXT PRIMARY KEY, size INTEGER, path TEXT)")
+        self._db.commit()
+
+    @classmethod
+    def open(cls, directory):
+        key = os.path.abspath(directory)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(directory)
+            return cls._instances[key]
+
+    def link(self, sha256, size, destination):
+        """
+        Hardlink 'destination' to a file with the same content if there is one.
+        Returns True if it was linked, and False if it has to be written.
+
+        """
+        with self._lock:
+            row = self._db.execute("SELECT path FROM files WHERE sha256 = ?", (sha256,)).fetchone()
+        if row is None:
+            return False
+
+        source = row[0]
+        try:
+            if os.path.getsize(source) != size:
+                raise FileNotFoundError(source)
+            os.link(source, destination)
+        except FileNotFoundError:
+            # Gone or changed since, so whatever is written next takes its place.
+            with self._lock:
+                self._db.execute("DELETE FROM files WHERE sha256 = ? AND path = ?", (sha256, source))
+                self._db.commit()
+            return False
+        except OSError:
+            # Most likely a different filesystem, or one without hardlinks.
+            return False
+
+        with self._lock:
+            self.linked_files += 1
+            self.saved_bytes += size
+        return True
+
+    def add(self, sha256, size, path):
+        """Index a file that has been written, unless its content is already indexed."""
+        with self._lock:
+            self._db.execute("INSERT OR IGNORE INTO files VALUES (?, ?, ?)", (sha256, size, os.path.abspath(path)))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+        with self._instances_lock:
+            self._instances.pop(os.path.abspath(self.directory), None)
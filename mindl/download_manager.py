@@ -18,20 +18,58 @@
 
 import logging
 import os.path
+import time
 import sys
 import os
 
+from . import events, metrics, trace
 from .base_plugin import BasePlugin
+from .dedup import DedupStore, format_size
+from .manifest import Manifest, book_identity
 from .progress_bar import LineReservePrinter, ProgressBar
+from .sinks import ARCHIVES, DirectorySink
+from .transfer_stats import TransferStats
+
+class DownloadCancelled(Exception):
+    """Raised by DownloadManager.start_download() when the download was cancelled."""
+    pass
 
 class DownloadManager():
     base_directory = "downloads"
+    # Number of threads writing files, and how many files to write before syncing them to disk (0 to never sync).
+    writer_threads = 4
+    fsync_every = 0
+    # Archive format ("zip" or "tar") to store files in for plugins that don't pick their own sink, or None for directories.
+    archive = None
+    # An S3Client and key prefix to upload files to instead of writing them to base_directory.
+    object_store = None
+    object_store_prefix = ""
+    # Hardlink files identical to ones already downloaded under base_directory instead of writing them again.
+    # Only directory sinks do this, as files in archives or object stores can't be linked to.
+    dedup = False
     
-    def __init__(self, plugin):
+    def __init__(self, plugin, printer=None, on_progress=None, url=None):
         self.logger = logging.getLogger("mindl")
         self._plugin = plugin
+        self.url = url
+        plugin.source_url = url
+        # When several downloads run at once, they share a printer and report progress
+        # through on_progress(manager, filename) instead of drawing their own progress bar.
+        self._printer = printer
+        self._on_progress = on_progress
         self._count = 0
         self._progress_bar = None
+        self._manifests = []
+        self._sink = None
+        # The SHA-1 of every file stored, by filename.
+        self._hashes = {}
+        # Bytes fetched and written, and how fast. Also added to TransferStats.total.
+        self.stats = TransferStats(parent=TransferStats.total)
+        plugin.stats = self.stats
+        plugin.resume_check = self.resume_check
+        # When each file was handed to the sink, by filename. Only kept when sending events.
+        self._submitted = {}
+        self._cancelled = False
 
     def start_download(self):
         if not self._plugin.has_valid_options():
@@ -40,51 +78,232 @@ class DownloadManager():
 
         self.logger.info("Starting download...")
         try:
-            with LineReservePrinter(sys.stdout) as lrp:
-                for dl in self._plugin.downloader():
-                    # We get the file before we create directories. This allows the generator
-                    # to get necessary info about what we're downloading before having to decide
-                    # on what to name the directory.
-                    filename, data = dl
-
-                    # We allow the plugin to change directories in between files.
-                    path = os.path.join(self.base_directory, self._plugin.directory())
-
-                    if not os.path.isdir(path):
-                        self.logger.info("Creating non-existent directory '{}'.".format(path))
-                        os.makedirs(path)
-
-                    with open(os.path.join(path, filename), "wb") as f:
-                        f.write(data)
-
-                    self._count += 1
-                    
-                    progress = self._plugin.progress()
-                    if self._progress_bar is None:
-                        if progress:
-                            current, total = progress
-                            self._progress_bar = ProgressBar(total=total,
-                                units="files", singular="file")
-                        else:
-                            self._progress_bar = ProgressBar(units="files", singular="file")
-
-                    self._progress_bar.update(1)
-                    lrp.line = self._progress_bar.get("Last: " + filename)
-                    lrp.flush()
+            if self._printer is None:
+                with LineReservePrinter(sys.stdout) as lrp:
+                    self._download(lrp)
+            else:
+                self._download(self._printer)
+        except DownloadCancelled:
+            self._close_sink(finished=False)
+            raise
         except Exception as e:
             self.logger.critical("An uncaught exception was raised while downloading.")
             if self._plugin.handle_exception(e) is True:
                 pass
             else:
+                self._close_sink(finished=False)
                 raise e
 
-    def finalize(self):
-        if self._count:
-            self.logger.info("Done! A total of {} files were downloaded.".format(self._count))
+    def _download(self, lrp):
+        try:
+            for dl in self._plugin.downloader():
+                if self._cancelled:
+                    raise DownloadCancelled("The download was cancelled.")
+                # We get the file before we create directories. This allows the generator
+                # to get necessary info about what we're downloading before having to decide
+                # on what to name the directory.
+                filename, data = dl
+                if not self._plugin.reports_received:
+                    self.stats.received(len(data))
+
+                sink = self._open_sink()
 
-            # Check if finalize() has been overridden and call if it has.
-            if self._plugin.finalize.__code__ is not BasePlugin.finalize.__code__:
-                self.logger.info("Finalizing...")
-                self._plugin.finalize()
+                # We allow the plugin to change directories in between files.
+                path = os.path.join(self.base_directory, self._plugin.directory())
+                if events.enabled():
+                    self._submitted[filename] = time.monotonic()
+                # Blocks while the sink has too many files waiting to be stored.
+                with trace.span("submit", "wait", file=filename):
+                    sink.submit(path, filename, data)
+                self._handle_written(lrp)
+        except DownloadCancelled:
+            raise
+        except Exception:
+            # Plugins stopping short because they were cancelled isn't what went wrong.
+            if self._cancelled:
+                raise DownloadCancelled("The download was cancelled.")
+            raise
         else:
-            self.logger.info("No files were downloaded.")
+            if self._cancelled:
+                raise DownloadCancelled("The download was cancelled.")
+        finally:
+            # Whatever made it to the sink still gets written, even if the download failed.
+            if self._sink is not None:
+                self._sink.flush()
+                self._handle_written(lrp)
+
+    def cancel(self):
+        """Stop the download from another thread. start_download() raises DownloadCancelled."""
+        self._cancelled = True
+        self._plugin.cancel()
+
+    @property
+    def plugin(self):
+        return self._plugin
+
+    @property
+    def count(self):
+        return self._count
+
+    @property
+    def hashes(self):
+        return self._hashes
+
+    @property
+    def path(self):
+        """Where the files are stored, or None if nothing has been stored."""
+        return getattr(self._sink, "path", None)
+
+    def progress(self):
+        """The number of files stored, including resumed ones, and the total if known (-1 otherwise)."""
+        if self._progress_bar is None:
+            return self._plugin.resumed(), -1
+
+        return self._progress_bar.current, self._progress_bar.total
+
+    def remaining(self):
+        """The number of files left to download, or -1 if unknown."""
+        current, total = self.progress()
+        return -1 if total == -1 else max(0, total - current)
+
+    def describe_progress(self):
+        """The download rate and ETA, followed by a separator if there's anything to say yet."""
+        out = self.stats.describe(self.remaining())
+        return out + " | " if out else ""
+
+    def resume_check(self):
+        """
+        A function telling whether a previous run of this download already stored a file, given its
+        filename, so that it can be skipped. None if there's nothing to pick up.
+
+        """
+        sink = self._open_sink()
+        if sink.resumable:
+            manifest = self._manifest(os.path.join(self.base_directory, self._plugin.directory()))
+            return manifest.is_complete if len(manifest) else None
+
+        stored = sink.stored()
+        return stored.__contains__ if stored else None
+
+    def _open_sink(self):
+        # The plugin can decide where its files go, but only once it knows what it's downloading.
+        if self._sink is None:
+            self._sink = self._plugin.sink() or self.open_sink(self._plugin.directory(), archive=self.archive,
+                identity=book_identity(self._plugin, self.url))
+
+        return self._sink
+
+    def _close_sink(self, finished):
+        if self._sink is not None:
+            self._sink.close(finished=finished)
+
+    @classmethod
+    def open_sink(cls, name, archive=None, prefix="", identity=None):
+        """
+        Open a sink for a download named 'name', which is either a directory or an archive of
+        the given format, on the local filesystem or the object store if one is set. 'prefix'
+        is prepended to the name of every file in an archive.
+
+        'identity' identifies the book (see manifest.book_identity()), so that a local zip
+        archive a previous run of the same download didn't finish can be picked up again.
+
+        """
+        if archive is not None:
+            if archive not in ARCHIVES:
+                raise ValueError("Unknown archive format: {}".format(archive))
+            ext, sink_class = ARCHIVES[archive]
+            if cls.object_store is not None:
+                from .s3 import MultipartUpload
+                key = "/".join(p for p in (cls.object_store_prefix, name + ext) if p)
+                upload = MultipartUpload(cls.object_store, key, concurrency=cls.object_store.concurrency)
+                return sink_class("s3://{}/{}".format(cls.object_store.bucket, key), fileobj=upload, prefix=prefix)
+            if archive == "zip":
+                return sink_class(os.path.join(cls.base_directory, name + ext), prefix=prefix, identity=identity)
+            return sink_class(os.path.join(cls.base_directory, name + ext), prefix=prefix)
+
+        directory = os.path.join(cls.base_directory, name)
+        if cls.object_store is not None:
+            from .s3 import S3Sink
+            return S3Sink(cls.object_store, cls.object_store_prefix, cls.base_directory, directory)
+        dedup = DedupStore.open(cls.base_directory) if cls.dedup else None
+        return DirectorySink(directory, threads=cls.writer_threads, fsync_every=cls.fsync_every, dedup=dedup)
+
+    def _handle_written(self, lrp):
+        """Update the manifest and progress for files that have been written since last time."""
+        for result in self._sink.completed():
+            if result.error is not None:
+                raise result.error
+
+            if self._sink.resumable:
+                self._manifest(result.directory).record(result.filename, result.size, result.sha1,
+                    index=self._plugin.file_index(result.filename))
+            self._count += 1
+            self._hashes[result.filename] = result.sha1
+            self.stats.written(result.size)
+            metrics.page_size.observe(result.size)
+            if events.enabled():
+                submitted = self._submitted.pop(result.filename, None)
+                events.emit("page", url=self.url, file=result.filename, size=result.size,
+                    fetch=self._plugin.fetch_time(result.filename),
+                    store=None if submitted is None else time.monotonic() - submitted)
+
+            if self._progress_bar is None:
+                # Files skipped when resuming count towards the progress as well.
+                progress = self._plugin.progress()
+                if progress:
+                    current, total = progress
+                    self._progress_bar = ProgressBar(initial=self._plugin.resumed(), total=total,
+                        units="files", singular="file")
+                else:
+                    self._progress_bar = ProgressBar(initial=self._plugin.resumed(),
+                        units="files", singular="file")
+
+            self._progress_bar.update(1)
+            if self._on_progress is not None:
+                self._on_progress(self, result.filename)
+            else:
+                lrp.line = self._progress_bar.get(self.describe_progress() + "Last: " + result.filename)
+                lrp.flush()
+
+    def _manifest(self, path):
+        if not self._manifests or self._manifests[-1].directory != path:
+            self._manifests.append(Manifest.open(path, book_identity(self._plugin, self.url)))
+
+        return self._manifests[-1]
+
+    def finalize(self):
+        # The plugin might move or delete the directory, so let go of the manifests first.
+        for manifest in self._manifests:
+            manifest.close()
+
+        try:
+            resumed = self._plugin.resumed()
+            if self._count or resumed:
+                if resumed:
+                    self.logger.info("Done! A total of {} files were downloaded and {} were already downloaded."
+                        .format(self._count, resumed))
+                else:
+                    self.logger.info("Done! A total of {} files were downloaded.".format(self._count))
+
+                # Check if finalize() has been overridden and call if it has.
+                if self._plugin.finalize.__code__ is not BasePlugin.finalize.__code__:
+                    self.logger.info("Finalizing...")
+                    self._plugin.finalize()
+            else:
+                self.logger.info("No files were downloaded.")
+        finally:
+            # Closed after the plugin's finalize(), since it might want to add files of its own to the sink.
+            if self._sink is not None:
+                self._close_sink(finished=self._finished())
+                if self._sink.linked_files:
+                    self.logger.info("Linked {} files identical to ones already downloaded, saving {}."
+                        .format(self._sink.linked_files, format_size(self._sink.saved_bytes)))
+
+    def _finished(self):
+        """Whether the plugin got every file it expected to."""
+        progress = self._plugin.progress()
+        if not progress:
+            return True
+
+        current, total = progress
+        return total == -1 or current >= total
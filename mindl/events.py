@@ -0,0 +1,146 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import logging
+import socket
+import atexit
+import queue
+import json
+import time
+import os
+
+"""
+A stream of events as newline-delimited JSON, for whatever is orchestrating mindl to
+follow what it's doing without having to parse the logs or the progress bar.
+
+Every event is a JSON object with an 'event' name and the 'time' it happened, plus
+fields that depend on the event:
+
+  book_start  url, plugin
+  page        url, file, size, fetch (seconds, if known), store (seconds from being
+              handed to the sink to being stored)
+  retry       url, item, attempt, max_attempts, error
+  gave_up     url, item, error
+  stalled     url, item, host, thread, seconds (a thread got stuck on an item, which
+              was given to another thread)
+  book_end    url, plugin, files, total, path, error, stats (see TransferStats.to_dict())
+  summary     stats for the whole run
+
+emit() only puts the event in a queue, and a background thread encodes and writes it,
+so downloads never wait on whoever is reading. It does nothing until start() is called.
+
+"""
+
+_END = object()
+
+class EventStream:
+    def __init__(self, fileobj):
+        self.logger = logging.getLogger("mindl")
+        self._file = fileobj
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="events", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def connect(cls, target):
+        """
+        Open an event stream to 'target', which is 'fd:N' for an open file descriptor,
+        'unix:PATH' or 'tcp:HOST:PORT' for a socket, or else the path of a file to append to.
+
+        """
+        kind, _, rest = target.partition(":")
+        if kind == "fd" and rest.isdigit():
+            return cls(os.fdopen(int(rest), "wb", closefd=False))
+        elif kind == "unix":
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(rest)
+            return cls(sock.makefile("wb"))
+        elif kind == "tcp":
+            host, _, port = rest.rpartition(":")
+            if not port.isdigit():
+                raise ValueError("The address '{}' is not in the right format. Please use 'tcp:host:port'.".format(target))
+            sock = socket.create_connection((host or "127.0.0.1", int(port)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            return cls(sock.makefile("wb"))
+
+        return cls(open(target, "ab"))
+
+    def put(self, event):
+        self._queue.put(event)
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is _END:
+                break
+
+            # Write whatever else is already queued along with it.
+            lines = [event]
+            while True:
+                try:
+                    event = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if event is _END:
+                    self._queue.put(_END)
+                    break
+                lines.append(event)
+
+            data = "".join(json.dumps(e, ensure_ascii=False) + "\n" for e in lines).encode("utf-8")
+            try:
+                # Buffered writers keep writing until everything's gone out, unlike raw ones.
+                self._file.write(data)
+                self._file.flush()
+            except OSError as e:
+                # Whoever was reading is gone. There's no point in keeping the events around.
+                self.logger.warning("Stopped sending events: {}".format(e))
+                break
+
+        try:
+            self._file.close()
+        except OSError:
+            pass
+
+    def close(self):
+        self._queue.put(_END)
+        self._thread.join()
+
+_stream = None
+
+def start(target):
+    """Start sending events to 'target' (see EventStream.connect()). They're flushed at exit."""
+    global _stream
+    _stream = EventStream.connect(target)
+    atexit.register(close)
+
+def enabled():
+    return _stream is not None
+
+def emit(event, **fields):
+    stream = _stream
+    if stream is None:
+        return
+
+    stream.put(dict(event=event, time=time.time(), **fields))
+
+def close():
+    global _stream
+    stream, _stream = _stream, None
+    if stream is not None:
+        stream.close()
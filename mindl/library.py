@@ -0,0 +1,101 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import sqlite3
+import os.path
+import json
+import time
+import os
+
+LIBRARY_FILENAME = ".mindl_library.sqlite"
+
+class Library:
+    """
+    An index of every book that has been downloaded in full, keyed by the plugin's name and
+    the book's content ID (see BasePlugin.content_id()), so that a URL for a book we already
+    have can be skipped without even creating a plugin instance.
+
+    A book only counts as downloaded if where it was stored still exists, so deleting a book
+    is enough to have it downloaded again. Books stored in an object store can't be checked,
+    so those are always assumed to still be there.
+
+    Use Library.open() so that every download under the same directory shares one instance.
+
+    """
+    # Set to False to download books again even if they're in the library. They're still recorded.
+    enabled = True
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, LIBRARY_FILENAME)
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS books (plugin TEXT, content_id TEXT, url TEXT, pages INTEGER, "
+            "path TEXT, hashes TEXT, finished REAL, PRIMARY KEY (plugin, content_id))")
+        self._db.commit()
+
+    @classmethod
+    def open(cls, directory):
+        key = os.path.abspath(directory)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(directory)
+            return cls._instances[key]
+
+    def find(self, plugin, url):
+        """
+        Return a dictionary describing the book at 'url' if it's been downloaded by 'plugin'
+        and is still where it was stored, or None otherwise.
+
+        """
+        with self._lock:
+            row = self._db.execute("SELECT url, pages, path, finished FROM books WHERE plugin = ? AND content_id = ?",
+                (plugin.name, plugin.content_id(url))).fetchone()
+        if row is None:
+            return None
+
+        url, pages, path, finished = row
+        if path and "://" not in path and not os.path.exists(path):
+            return None
+
+        return {"url": url, "pages": pages, "path": path, "finished": finished}
+
+    def has(self, plugin, url):
+        return self.enabled and self.find(plugin, url) is not None
+
+    def record(self, plugin, url, pages, path, hashes):
+        """Record a finished book. 'hashes' is a dictionary of the SHA-1 of every file by filename."""
+        # Relative paths would only be found again from the same working directory.
+        if path and "://" not in path:
+            path = os.path.abspath(path)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?, ?)", (plugin.name,
+                plugin.content_id(url), url, pages, path, json.dumps(hashes, ensure_ascii=False), time.time()))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+        with self._instances_lock:
+            self._instances.pop(os.path.abspath(self.directory), None)
@@ -0,0 +1,52 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+from . import trace
+
+class Limiter:
+    """
+    A semaphore used as a context manager to cap how many threads across every running
+    download can do something at once. A limit of 0 means unlimited. Set the limit before
+    any download starts, as changing it replaces the underlying semaphore.
+
+    """
+    def __init__(self, limit=0, name=""):
+        # Shown in traces, for the time spent waiting on the limit.
+        self.name = name
+        self.set(limit)
+
+    def set(self, limit):
+        self.limit = max(0, int(limit))
+        self._semaphore = threading.BoundedSemaphore(self.limit) if self.limit else None
+
+    def __enter__(self):
+        if self._semaphore is not None:
+            with trace.span("wait for " + self.name, "wait"):
+                self._semaphore.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._semaphore is not None:
+            self._semaphore.release()
+
+# Requests to remote servers, e.g. for images.
+connections = Limiter(name="connections")
+# CPU heavy work, e.g. descrambling and encoding images.
+cpu = Limiter(name="cpu")
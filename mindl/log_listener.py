@@ -0,0 +1,114 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import logging.handlers
+import threading
+import logging
+import atexit
+import queue
+
+"""
+Sends every log record through a queue to a single listener thread, which is the only
+thing that ever writes them out. Download threads log a lot and the console is slow (and
+while a progress bar is shown, sys.stdout is a LineReservePrinter with its own lock), so
+this keeps a page fetch from ever waiting on the terminal.
+
+Records are handed over as they are and only formatted on the listener thread, which is
+fine since they never leave the process. Since they're written out a little later than
+they're logged, call flush() before writing to the console directly, e.g. to ask for input. Each logger's level is set to the lowest level
+of its handlers, so logging calls below it return before a record is even created. Guard
+debug calls whose message is expensive to build with logger.isEnabledFor(logging.DEBUG).
+
+"""
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The default formats the message and traceback on the calling thread, which is
+        # only needed to pickle the record. Ours never leave the process.
+        return record
+
+class _Dispatcher:
+    """
+    Hands every record to the handlers of the logger it was logged to and those of its
+    ancestors, up to the first one that doesn't propagate, the same as Logger.callHandlers().
+
+    """
+    def __init__(self):
+        self.handlers = {}
+        self.thread = None
+
+    def handle(self, record):
+        self.thread = threading.current_thread()
+        if isinstance(record, threading.Event):
+            # From flush(), which is waiting for everything queued before it.
+            record.set()
+            return
+
+        logger = logging.getLogger(record.name)
+        while logger is not None:
+            for handler in self.handlers.get(logger.name, ()):
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            if not logger.propagate:
+                return
+            logger = logger.parent
+
+_queue = queue.SimpleQueue()
+_dispatcher = _Dispatcher()
+_queue_handler = _QueueHandler(_queue)
+_listener = None
+_lock = threading.Lock()
+
+def add_handler(logger, handler):
+    """
+    Have 'handler' handle the records logged to 'logger', on the listener thread.
+    The logger mustn't propagate, or records would also be handled on the calling thread.
+
+    """
+    global _listener
+    with _lock:
+        handlers = _dispatcher.handlers.setdefault(logger.name, [])
+        handlers.append(handler)
+        logger.setLevel(min(h.level for h in handlers) or logging.DEBUG)
+        if _queue_handler not in logger.handlers:
+            logger.addHandler(_queue_handler)
+
+        if _listener is None:
+            _listener = logging.handlers.QueueListener(_queue, _dispatcher)
+            _listener.start()
+            atexit.register(stop)
+
+def flush(timeout=5.0):
+    """Wait for every record logged so far to be written out."""
+    with _lock:
+        listener = _listener
+    # Handlers logging something of their own would otherwise wait on themselves.
+    if listener is None or threading.current_thread() is _dispatcher.thread:
+        return
+
+    done = threading.Event()
+    _queue.put(done)
+    done.wait(timeout)
+
+def stop():
+    """Write out every record that's still queued and stop the listener thread."""
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
@@ -0,0 +1,170 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import hashlib
+import logging
+import os.path
+import json
+import os
+
+MANIFEST_FILENAME = ".mindl_manifest"
+
+def book_identity(plugin, url):
+    """What identifies the book 'plugin' is downloading from 'url' in a manifest, or None if it can't be told."""
+    if url is None:
+        return None
+
+    try:
+        return "{}:{}".format(plugin.name, plugin.content_id(url))
+    except Exception:
+        return None
+
+class Manifest:
+    """
+    Keeps track of which files have been completely written to a directory, so that
+    an interrupted download can be resumed without downloading everything again.
+
+    Each completed file is appended to the manifest as a line of JSON with its size
+    and hash as soon as it's written, meaning a crash will at worst lose the last line.
+    A file is only considered complete if it's in the manifest and the file on disk
+    still has the recorded size, and either the recorded modification time or hash.
+
+    The first line identifies the book (see book_identity()). Directory names aren't
+    always unique to a book, so a manifest for a different book is ignored, and replaced
+    as soon as something is recorded.
+
+    Use Manifest.open() instead of instantiating it directly, so that the download
+    manager and the plugin share the same instance for the same directory.
+
+    """
+    # Set to False to ignore existing manifests and download everything again.
+    enabled = True
+
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, directory, identity=None):
+        self.logger = logging.getLogger("mindl")
+        self.directory = directory
+        self.identity = identity
+        self.path = os.path.join(directory, MANIFEST_FILENAME)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._file = None
+        # Whether what's on disk is for a different book (or ignored) and has to be started over.
+        self._replace = not self.enabled
+        if self.enabled:
+            self._load()
+
+    @classmethod
+    def open(cls, directory, identity=None):
+        key = os.path.abspath(directory)
+        with cls._instances_lock:
+            if key not in cls._instances:
+                cls._instances[key] = cls(directory, identity)
+            return cls._instances[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, filename):
+        return filename in self._entries
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+
+        with open(self.path, encoding="utf-8") as f:
+            try:
+                header = json.loads(f.readline())
+            except ValueError:
+                header = {}
+            if not isinstance(header, dict) or "identity" not in header or \
+                    (self.identity is not None and header["identity"] != self.identity):
+                self.logger.info("Ignoring the manifest in '{}', as it's for a different download."
+                    .format(self.directory))
+                self._replace = True
+                return
+
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Most likely a line cut short by a crash. Whatever file it was will just be downloaded again.
+                    continue
+                self._entries[entry["filename"]] = entry
+
+    def _open_file(self):
+        if self._replace or not os.path.isfile(self.path):
+            self._file = open(self.path, "w", encoding="utf-8")
+            self._file.write(json.dumps({"identity": self.identity}, ensure_ascii=False) + "\n")
+            self._replace = False
+            return
+
+        # Don't append to the end of a line cut short by a crash.
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            cut_short = f.read(1) != b"\n"
+        self._file = open(self.path, "a", encoding="utf-8")
+        if cut_short:
+            self._file.write("\n")
+
+    def record(self, filename, size, sha1, index=None):
+        entry = {"filename": filename, "index": index, "size": size, "sha1": sha1}
+        try:
+            entry["mtime"] = os.stat(os.path.join(self.directory, filename)).st_mtime_ns
+        except OSError:
+            pass
+        with self._lock:
+            if self._file is None:
+                self._open_file()
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+            self._entries[filename] = entry
+
+    def is_complete(self, filename):
+        entry = self._entries.get(filename)
+        if entry is None:
+            return False
+
+        path = os.path.join(self.directory, filename)
+        try:
+            stat = os.stat(path)
+            if stat.st_size != entry["size"]:
+                return False
+            if stat.st_mtime_ns == entry.get("mtime"):
+                return True
+
+            # Touched since, so only the content can tell.
+            sha1 = hashlib.sha1()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha1.update(chunk)
+            return sha1.hexdigest() == entry["sha1"]
+        except OSError:
+            return False
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+        with self._instances_lock:
+            self._instances.pop(os.path.abspath(self.directory), None)
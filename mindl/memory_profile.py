@@ -0,0 +1,199 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import tracemalloc
+import threading
+import linecache
+import logging
+import atexit
+
+from .dedup import format_size
+
+"""
+Accounts for memory per stage of the pipeline (fetching, descrambling, encoding,
+writing...) and per page, using tracemalloc, to find out where memory goes and catch it
+growing.
+
+Every stage is run with 'with memory_profile.stage("name", page=...):'. tracemalloc only
+knows how much the whole process has allocated, so while profiling only one stage runs at
+a time, which makes downloads slower but means whatever was allocated during a stage was
+allocated by it. For each stage we keep how far above where it started memory went (its
+peak) and how much of it was still allocated when it ended (what it handed on). Bytes
+held in queues between stages are tracked with held(), and the biggest allocation sites
+are taken from a snapshot at the highest memory usage seen.
+
+Until start() is called, stage() returns a shared object that does nothing.
+
+"""
+
+class _Usage:
+    def __init__(self):
+        self.calls = 0
+        self.peak = 0
+        self.peak_total = 0
+        self.retained = 0
+
+    def add(self, peak, retained):
+        self.calls += 1
+        self.peak = max(self.peak, peak)
+        self.peak_total += peak
+        self.retained += retained
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+_NULL = _NullStage()
+
+class MemoryProfile:
+    # Frames kept per allocation. More frames tell more about where it came from, but cost more.
+    frames = 8
+    # How often the sampler checks overall memory usage, and how much higher than the last
+    # snapshot it has to be for another snapshot to be taken.
+    sample_interval = 0.25
+    snapshot_growth = 1.1
+    # How many pages and allocation sites to report.
+    top = 10
+
+    def __init__(self):
+        self.logger = logging.getLogger("mindl")
+        self._lock = threading.RLock()
+        self._stages = {}
+        self._pages = {}
+        # Bytes held in each queue now and at most.
+        self._held = {}
+        self._held_peak = {}
+        self._snapshot = None
+        self._snapshot_size = 0
+        self._stop = threading.Event()
+        tracemalloc.start(self.frames)
+        self._thread = threading.Thread(target=self._sample, name="memory-profile", daemon=True)
+        self._thread.start()
+
+    def stage(self, name, page=None):
+        return _Stage(self, name, page)
+
+    def held(self, name, size):
+        with self._lock:
+            held = self._held.get(name, 0) + size
+            self._held[name] = held
+            if held > self._held_peak.get(name, 0):
+                self._held_peak[name] = held
+
+    def _record(self, name, page, peak, retained):
+        self._stages.setdefault(name, _Usage()).add(peak, retained)
+        if page is not None:
+            self._pages.setdefault(page, _Usage()).add(peak, retained)
+
+    def _sample(self):
+        while not self._stop.wait(self.sample_interval):
+            current, peak = tracemalloc.get_traced_memory()
+            if current > self._snapshot_size * self.snapshot_growth:
+                self._take_snapshot(current)
+
+    def _take_snapshot(self, size):
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, linecache.__file__)))
+        self._snapshot = snapshot
+        self._snapshot_size = size
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        current, peak = tracemalloc.get_traced_memory()
+        if self._snapshot is None or current > self._snapshot_size:
+            self._take_snapshot(current)
+        tracemalloc.stop()
+        return peak
+
+    def report(self):
+        """Stop profiling and log what was found."""
+        peak = self.stop()
+        log = self.logger.info
+        log("Memory profile. Highest traced memory usage: {}.".format(format_size(peak)))
+        log("By stage (peak is how far memory went above where the stage started, retained what was still "
+            "allocated when it ended):")
+        for name, usage in sorted(self._stages.items(), key=lambda item: -item[1].peak):
+            log("  {:<12} {:>6} calls, peak {:>10} (avg {:>10}), retained {:>10} (avg {:>10})".format(name,
+                usage.calls, format_size(usage.peak), format_size(usage.peak_total // usage.calls),
+                format_size(usage.retained), format_size(usage.retained // usage.calls)))
+
+        if self._pages:
+            log("Pages with the highest peak:")
+            pages = sorted(self._pages.items(), key=lambda item: -item[1].peak)[:self.top]
+            for page, usage in pages:
+                log("  {:<12} peak {:>10} over {} stages".format(str(page), format_size(usage.peak), usage.calls))
+
+        if self._held_peak:
+            log("Most bytes held in queues at once:")
+            for name, size in sorted(self._held_peak.items()):
+                log("  {:<20} {:>10}".format(name, format_size(size)))
+
+        if self._snapshot is not None:
+            log("Biggest allocation sites when memory usage was at {}:".format(format_size(self._snapshot_size)))
+            for stat in self._snapshot.statistics("lineno")[:self.top]:
+                frame = stat.traceback[0]
+                log("  {:>10} in {} blocks at {}:{}".format(format_size(stat.size), stat.count, frame.filename,
+                    frame.lineno))
+
+class _Stage:
+    def __init__(self, profile, name, page):
+        self._profile = profile
+        self._name = name
+        self._page = page
+
+    def __enter__(self):
+        self._profile._lock.acquire()
+        tracemalloc.reset_peak()
+        self._start = tracemalloc.get_traced_memory()[0]
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            current, peak = tracemalloc.get_traced_memory()
+            self._profile._record(self._name, self._page, max(0, peak - self._start), max(0, current - self._start))
+        finally:
+            self._profile._lock.release()
+
+_profile = None
+
+def start():
+    """Start profiling. The report is logged at exit."""
+    global _profile
+    _profile = MemoryProfile()
+    atexit.register(report)
+
+def stage(name, page=None):
+    if _profile is None:
+        return _NULL
+    return _profile.stage(name, page)
+
+def held(name, size):
+    """Count 'size' more bytes (or fewer, if negative) as being held in the queue 'name'."""
+    if _profile is not None:
+        _profile.held(name, size)
+
+def report():
+    global _profile
+    profile, _profile = _profile, None
+    if profile is not None:
+        profile.report()
@@ -0,0 +1,238 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import http.server
+import threading
+import logging
+import bisect
+import atexit
+import time
+import os
+
+from urllib.parse import urlsplit
+
+from .transfer_stats import TransferStats
+
+"""
+Metrics in the Prometheus text format, either served over HTTP (--metrics) or written to
+a file every few seconds for node_exporter's textfile collector (--metrics-file).
+
+Nothing is recorded until enable() is called, and until then every update returns right
+away, so the metrics below can be updated from hot paths without costing anything when
+no one is looking at them. Metrics that can be read off something we already keep track
+of (e.g. TransferStats.total) take a 'collect' function instead, and cost nothing at all.
+
+"""
+
+class Metric:
+    # Whether updates are recorded. Shared by every metric, see enable().
+    enabled = False
+    type = None
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._collect = collect
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def samples(self):
+        """Yield (suffix, labels, value) for every sample."""
+        raise NotImplementedError("'samples' needs to be implemented.")
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help), "# TYPE {} {}".format(self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            if labels:
+                labels = "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+            lines.append("{}{}{} {}".format(self.name, suffix, labels or "", _number(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """A count that only goes up. Label values are passed as a tuple in the order of 'labels'."""
+    type = "counter"
+
+    def __init__(self, name, help, labels=(), collect=None):
+        super().__init__(name, help, labels, collect)
+        self._values = {}
+
+    def inc(self, amount=1, labels=()):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        if self._collect is not None:
+            yield "", (), self._collect()
+            return
+
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield "", tuple(zip(self.labels, labels)), value
+
+class Gauge(Counter):
+    """A value that goes up and down."""
+    type = "gauge"
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+class Histogram(Metric):
+    """Counts observations in buckets, e.g. how long something took."""
+    type = "histogram"
+
+    def __init__(self, name, help, buckets, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Observations per bucket (not cumulative), then their sum, by label values.
+        self._values = {}
+
+    def observe(self, value, labels=()):
+        if not self.enabled:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, labels=()):
+        """Use as 'with histogram.time():' to observe how long the block took."""
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = sorted((labels, list(counts)) for labels, counts in self._values.items())
+        for labels, counts in values:
+            labels = tuple(zip(self.labels, labels))
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                total += count
+                yield "_bucket", labels + (("le", _number(bound)),), total
+            yield "_sum", labels, counts[-1]
+            yield "_count", labels, total
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.monotonic() if self._histogram.enabled else None
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._started is not None:
+            self._histogram.observe(time.monotonic() - self._started, self._labels)
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+registry = []
+
+# Most of what we download takes between a few milliseconds and a few seconds.
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+received_bytes = Counter("mindl_received_bytes_total", "Bytes downloaded.",
+    collect=lambda: TransferStats.total.received_bytes)
+written_bytes = Counter("mindl_written_bytes_total", "Bytes stored.",
+    collect=lambda: TransferStats.total.written_bytes)
+pages = Counter("mindl_pages_total", "Pages (or other files) stored.",
+    collect=lambda: TransferStats.total.written_files)
+page_size = Histogram("mindl_page_size_bytes", "The size of every page stored.",
+    (16 * 1024, 64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024, 16 * 1024 * 1024))
+books = Counter("mindl_books_total", "Books finished, by whether they failed.", labels=("result",))
+http_responses = Counter("mindl_http_responses_total", "HTTP responses, by host and status code.",
+    labels=("host", "code"))
+fetch_seconds = Histogram("mindl_fetch_seconds", "How long it took to fetch and process each page.", SECONDS)
+descramble_seconds = Histogram("mindl_descramble_seconds", "How long it took to descramble each page.", SECONDS)
+encode_seconds = Histogram("mindl_encode_seconds", "How long it took to encode each descrambled page.", SECONDS)
+retries = Counter("mindl_retries_total", "Pages that failed and were retried, or given up on.", labels=("result",))
+fetched_queue = Gauge("mindl_fetched_queue_depth", "Pages fetched and waiting to be handed to storage.")
+write_queue = Gauge("mindl_write_queue_depth", "Files waiting for a writer thread.")
+in_flight = Gauge("mindl_requests_in_flight", "Pages being fetched right now.",
+    collect=lambda: TransferStats.total.in_flight)
+active_downloads = Gauge("mindl_active_downloads", "Books being downloaded right now.")
+
+def count_response(response, *args, **kwargs):
+    """A requests response hook that counts responses by host and status code."""
+    http_responses.inc(labels=(urlsplit(response.url).netloc, str(response.status_code)))
+
+def enable():
+    Metric.enabled = True
+
+def render():
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+    server_version = "mindl"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def serve(address):
+    """Enable metrics and serve them at http://address/metrics on a background thread."""
+    enable()
+    server = http.server.ThreadingHTTPServer(address, _RequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+def write_file(path):
+    # Written under another name and renamed, so whatever reads it never sees half of it.
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(render())
+    os.replace(path + ".tmp", path)
+
+def write_periodically(path, interval=5.0):
+    """Enable metrics and write them to 'path' every 'interval' seconds, and once more at exit."""
+    enable()
+    logger = logging.getLogger("mindl")
+
+    def run():
+        while True:
+            try:
+                write_file(path)
+            except OSError as e:
+                logger.warning("Could not write metrics to '{}': {}".format(path, e))
+            time.sleep(interval)
+
+    write_file(path)
+    threading.Thread(target=run, name="metrics", daemon=True).start()
+    atexit.register(write_file, path)
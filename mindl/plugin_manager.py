@@ -17,15 +17,165 @@
 # along with mindl. If not, see <http://www.gnu.org/licenses/>.
 
 from .base_plugin import BasePlugin
+from . import log_listener
 
+import importlib.util
 import importlib
 import pkgutil
 import logging
+import ast
 import sys
+import re
+
+from collections import defaultdict
+
+"""
+Plugins are found by reading their source instead of importing them, since importing
+a plugin means importing whatever it depends on (e.g. selenium), which is slow. For that
+to work, a plugin module can declare the URLs it handles as a tuple of regular expressions
+in string literals named URL_PATTERNS:
+
+    URL_PATTERNS = (r"^https?://example.com/book/(?P<id>[0-9]+)", )
+
+The module is only imported once a URL matches one of its patterns, after which the
+plugin's can_handle() has the final say. Plugins without URL_PATTERNS are imported right
+away like before, so they still work, just without the faster startup.
+
+To avoid trying every plugin on every URL, plugins are indexed by the host (or scheme,
+for things like dummy://) their patterns start with, and each plugin's patterns are
+combined into a single regular expression. Patterns that don't start with a literal host
+are tried on every URL.
+
+"""
+
+# Used to find out which host or scheme a URL pattern is for.
+RE_GROUP_NAME = re.compile(r"\(\?P<\w+>")
+RE_PATTERN_SCHEME = re.compile(r"\^?(?P<scheme>https\?|https?|[a-z][a-z0-9+-]*)://", flags=re.I)
+RE_PATTERN_HOST = re.compile(r"(?:\(\?:www\\?\.\)\?)?(?P<host>(?:[a-z0-9-]|\\?\.)+)(?:/|\\\?|\$)", flags=re.I)
+
+class PluginEntry():
+    """What the plugin manager knows about a plugin before it's imported."""
+    def __init__(self, modname, classname, name=None, version=None, patterns=None):
+        self.modname = modname
+        self.classname = classname
+        self.name = name or classname
+        self.version = version
+        self.patterns = patterns
+        self._matcher = combine_patterns(patterns) if patterns is not None else None
+        self._plugin = None
+
+    @property
+    def loaded(self):
+        return self._plugin is not None
+
+    def load(self):
+        """Import the plugin and return its class. Raises ImportError if it can't be imported."""
+        if self._plugin is None:
+            module = importlib.import_module(self.modname)
+            plugin = getattr(module, self.classname, None)
+            if plugin is None or not isinstance(plugin, type) or not issubclass(plugin, BasePlugin):
+                raise ImportError("'{}' does not have a plugin class named '{}'.".format(self.modname, self.classname))
+            self._plugin = plugin
+
+        return self._plugin
+
+    def might_handle(self, url):
+        """False if the plugin can't handle the URL for sure. Otherwise the plugin has to be asked."""
+        if self._matcher is None:
+            return True
+
+        return self._matcher(url) is not None
+
+    def route_keys(self):
+        """The keys of every URL the plugin might handle (see url_route_key()), or None if it can't tell."""
+        if self.patterns is None:
+            return None
+
+        keys = set(pattern_route_key(p) for p in self.patterns)
+        return None if None in keys else keys
+
+def combine_patterns(patterns):
+    """Combine regular expressions into a single one and return its match function."""
+    # Group names can't be repeated, and we only care whether it matches anyway.
+    if not any("(?P=" in p for p in patterns):
+        try:
+            return re.compile("|".join("(?:{})".format(RE_GROUP_NAME.sub("(?:", p)) for p in patterns)).match
+        except re.error:
+            pass
+
+    regexes = [re.compile(p) for p in patterns]
+    return lambda url: next((m for m in (r.match(url) for r in regexes) if m), None)
+
+def url_route_key(url):
+    """The host of the URL without any 'www.', or its scheme if it isn't HTTP(S). None if it has neither."""
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        return None
+
+    scheme = scheme.lower()
+    if scheme not in ("http", "https"):
+        return scheme + ":"
+
+    host = re.split(r"[/?#]", rest, 1)[0].rsplit("@", 1)[-1].split(":", 1)[0].lower()
+    return host[4:] if host.startswith("www.") else host
+
+def pattern_route_key(pattern):
+    """What url_route_key() returns for every URL the pattern matches, or None if it can't tell."""
+    m = RE_PATTERN_SCHEME.match(pattern)
+    if not m:
+        return None
+
+    scheme = m.group("scheme").lower()
+    if not scheme.startswith("http"):
+        return scheme + ":"
+
+    m = RE_PATTERN_HOST.match(pattern, m.end())
+    if not m:
+        return None
+
+    host = m.group("host").replace("\\.", ".").lower()
+    return host[4:] if host.startswith("www.") else host
+
+def read_plugin_entry(modname, path):
+    """
+    Read the name, version and URL patterns of a plugin from its source without importing it.
+    Returns None if the module doesn't look like a plugin.
+
+    """
+    classname = modname.split(".")[-1]
+    with open(path, "rb") as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    found = False
+    name = None
+    version = None
+    patterns = None
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name):
+            target = node.targets[0].id
+            try:
+                if target == "__version__":
+                    version = ast.literal_eval(node.value)
+                elif target == "URL_PATTERNS":
+                    patterns = tuple(ast.literal_eval(node.value))
+            except ValueError:
+                # Not a literal, so we can't know without importing it.
+                pass
+        elif isinstance(node, ast.ClassDef) and node.name == classname:
+            found = True
+            for item in node.body:
+                if (isinstance(item, ast.Assign) and len(item.targets) == 1 and isinstance(item.targets[0], ast.Name)
+                        and item.targets[0].id == "name" and isinstance(item.value, ast.Constant)):
+                    name = item.value.value
+
+    if not found:
+        return None
+
+    return PluginEntry(modname, classname, name=name, version=version, patterns=patterns)
 
 class PluginManager():
     def __init__(self):
-        self.plugins = {}
+        self.entries = []
         self.logger = logging.getLogger("mindl")
 
         try:
@@ -36,42 +186,104 @@ class PluginManager():
 
         prefix = package.__name__ + "."
         for importer, modname, ispkg in (m for m in pkgutil.iter_modules(package.__path__, prefix) if not m[2]):
+            spec = importlib.util.find_spec(modname)
             try:
-                module = importlib.import_module(modname)
-            except ImportError as e:
-                self.logger.exception("Plugin '{}' could not be loaded: {}".format(modname.split(".")[-1], e))
+                entry = read_plugin_entry(modname, spec.origin)
+            except (OSError, SyntaxError, ValueError) as e:
+                self.logger.error("Plugin '{}' could not be read: {}".format(modname.split(".")[-1], e))
                 continue
-            
-            classname = modname.split(".")[-1]
-            if hasattr(module, classname) and issubclass(getattr(module, classname).__class__, BasePlugin.__class__):
-                self.logger.debug("Loading plugin '{}'...".format(classname))
-                try:
-                    ver = getattr(module, "__version__")
-                except AttributeError:
-                    ver = None
-                self.plugins[getattr(module, classname)] = ver
+            if entry is None:
+                continue
+
+            # Without patterns there's no way of telling which URLs it handles, so import it now.
+            if entry.patterns is None and not self._load(entry):
+                continue
+
+            self.logger.debug("Registered plugin '{}'...".format(entry.classname))
+            self.entries.append(entry)
+
+        self._build_index()
+
+    def _build_index(self):
+        # Plugins by the key of the URLs they handle, and plugins that need to be tried on every URL.
+        self._by_key = defaultdict(list)
+        self._unkeyed = []
+        for entry in self.entries:
+            keys = entry.route_keys()
+            if keys is None:
+                self._unkeyed.append(entry)
+            else:
+                for key in keys:
+                    self._by_key[key].append(entry)
+
+        self._order = dict((entry, i) for i, entry in enumerate(self.entries))
+
+    def candidates(self, url):
+        """The plugins that might handle the URL, in the order they were registered."""
+        keyed = self._by_key.get(url_route_key(url), ())
+        if not self._unkeyed:
+            return list(keyed)
+        elif not keyed:
+            return list(self._unkeyed)
+
+        return sorted(set(keyed).union(self._unkeyed), key=self._order.get)
+
+    def route(self, urls):
+        """
+        Yield every URL along with a list of the plugins that handle it, without importing any
+        plugins that haven't been imported already. Meant for planning large batches of URLs.
+
+        """
+        for url in urls:
+            yield url, [entry for entry in self.candidates(url) if entry.might_handle(url) and
+                        (entry.patterns is not None or entry.load().can_handle(url))]
+
+    @property
+    def plugins(self):
+        """Every plugin class along with its version. Imports every plugin, so avoid if possible."""
+        return dict((entry.load(), entry.version) for entry in list(self.entries) if self._load(entry))
+
+    def _load(self, entry):
+        try:
+            entry.load()
+        except ImportError as e:
+            self.logger.exception("Plugin '{}' could not be loaded: {}".format(entry.classname, e))
+            # No point in trying again for every URL.
+            if entry in self.entries:
+                self.entries.remove(entry)
+                self._build_index()
+            return False
+
+        return True
 
     def find_handlers(self, url):
-        self.logger.debug("Finding handlers for '{}'".format(url))
+        # This runs for every URL, so skip building debug messages nobody will see.
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            self.logger.debug("Finding handlers for '{}'".format(url))
         # A list of plugin classes that will handle the URL.
         handlers = []
-        # A list of strings with plugin name and version for debug purposes.
-        out = []
-        for plugin, version in self.plugins.items():
+        for entry in self.candidates(url):
+            if not entry.might_handle(url) or not self._load(entry):
+                continue
+            plugin = entry.load()
             if plugin.can_handle(url):
-                handlers.append((plugin, version))
-                out.append("{} v{}".format(plugin.name, version) if version else plugin.name)
+                handlers.append((plugin, entry.version))
 
         if not handlers:
-            self.logger.debug("Found no handlers.")
+            if debug:
+                self.logger.debug("Found no handlers.")
             return None
 
-        self.logger.debug("Found the following handlers: {}".format(", ".join(out)))
+        if debug:
+            out = ("{} v{}".format(plugin.name, version) if version else plugin.name for plugin, version in handlers)
+            self.logger.debug("Found the following handlers: {}".format(", ".join(out)))
         return handlers
 
     def select_plugin(self, url, plugins):
         self.logger.info("Found multiple plugins that can handle '{}'.".format(url))
         self.logger.info("Please select one of the following plugins:")
+        log_listener.flush()
 
         i = 1
         for plugin, version in plugins:
@@ -89,8 +301,8 @@ class PluginManager():
                     return plugins[got - 1]
                 else:
                     self.logger.error("The number does not match any plugin. Please try again...")
+                    log_listener.flush()
                     got = ""
             except ValueError:
                 self.logger.error("Unintelligible number. Please try again...")
-
-
+                log_listener.flush()
@@ -33,10 +33,18 @@ URL_BOOKLIVE_API = "http://www.animatebookstore.com/sws/apis/"
 URL_LOGIN_PAGE = "https://www.animatebookstore.com/mypage/"
 URL_LOGIN = "https://www.animatebookstore.com/frontparts/login_check.php"
 
-RE_BOOK = re.compile(r"^https?://(?:www.)?animatebookstore.com/products/detail.php\?product_id=(?P<product_id>\d+?)", flags=re.ASCII)
-RE_BOOKVIEW = re.compile(r"https?://(?:www.)?animatebookstore.com/bookview/\?u0=(?P<product_id>\d+?)&(?:amp;)?cid=(?P<cid>\d+)", flags=re.ASCII)
+# Read by the plugin manager without importing the plugin, so these have to stay string literals.
+URL_PATTERNS = (r"^https?://(?:www.)?animatebookstore.com/products/detail.php\?product_id=(?P<product_id>\d+?)",
+                r"https?://(?:www.)?animatebookstore.com/bookview/\?u0=(?P<product_id>\d+?)&(?:amp;)?cid=(?P<cid>\d+)")
+
+RE_BOOK = re.compile(URL_PATTERNS[0], flags=re.ASCII)
+RE_BOOKVIEW = re.compile(URL_PATTERNS[1], flags=re.ASCII)
 RE_TITLE_CLEANUP = re.compile(r".+?( ?(?P<volume>[0-9]+)巻)$")
 
+def _timeout():
+    """The same timeouts BinBApi uses, for requests made before there's a BinBApi instance."""
+    return (binbapi.BinBApi.connect_timeout, binbapi.BinBApi.read_timeout)
+
 class animatebookstore(BinBPlugin):
     name = "AnimateBookstore"
     options = BinBPlugin.options + [("username", ""), ("password", "")]
@@ -59,7 +67,7 @@ class animatebookstore(BinBPlugin):
         # Get product ID and content ID.
         regex = RE_BOOK.match(url)
         if regex:
-            r = s.get(url)
+            r = s.get(url, timeout=_timeout())
             product_id, cid = RE_BOOKVIEW.search(r.text).groups()
         else:
             regex = RE_BOOKVIEW.match(url)
@@ -102,10 +110,15 @@ class animatebookstore(BinBPlugin):
     def can_handle(url):
         return any((RE_BOOK.match(url), RE_BOOKVIEW.match(url)))
 
+    @classmethod
+    def content_id(cls, url):
+        # Both kinds of URLs have the product ID, but only the viewer has the content ID.
+        return (RE_BOOK.match(url) or RE_BOOKVIEW.match(url)).group("product_id")
+
     def login(self, session):
         # Get a token first.
         self.logger.debug("Getting a login token...")
-        r = session.get(URL_LOGIN_PAGE)
+        r = session.get(URL_LOGIN_PAGE, timeout=_timeout())
         # When you open the login page, you get a 302 to a URL with a "transactionId",
         # which we need for the login POST.
         if not len(r.history):
@@ -124,7 +137,7 @@ class animatebookstore(BinBPlugin):
             "login_pass": self._password,
             "login_memory": 0
             }
-        r = session.post(URL_LOGIN, data=params)
+        r = session.post(URL_LOGIN, data=params, timeout=_timeout())
         if r.status_code != requests.codes.ok:
             self.logger.critical("The server responded with status code {} while logging in."
                 .format(r.status_code))
@@ -1,2 +1,2 @@
-from .binb_api import BinBApi, BinBApiError, SERVERTYPE_SBC, SERVERTYPE_STATIC, USER_AGENT
+from .binb_api import BinBApi, BinBApiError, SERVERTYPE_SBC, SERVERTYPE_STATIC, USER_AGENT, descramble_data_key
 from .descramble import BinBDescrambler, DescrambleRectangle
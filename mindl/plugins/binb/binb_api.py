@@ -93,6 +93,16 @@ SERVERTYPE_UNSET = None
 SERVERTYPE_SBC = 0
 SERVERTYPE_STATIC = 1
 
+def descramble_data_key(cid, k):
+    """The initial key the descrambling data in get_content_info's response is encrypted with."""
+    s = cid + ":" + k
+    res = 0
+    for i, char in enumerate(s):
+        res += ord(char) << (i % 16)
+    res &= 0x7FFFFFFF
+
+    return res or 0x12345678
+
 class BinBApiError(Exception):
     """Generic exception raised when the API returns <=0, meaning something went wrong."""
     pass
@@ -106,6 +116,10 @@ class BinBApi:
     # L has pretty bad artifacting, so most of the time S_H > M_L.
     # I've never seen anything over M, so for now I'm assuming it doesn't exist.
     image_size_priorities = ("M_H", "S_H", "M_L", "S_L") # SS omitted.
+    # Seconds to wait for a connection, and then for the server to send anything at all, before a request fails.
+    # Without these a request to a server that stopped responding would never return.
+    connect_timeout = 10
+    read_timeout = 30
     
     def __init__(self, bib_url, cid, logger=None, requests_session=None, **kwargs):
         self._bib = bib_url if bib_url.endswith("/") else bib_url + "/"
@@ -152,6 +166,11 @@ class BinBApi:
 
         return res
 
+    @property
+    def timeout(self):
+        """The timeout to pass to every request made through our session."""
+        return (self.connect_timeout, self.read_timeout)
+
     @property
     def cid(self):
         if self._cid is None:
@@ -295,7 +314,7 @@ class BinBApi:
         url = BIB_API_METHODS["get_content_info"].format(bib=self.bib,
             params=urlencode(params))
         self._logger.debug("Calling get_content_info: {}".format(url))
-        r = self.session.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
         
@@ -324,7 +343,7 @@ class BinBApi:
         url = BIB_API_METHODS["get_bibliography"].format(bib=self.bib,
             params=urlencode(params))
         self._logger.debug("Calling get_bibliography: {}".format(url))
-        r = self.session.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
         
@@ -360,7 +379,7 @@ class BinBApi:
         params = dict(cid=self.cid, p=self.p, **self._kwargs, **kwargs)
         url = SBC_API_METHODS["check_login"].format(bib=self.bib, params=urlencode(params))
         self._logger.debug("Calling get_content: {}".format(url))
-        r = self.session.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
         elif r.json()["result"] != 1:
@@ -373,7 +392,7 @@ class BinBApi:
         params = dict(cid=self.cid, p=self.p, **self._kwargs, **kwargs)
         url = SBC_API_METHODS["check_p"].format(sbc=self.sbc, params=urlencode(params))
         self._logger.debug("Calling check_p: {}".format(url))
-        r = self.session.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
         elif r.json()["result"] != 1:
@@ -392,7 +411,7 @@ class BinBApi:
         """
         if self.server_type == SERVERTYPE_STATIC and not self.allow_sbc_on_static:
             url = self.sbc + "content.js"
-            r = self.session.get(url)
+            r = self.session.get(url, timeout=self.timeout)
             if r.status_code != requests.codes.ok:
                 r.raise_for_status()
             self._content = json.loads(RE_CONTENT_JS.match(r.text).group("data"))
@@ -401,7 +420,7 @@ class BinBApi:
             params = dict(cid=self.cid, p=self.p, **self._kwargs, **kwargs)
             url = SBC_API_METHODS["get_content"].format(sbc=self.sbc, params=urlencode(params))
             self._logger.debug("Calling get_content: {}".format(url))
-            r = self.session.get(url)
+            r = self.session.get(url, timeout=self.timeout)
             if r.status_code != requests.codes.ok:
                 r.raise_for_status()
             
@@ -425,7 +444,7 @@ class BinBApi:
         if self.server_type == SERVERTYPE_STATIC and not self.allow_sbc_on_static:
             for size in self.image_size_priorities:
                 url = self.sbc + self.page_paths[page_number] + "/{}.jpg".format(size)
-                r = self.session.get(url)
+                r = self.session.get(url, timeout=self.timeout)
                 if r.status_code != requests.codes.ok:
                     continue
                 else:
@@ -437,7 +456,7 @@ class BinBApi:
             self._assert_sbc_server_type()
             params = dict(cid=self.cid, p=self.p, src=self.page_paths[page_number], h=9999, q=0, **self._kwargs, **kwargs)
             url = SBC_API_METHODS["get_image"].format(sbc=self.sbc, params=urlencode(params))
-            r = self.session.get(url)
+            r = self.session.get(url, timeout=self.timeout)
             if r.status_code != requests.codes.ok:
                 r.raise_for_status()
 
@@ -451,7 +470,7 @@ class BinBApi:
         self._assert_sbc_server_type()
         params = dict(cid=self.cid, p=self.p, src=self.page_paths[page_number], h=9999, q=0, **self._kwargs, **kwargs)
         url = SBC_API_METHODS["get_image_base64"].format(sbc=self.sbc, params=urlencode(params))
-        r = self.session.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
 
@@ -484,7 +503,7 @@ class BinBApi:
             params = dict(cid=self.cid, p=self.p, src=self.nec_page_paths[page_number], h=9999, q=0, **self._kwargs, **kwargs)
         
         url = SBC_API_METHODS["get_nec_image"].format(sbc=self.sbc, params=urlencode(params))
-        r = self.session.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
 
@@ -505,7 +524,7 @@ class BinBApi:
         self._assert_sbc_server_type()
         params = dict(cid=self.cid, p=self.p, h=9999, q=0, **self._kwargs, **kwargs)
         url = SBC_API_METHODS["get_nec_image_list"].format(sbc=self.sbc, params=urlencode(params))
-        r = self.session.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
 
@@ -534,7 +553,7 @@ class BinBApi:
         self._assert_sbc_server_type()
         params = dict(cid=self.cid, p=self.p, src=self.page_paths[page_number], h=9999, q=0, **self._kwargs, **kwargs)
         url = SBC_API_METHODS["get_small_image"].format(sbc=self.sbc, params=urlencode(params))
-        r = self.session.get(url)
+        r = self.session.get(url, timeout=self.timeout)
         if r.status_code != requests.codes.ok:
             r.raise_for_status()
 
@@ -565,7 +584,7 @@ class BinBApi:
             self._assert_sbc_server_type()
             params = dict(cid=self.cid, p=self.p, h=9999, q=0, **self._kwargs, **kwargs)
             url = SBC_API_METHODS["get_small_image_list"].format(sbc=self.sbc, params=urlencode(params))
-            r = self.session.get(url)
+            r = self.session.get(url, timeout=self.timeout)
             if r.status_code != requests.codes.ok:
                 r.raise_for_status()
 
@@ -626,16 +645,7 @@ class BinBApi:
                 raise RuntimeError("allow_sbc_on_static is True, but no 'p' was received.")
 
     def _decrypt_descramble_data(self, ciphertext):
-        def generate_key(cid, k):
-            s = cid + ":" + k
-            res = 0
-            for i, char in enumerate(s):
-                res += ord(char) << (i % 16)
-            res &= 0x7FFFFFFF
-
-            return res or 0x12345678
-
-        key = generate_key(self.cid, self.k)
+        key = descramble_data_key(self.cid, self.k)
         res = ""
         for i, char in enumerate(ciphertext):
             key = (key >> 1) ^ (-(key & 1) & 0x48200004)
@@ -661,6 +671,15 @@ class BinBApi:
         """
         return self._descrambler.descramble(self.pages[page_number], BytesIO(image_data), **kwargs)
 
+    def descramble_image(self, page_number, image_data):
+        """The same as descramble(), but returns a PIL image to be encoded later with encode()."""
+        return self._descrambler.descramble_image(self.pages[page_number], BytesIO(image_data))
+
+    @staticmethod
+    def encode(image, **kwargs):
+        """Encode a descrambled PIL image. Keyword arguments work the same as in descramble()."""
+        return BinBDescrambler.encode(image, **kwargs)
+
 if __name__ == "__main__":
     import sys
     logging.basicConfig(format='[%(levelname)s] %(message)s', level=logging.DEBUG)
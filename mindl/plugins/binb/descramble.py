@@ -289,6 +289,10 @@ class BinBDescrambler:
         return img_width, img_height, res
 
     def descramble(self, filename, file, format="JPEG", **kwargs):
+        return self.encode(self.descramble_image(filename, file), format=format, **kwargs)
+
+    def descramble_image(self, filename, file):
+        """Descramble the image, but return it as a PIL image instead of encoding it."""
         img = PIL.Image.open(file, mode="r")
         img_arr = img.load()
 
@@ -305,13 +309,17 @@ class BinBDescrambler:
             for x in range(rect.width):
                 for y in range(rect.height):
                     new_arr[x + rect.dst_x, y+rect.dst_y] = img_arr[x + rect.src_x, y + rect.src_y]
-        
+
+        return new
+
+    @staticmethod
+    def encode(image, format="JPEG", **kwargs):
         image_data = io.BytesIO()
         if format == "JPEG":
             if "quality" not in kwargs:
                 kwargs["quality"] = 95
             if "optimize" not in kwargs:
                 kwargs["optimize"] = True
-        new.save(image_data, format=format, **kwargs)
+        image.save(image_data, format=format, **kwargs)
 
         return image_data.getvalue()
@@ -30,8 +30,12 @@ URL_BOOKLIVE_API = "https://booklive.jp/bib-api/"
 URL_LOGIN_SCREEN = "https://booklive.jp/login"
 URL_LOGIN = "https://booklive.jp/login/index"
 
-RE_BOOK = re.compile(r"^https?://booklive.jp/product/index/title_id/(?P<title_id>[0-9]+?)/vol_no/(?P<volume>[0-9]+?)$")
-RE_READER = re.compile(r"^https?://booklive.jp/bviewer/\?cid=(?P<cid>[_0-9]+)")
+# Read by the plugin manager without importing the plugin, so these have to stay string literals.
+URL_PATTERNS = (r"^https?://booklive.jp/product/index/title_id/(?P<title_id>[0-9]+?)/vol_no/(?P<volume>[0-9]+?)$",
+                r"^https?://booklive.jp/bviewer/\?cid=(?P<cid>[_0-9]+)")
+
+RE_BOOK = re.compile(URL_PATTERNS[0])
+RE_READER = re.compile(URL_PATTERNS[1])
 RE_TITLE_CLEANUP = re.compile(r".+?( ?\([0-9]+\)| ?[0-9]+巻)$")
 
 class booklive(BinBPlugin):
@@ -88,7 +92,7 @@ class booklive(BinBPlugin):
     def login(self, session):
         # Get a token first.
         self.logger.debug("Getting a login token...")
-        r = session.get(URL_LOGIN_SCREEN)
+        r = session.get(URL_LOGIN_SCREEN, timeout=self.binb.timeout)
         res = re.search("input type=\"hidden\" name=\"token\" value=\"(.+?)\">", r.text)
         if res:
             token = res.group(1)
@@ -98,7 +102,7 @@ class booklive(BinBPlugin):
         # Log in.
         self.logger.debug("Logging in as '{}'...".format(self._username))
         params = {"mail_addr": self._username, "pswd": self._password, "token": token}
-        r = session.post(URL_LOGIN, data=params)
+        r = session.post(URL_LOGIN, data=params, timeout=self.binb.timeout)
 
         for cookie in session.cookies:
             if cookie.name == "BL_LI":
@@ -107,6 +111,14 @@ class booklive(BinBPlugin):
 
         return False
 
+    @classmethod
+    def content_id(cls, url):
+        r = RE_BOOK.match(url)
+        if r:
+            return "{}_{}".format(*r.groups())
+
+        return RE_READER.match(url).group("cid")
+
     @staticmethod
     def can_handle(url):
         return any((RE_BOOK.match(url), RE_READER.match(url)))
@@ -16,55 +16,175 @@
 # You should have received a copy of the GNU General Public License
 # along with mindl. If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+import binascii
 import random
-import hashlib
+import math
+import time
 import os
 
-from time import sleep
 from re import match
-from mindl import BasePlugin, download_directory
+from mindl import download_directory, memory_profile, trace
+from mindl.plugins.utils.threaded_downloader import ThreadedDownloaderPlugin
 
-__version__ = "0.1"
+__version__ = "0.2"
+# Read by the plugin manager without importing the plugin, so this has to stay a string literal.
+URL_PATTERNS = (r"^dummy://.*$", )
 
-class dummy(BasePlugin):
-    """Simulates downloads by creating random data and sleeping in between files. Useful for testing stuff."""
+# Suffixes allowed in sizes, e.g. "64k".
+SIZE_UNITS = {"": 1, "b": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+def parse_size(text):
+    text = text.strip().lower()
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ""
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+def size_distribution(text):
+    """
+    Parse a file size distribution, returning a function that picks a size using a
+    random.Random, and the largest size it can pick. One of:
+
+      64k               every file is the same size
+      16k-1m            uniform between the two sizes
+      lognormal:256k:1  log-normal with the given median and sigma, capped at 16 times the median
+
+    """
+    if text.startswith("lognormal:"):
+        median, sigma = text[len("lognormal:"):].split(":")
+        median, sigma = parse_size(median), float(sigma)
+        cap = median * 16
+        return (lambda rng: min(cap, max(1, int(rng.lognormvariate(math.log(median), sigma))))), cap
+    elif "-" in text:
+        low, high = (parse_size(x) for x in text.split("-", 1))
+        low, high = min(low, high), max(low, high)
+        return (lambda rng: rng.randint(low, high)), high
+
+    size = parse_size(text)
+    return (lambda rng: size), size
+
+class dummy(ThreadedDownloaderPlugin):
+    """
+    Generates files instead of downloading them, to test and benchmark everything around
+    the plugins: the download manager, progress, storage and so on.
+
+    Files are cut from a block of random data generated up front, so making them costs next
+    to nothing: they're handed over as memoryviews of it, and only files larger than the
+    block are copied. 'length' is how many seconds each file takes to "download" on one of the
+    'threads', 'rate' caps how many files are made per second across all of them (0 for no
+    cap), and 'fail' is the chance of a file failing and having to be retried. With a length
+    and rate of 0, files are made as fast as they can be stored.
+
+    """
     name = "Dummy"
     options = ( ("n", 20),
                 ("length", 0.75),
+                ("rate", 0),
+                ("threads", 1),
+                ("size", "4k-64k"),
+                ("fail", 0),
+                ("seed", ""),
+                ("chatter", 1),
                 ("cleanup", 1),
-                ("progress", 1) )
+                ("progress", 1),
+                ("page_start", 1),
+                ("page_end", "end") )
+
+    # The most random data to generate up front. Files are cut from it, wrapping around if they don't fit.
+    pattern_size = 8 * 1024 ** 2
+    # Injected failures should be retried quickly, and never give up on the whole download.
+    retry_backoff = 0.05
+    retry_backoff_max = 1.0
+    host_error_budget = 0
 
     def __init__(self, url):
-        self.count = 0
+        self.first = max(1, int(self["page_start"]))
+        self.last = int(self["n"]) if self["page_end"] == "end" else min(int(self["n"]), int(self["page_end"]))
+        self.partial = (self.first, self.last) != (1, int(self["n"]))
+
+        self._length = float(self["length"])
+        self._interval = 1 / float(self["rate"]) if float(self["rate"]) > 0 else 0
+        self._next = time.monotonic()
+        self._fail = float(self["fail"])
+        self._chatter = bool(int(self["chatter"]))
+        self._pick_size, largest = size_distribution(str(self["size"]))
+        seed = self["seed"]
+        self._random = random.Random(seed if seed != "" else None)
+        self._random_lock = threading.Lock()
+        # Twice as long as the largest file if it can be, so that files of the same size don't all have the same content.
+        length = max(2, min(2 * largest, self.pattern_size))
+        self._data = memoryview(binascii.hexlify(os.urandom(length // 2)))
+
+        super().__init__(max(1, int(self["threads"])))
+        pages = range(self.first - 1, self.last)
+        self.distribute_items(pages, expected_downloads=len(pages))
 
     def progress(self):
         if bool(int(self["progress"])):
-            return self.count, int(self["n"])
+            return self.download_counter, max(0, self.last + 1 - self.first)
 
     @staticmethod
     def can_handle(url):
-        if match("^dummy://.*$", url):
+        if match(URL_PATTERNS[0], url):
             return True
 
         return False
 
-    def downloader(self):
-        while self.count < int(self["n"]):
-            sleep(float(self["length"]))
-            self.count += 1
-            data = hashlib.sha224(bytes([random.randint(0,255) for i in range(24)])).hexdigest()
-            while random.randint(0, 9):
-                data += hashlib.sha224(bytes([random.randint(0,255) for i in range(24)])).hexdigest()
-            
-            if not self.count % 5:
+    def item_filename(self, item):
+        return "{}.txt".format(item + 1)
+
+    def _wait_for_slot(self):
+        if not self._interval:
+            return
+
+        with self._random_lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self._interval
+        if slot > now:
+            time.sleep(slot - now)
+
+    def download_item(self, item):
+        self._wait_for_slot()
+        if self._length:
+            with self.in_flight():
+                time.sleep(self._length)
+
+        with self._random_lock:
+            failed = self._fail and self._random.random() < self._fail
+            size = self._pick_size(self._random)
+            offset = self._random.randrange(max(1, len(self._data) - size + 1))
+        if failed:
+            raise RuntimeError("Injected failure.")
+
+        filename = self.item_filename(item)
+        with trace.span("generate", "cpu"), memory_profile.stage("generate", filename):
+            data = self._cut(offset, size)
+
+        if self._chatter:
+            if not (item + 1) % 5:
                 self.logger.debug("順調に進んでるぞ～")
-            if not self.count % 13:
+            if not (item + 1) % 13:
                 self.logger.error("大変！エラーが発生したよ！\nなんとかしてくれよ～")
-            
-            yield "{}.txt".format(self.count), data.encode()
+
+        self.got_download((filename, data))
+
+    def _cut(self, offset, size):
+        if offset + size <= len(self._data):
+            return self._data[offset:offset + size]
+
+        data = bytearray(size)
+        done = 0
+        while done < size:
+            chunk = self._data[offset:offset + size - done]
+            data[done:done + len(chunk)] = chunk
+            done += len(chunk)
+            offset = 0
+        return memoryview(data)
 
     def finalize(self):
-        if bool(int(self["cleanup"])):
+        path = os.path.join(download_directory(), self.directory())
+        # Nothing to clean up if the files went into an archive or an object store.
+        if bool(int(self["cleanup"])) and os.path.isdir(path):
             from shutil import rmtree
             self.logger.info("Cleaning up dummy files...")
-            rmtree(os.path.join(download_directory(), self.directory()))
+            rmtree(path)
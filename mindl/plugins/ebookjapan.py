@@ -18,6 +18,7 @@
 
 import functools
 import requests
+import logging
 import base64
 import sys
 import re
@@ -34,6 +35,9 @@ from re import match
 from mindl import BasePlugin
 
 __version__ = "0.1"
+# Read by the plugin manager without importing the plugin, so these have to stay string literals.
+URL_PATTERNS = (r"^https?://(?:www.)?ebookjapan.jp/ebj/\d+?/?.+$",
+                r"^https?://br.ebookjapan.jp/br/reader/viewer/view.html\?.+$")
 
 API_LOGIN = "https://api.ebookjapan.jp/ebj/api/EbiService.svc/user/login"
 USER_AGENT = "Mozilla/5.0 (Windows NT 6.3; rv:36.0) Gecko/20100101 Firefox/36.0"
@@ -73,9 +77,7 @@ class ebookjapan(BasePlugin):
 
     @staticmethod
     def can_handle(url):
-        if match(r"^https?://(?:www.)?ebookjapan.jp/ebj/\d+?/?.+$", url):
-            return True
-        elif match(r"^https?://br.ebookjapan.jp/br/reader/viewer/view.html\?.+$", url):
+        if any(match(pattern, url) for pattern in URL_PATTERNS):
             return True
 
         return False
@@ -191,7 +193,9 @@ class ebookjapan(BasePlugin):
             if total_pages == slider_page:
                 break
 
-            self.logger.debug("Ripping page: {}".format(int(current.get_attribute("page")) + 1))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                # Reading the attribute is a round trip to the browser.
+                self.logger.debug("Ripping page: {}".format(int(current.get_attribute("page")) + 1))
             # Remove the "data:image/png;base64," part, then decode it.
             data = base64.b64decode(self.d.execute_script('return arguments[0].toDataURL("image/png");', current)[22:])
             yield "{:04d}.png".format(i + 1), data
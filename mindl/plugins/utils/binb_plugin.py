@@ -16,21 +16,24 @@
 # You should have received a copy of the GNU General Public License
 # along with mindl. If not, see <http://www.gnu.org/licenses/>.
 
-import os.path
+import threading
 import json
 import sys
-import os
+
+from urllib.parse import urlsplit
 
 import mindl.plugins.binb as binbapi
-from mindl import download_directory
+from mindl import open_sink, limits, memory_profile, metrics, trace
+from mindl.manifest import book_identity
 from mindl.plugins.utils.threaded_downloader import ThreadedDownloaderPlugin
 
 # Data we should take from the content info response and pull it into our metadata.
 METADATA = ["Authors", "Publisher", "PublisherRuby", "Title", "TitleRuby", "Categories", "Publisher",
             "PublisherRuby", "Abstract"]
 
-# Number of errors before it gives up if another error were to happen.
-MAX_ERRORS = 20
+# Logged in sessions kept around when keep_sessions is set, keyed by plugin name and username.
+_sessions = {}
+_sessions_lock = threading.Lock()
 
 class BinBPlugin(ThreadedDownloaderPlugin):
     name = "BinBPlugin"
@@ -51,10 +54,31 @@ class BinBPlugin(ThreadedDownloaderPlugin):
         self.metadata = {}
 
         self._cid = cid
+        self._sink = None
+        self._range = None
+
+        # Reuse a session we've already logged in with if we can.
+        session_key = None
+        if login and self.keep_sessions and kwargs.get("requests_session") is None:
+            session_key = (self.name, self["username"] if "username" in self else None)
+            with _sessions_lock:
+                session = _sessions.get(session_key)
+            if session is not None:
+                self.logger.debug("Reusing a logged in session.")
+                kwargs["requests_session"] = session
+                login = False
+
         self.binb = binbapi.BinBApi(bib, self._cid, logger=self.logger, **kwargs)
+        # Sessions can be shared between instances, so make sure the hook is only added once.
+        hooks = self.binb.session.hooks["response"]
+        if metrics.Metric.enabled and metrics.count_response not in hooks:
+            hooks.append(metrics.count_response)
 
         if login:
-            self.login(self.binb.session)
+            # Only keep the session if the plugin tells us the login went through.
+            if self.login(self.binb.session) and session_key is not None:
+                with _sessions_lock:
+                    _sessions[session_key] = self.binb.session
 
         # Extract info into metadata dictionary.
         for md in METADATA:
@@ -71,8 +95,13 @@ class BinBPlugin(ThreadedDownloaderPlugin):
             sys.exit(1)
         
         super().__init__(threads)
-        # Distribute page numbers for the threads.
-        self.distribute_items(range(len(self.binb.pages)), expected_downloads=len(self.binb.pages))
+        # Images are all served from the same place, so failures are budgeted per content server.
+        self._host = urlsplit(self.binb.sbc).netloc
+        # Distribute page numbers in the requested range for the threads.
+        first, last = self._page_range()
+        pages = range(first - 1, last)
+        self.partial = len(pages) != len(self.binb.pages)
+        self.distribute_items(pages, expected_downloads=len(pages))
 
     def login(self):
         raise NotImplementedError("Login method needs to be implemented if login=True.")
@@ -80,10 +109,26 @@ class BinBPlugin(ThreadedDownloaderPlugin):
     def directory(self):
         return self._directory
 
+    def _page_range(self):
+        """The first and last page to download, starting from 1."""
+        # Only parsed once, since progress() asks for it after every page.
+        if self._range is not None:
+            return self._range
+
+        try:
+            first = max(1, int(self["page_start"]))
+            last = len(self.binb.pages) if self["page_end"] == "end" else min(len(self.binb.pages), int(self["page_end"]))
+        except ValueError:
+            self.logger.critical("Unintelligible page range. Please use integers, or 'end' for the last page.")
+            sys.exit(1)
+
+        self._range = first, max(first - 1, last)
+        return self._range
+
     def progress(self):
-        end_page = len(self.binb.pages) if self["page_end"] == "end" else int(self["page_end"])
-        
-        return self.download_counter, int(end_page + 1 - int(self["page_start"]))
+        first, last = self._page_range()
+
+        return self.download_counter, last + 1 - first
 
     def downloader(self):
         # Use above metadata to name our target directory.
@@ -98,65 +143,74 @@ class BinBPlugin(ThreadedDownloaderPlugin):
                 self._directory += " 【{}】".format("×".join(names))
         else:
             self._directory = super().directory()
+        # Parts of the same book can go in the same directory, but not in the same archive.
+        if self.partial and bool(int(self["zip_it"])):
+            self._directory += " (p{}-{})".format(*self._page_range())
 
         dler = super().downloader()
         for dl in dler:
             yield dl
 
+    def sink(self):
+        # Stream the pages straight into the archive instead of zipping them afterwards. If the
+        # download doesn't finish, the next run picks the archive up where this one left off.
+        if self._sink is None:
+            if bool(int(self["zip_it"])):
+                self._sink = open_sink(self.directory(), archive="zip", prefix="content/",
+                    identity=book_identity(self, self.source_url))
+            else:
+                self._sink = open_sink(self.directory())
+
+        return self._sink
+
     def finalize(self):
-        mydir = os.path.join(download_directory(), self.directory())
-
-        if bool(int(self["zip_it"])):
-            from shutil import rmtree
-            self.logger.debug("Zipping files...")
-            items = os.listdir(mydir)
-            from zipfile import ZipFile
-            zipf = ZipFile(mydir + ".zip" , mode="w")
-            for item in items:
-                zipf.write(os.path.join(mydir, item), "content/" + item)
-            if self["additional_zip_content"]:
-                for extra_file in [f.strip() for f in self["additional_zip_content"].split(",")]:
-                    zipf.write(extra_file, os.path.basename(extra_file))
-            if bool(int(self["metadata"])):
-                zipf.writestr("metadata.json", self._serialize_metadata())
-            zipf.close()
-            self.logger.info("Collection zipped to '{}'!".format(mydir + ".zip"))
-            self.logger.info("Deleting directory '{}'...".format(mydir))
-            rmtree(mydir)
-        elif bool(int(self["metadata"])):
-            with open(os.path.join(mydir, "metadata.json"), "w", encoding="utf-8") as f:
-                f.write(self._serialize_metadata())
+        zipped = bool(int(self["zip_it"]))
+        if zipped and self.failed_items:
+            # The DownloadManager leaves it unfinished, since not every page made it.
+            self.logger.warning("Leaving '{}' unfinished, since some pages are missing. Download it again to resume."
+                .format(self._sink.path))
+            return
+
+        if zipped and self["additional_zip_content"]:
+            for extra_file in [f.strip() for f in self["additional_zip_content"].split(",")]:
+                self._sink.add_file(extra_file)
+        if bool(int(self["metadata"])):
+            self._sink.add_data("metadata.json", self._serialize_metadata())
+
+        self._sink.close()
+        if zipped:
+            self.logger.info("Collection zipped to '{}'!".format(self._sink.path))
 
     def _serialize_metadata(self):
         return json.dumps(self.metadata, indent=4, sort_keys=True, ensure_ascii=False)
 
-    def download_many(self, pages):
-        while len(pages):
-            # Check if we need to stop.
-            if self.stop_event.is_set():
-                return
-
-            page = pages[0]
-            try:
-                data = self.binb.get_image(page)
-            except:
-                self.logger.exception("Failed to get an image from the API. Trying again...")
-                data = None
-            
-            if data is None:
-                if self._errors >= MAX_ERRORS:
-                    self.logger.critical("The number of errors has exceeded the maximum allowed. Aborting!")
-                    self.stop_event.set()
-                    return
-                else:
-                    with self._errors_lock:
-                        self._errors += 1
-                    continue
-
-            keywords = {"format":"PNG", "optimize":True} if bool(int(self["lossless"])) else {"format":"JPEG", "quality":95, "optimize":True}
-            data = self.binb.descramble(page, data, **keywords)
-
-            # Add (filename, data) to list for further processing.
-            ext = "jpg" if keywords["format"] == "JPEG" else "png"
-            self.got_download(("{:04d}.{}".format(page + 1, ext), data))
-            pages.pop(0)
+    def _image_format(self):
+        if bool(int(self["lossless"])):
+            return "png", {"format":"PNG", "optimize":True}
+        else:
+            return "jpg", {"format":"JPEG", "quality":95, "optimize":True}
+
+    def item_filename(self, page):
+        ext, keywords = self._image_format()
+        return "{:04d}.{}".format(page + 1, ext)
+
+    def item_host(self, page):
+        return self._host
+
+    def download_item(self, page):
+        filename = self.item_filename(page)
+        with limits.connections, trace.span("get_image", "http"), memory_profile.stage("fetch", filename), \
+                self.in_flight():
+            data = self.binb.get_image(page)
+        received = len(data)
+
+        ext, keywords = self._image_format()
+        with limits.cpu:
+            with metrics.descramble_seconds.time(), trace.span("descramble", "cpu"), \
+                    memory_profile.stage("descramble", filename):
+                image = self.binb.descramble_image(page, data)
+            with metrics.encode_seconds.time(), trace.span("encode", "cpu"), memory_profile.stage("encode", filename):
+                data = self.binb.encode(image, **keywords)
+
+        # Add (filename, data) to list for further processing.
+        self.got_download((filename, data), received=received)
@@ -0,0 +1,154 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import random
+import heapq
+import queue
+import time
+
+# Returned by RetryScheduler.get() once every item has either succeeded or been given up on.
+FINISHED = object()
+
+# Possible return values of RetryScheduler.failed().
+RETRY = 0 # The item was put back on the queue and will be retried later.
+GAVE_UP = 1 # The item ran out of attempts and will not be retried.
+HOST_EXHAUSTED = 2 # The host ran out of its failure budget. The scheduler has been closed.
+
+def backoff_delay(attempts, backoff, max_backoff):
+    """The delay before trying again after 'attempts' failed attempts. Exponential with jitter in the upper half."""
+    delay = min(max_backoff, backoff * 2 ** (attempts - 1))
+    return delay * (0.5 + random.random() / 2)
+
+class RetryScheduler:
+    """
+    A work queue shared by all downloader threads. Instead of having a thread retry
+    a failed item in a tight loop, the item is put back on the queue and becomes
+    available again after an exponential backoff with some jitter, letting the thread
+    move on to other items in the meantime.
+
+    Each item has a limited number of attempts, after which it's given up on. Each host
+    also has a failure budget: the number of failures in a row it's allowed, with no item
+    from it succeeding in between. When exhausted, the scheduler is closed, since at that
+    point it's more likely the host itself is having issues than any single item. Failures
+    that are retried successfully don't add up over a whole download.
+
+    """
+    def __init__(self, items, max_attempts=5, backoff=1.0, max_backoff=30.0, host_budget=20):
+        self.max_attempts = max(1, max_attempts)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.host_budget = host_budget
+        self.failed_items = [] # Items we gave up on.
+
+        self._cond = threading.Condition()
+        self._closed = False
+        self._seq = 0 # Keeps the heap stable for items that become ready at the same time.
+        self._heap = []
+        for item in items:
+            self._push(item, 0)
+        # Number of items that are either queued or being worked on.
+        self._pending = len(self._heap)
+        self._attempts = collections.Counter()
+        # Failures in a row for each host.
+        self._host_errors = collections.Counter()
+
+    def _push(self, item, ready_at):
+        heapq.heappush(self._heap, (ready_at, self._seq, item))
+        self._seq += 1
+
+    def get(self, timeout=None):
+        """
+        Get the next item that is ready to be worked on. Returns FINISHED if there's nothing
+        left to do and raises queue.Empty if nothing became ready within the timeout.
+
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed or not self._pending:
+                    return FINISHED
+
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    return heapq.heappop(self._heap)[2]
+
+                # Either everything left is in flight, or we're waiting on a backoff.
+                wait = None if not self._heap else self._heap[0][0] - now
+                if deadline is not None:
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        raise queue.Empty()
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+    def discard(self, predicate):
+        """Remove every queued item for which predicate(item) is true. Returns the number of items removed."""
+        with self._cond:
+            kept = [entry for entry in self._heap if not predicate(entry[2])]
+            removed = len(self._heap) - len(kept)
+            heapq.heapify(kept)
+            self._heap = kept
+            self._pending -= removed
+            self._cond.notify_all()
+            return removed
+
+    def succeeded(self, item, host=None):
+        with self._cond:
+            self._pending -= 1
+            self._host_errors.pop(host, None)
+            self._cond.notify_all()
+
+    def failed(self, item, host=None):
+        """Report a failed item. Returns RETRY, GAVE_UP or HOST_EXHAUSTED."""
+        with self._cond:
+            self._host_errors[host] += 1
+            if self.host_budget and self._host_errors[host] > self.host_budget:
+                self._closed = True
+                self._cond.notify_all()
+                return HOST_EXHAUSTED
+
+            self._attempts[item] += 1
+            if self._attempts[item] >= self.max_attempts:
+                self._pending -= 1
+                self.failed_items.append(item)
+                self._cond.notify_all()
+                return GAVE_UP
+
+            self._push(item, time.monotonic() + self.retry_delay(item))
+            self._cond.notify_all()
+            return RETRY
+
+    def retry_delay(self, item):
+        """The delay before the next attempt of an item. See backoff_delay()."""
+        return backoff_delay(self._attempts[item], self.backoff, self.max_backoff)
+
+    def attempts(self, item):
+        with self._cond:
+            return self._attempts[item]
+
+    def host_errors(self, host=None):
+        """The number of failures in a row for a host."""
+        with self._cond:
+            return self._host_errors[host]
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
@@ -16,40 +16,120 @@
 # You should have received a copy of the GNU General Public License
 # along with mindl. If not, see <http://www.gnu.org/licenses/>.
 
+import contextlib
 import threading
+import os.path
 import queue
 import time
 
-from mindl import BasePlugin
+from mindl import BasePlugin, download_directory, events, memory_profile, metrics, trace
+from mindl.manifest import Manifest, book_identity
+from mindl.plugins.utils import retry_scheduler
+from mindl.transfer_stats import TransferStats
 
 class ThreadedDownloaderPlugin(BasePlugin):
+    # Number of times an item is attempted before giving up on it.
+    max_attempts = 5
+    # Base and maximum delay in seconds before a failed item is retried.
+    retry_backoff = 1.0
+    retry_backoff_max = 30.0
+    # Number of failures in a row a single host is allowed before we give up on the whole download.
+    host_error_budget = 20
+    # Pass the number of bytes actually received to got_download() if it isn't the size of the file.
+    reports_received = True
+    # Seconds a thread can spend on a single request (see in_flight()) before it's considered stalled and the item is
+    # given to another thread, which counts as a failed attempt. Only applies to distributed items. 0 to wait forever.
+    stall_timeout = 120.0
+    # Number of fetched files that can wait for the DownloadManager before threads hold off on fetching more.
+    max_fetched = 64
+
     def __init__(self, thread_count=10):
         self._thread_count = thread_count
         self._threads = []
         self.stop_event = threading.Event()
-        # It should be safe to use a list here, but just in case we'll use Queue.
-        self._downloads = queue.Queue()
+        # Bounded, so that memory usage doesn't depend on how far ahead of storage fetching gets.
+        self._downloads = queue.Queue(maxsize=max(1, self.max_fetched))
         self.download_counter = 0
-        self._errors = 0 # Number of errors while downloading files.
-        self._errors_lock = threading.Lock()
-        self._thread_items = None
+        self._expected = -1
+        self._scheduler = None
+        self._items_by_filename = {}
+        self._resumed = 0
+        # Replaced by the DownloadManager's, but lets the plugin run without one.
+        self.stats = TransferStats()
+        # When each thread started on its current item, and how long each file took to fetch. Only kept when sending events.
+        self._fetching = threading.local()
+        self._fetch_times = {}
+        # The item each thread is working on, until it's handed over, and since when its request has been in flight
+        # (None if it isn't). Used to spot stalled threads.
+        self._active = {}
+        # Threads whose items were given to others. Whatever they eventually get is thrown away.
+        self._abandoned = set()
+        self._active_lock = threading.Lock()
+
+    def got_download(self, item, received=None):
+        """Hand over a (filename, data) tuple. 'received' is how many bytes it took to get, if not len(data)."""
+        self.stats.received(len(item[1]) if received is None else received)
+        started = getattr(self._fetching, "started", None)
+        if started is not None:
+            self._fetch_times[item[0]] = time.monotonic() - started
+        with self._active_lock:
+            thread = threading.current_thread()
+            if thread in self._abandoned:
+                # Another thread has been given this item since.
+                return
+            self._active.pop(thread, None)
+
+        metrics.fetched_queue.inc()
+        memory_profile.held("fetched pages", len(item[1]))
+        # Wait for the DownloadManager to catch up, unless the download is being stopped.
+        while not self.stop_event.is_set():
+            try:
+                self._downloads.put(item, timeout=0.25)
+                return
+            except queue.Full:
+                continue
+        metrics.fetched_queue.dec()
+        memory_profile.held("fetched pages", -len(item[1]))
+
+    @contextlib.contextmanager
+    def in_flight(self):
+        """
+        Wrap what download_item() does that can stall, i.e. the request itself, once it's been
+        given whatever limits.connections slot it needs. Only time spent in here counts towards
+        stall_timeout, so that threads waiting their turn aren't taken for stalled ones.
+
+        """
+        thread = threading.current_thread()
+        self._set_in_flight(thread, time.monotonic())
+        try:
+            yield
+        finally:
+            self._set_in_flight(thread, None)
 
-    def got_download(self, item):
-        self._downloads.put(item)
+    def _set_in_flight(self, thread, since):
+        with self._active_lock:
+            if thread in self._active:
+                self._active[thread] = (self._active[thread][0], since)
+
+    def fetch_time(self, filename):
+        return self._fetch_times.pop(filename, None)
 
     def downloader(self):
-        # Start all the threads and start downloading immediately.
+        # Skip whatever a previous run already downloaded, then start all the threads and start downloading immediately.
+        self._skip_completed()
         self._start_threads()
         
         try:
             while not self._done():
+                self._check_stalled()
                 # Try until we either get a download or threads are dead.
                 try:
-                    filename, data = self._downloads.get(timeout=0.25)
+                    with trace.span("wait for page", "wait"):
+                        filename, data = self._downloads.get(timeout=0.25)
                 except queue.Empty:
                     if not self._are_threads_alive():
                         # Threads are all dead. Assert we have all downloads we should have.
-                        if self._expected != -1 and self.download_counter != self._expected:
+                        if self._expected != -1 and self.download_counter != self._expected - len(self.failed_items):
                             raise RuntimeError("All downloader threads are dead, but not all downloads have finished.")
                         # Otherwise we're just fine.
                         break
@@ -57,37 +137,209 @@ class ThreadedDownloaderPlugin(BasePlugin):
                         continue
 
                 self.download_counter += 1
+                metrics.fetched_queue.dec()
+                memory_profile.held("fetched pages", -len(data))
                 yield filename, data
+
+            if self.failed_items:
+                self.logger.error("Gave up on {} item(s) after {} attempts each: {}".format(len(self.failed_items),
+                    self.max_attempts, ", ".join(str(item) for item in self.failed_items)))
         except KeyboardInterrupt:
             self.logger.info("Download interrupted! Please wait for threads to stop...")
             self.stop_event.set()
+            if self._scheduler is not None:
+                self._scheduler.close()
             while self._are_threads_alive():
                 time.sleep(0.1)
+        finally:
+            # Nobody's taking files anymore, e.g. because storing one failed, so don't leave threads waiting to hand theirs over.
+            self.stop_event.set()
+
+    def cancel(self):
+        self.stop_event.set()
+        if self._scheduler is not None:
+            self._scheduler.close()
+
+    @property
+    def failed_items(self):
+        if self._scheduler is None:
+            return []
 
-    def download_many(self, items):
-        """The thread target that will download many files and put results in our queue using got_download()."""
+        return self._scheduler.failed_items
+
+    def download_many(self):
+        """
+        The thread target that will download many files and put results in our queue using got_download().
+        Only used if no items were distributed, otherwise download_item() is used instead.
+
+        """
+        raise NotImplementedError("The downloader itself needs to be implemented.")
+
+    def download_item(self, item):
+        """
+        Download a single distributed item and put the result in our queue using got_download().
+        Raise an exception on failure and the item will be retried later.
+
+        """
         raise NotImplementedError("The downloader itself needs to be implemented.")
 
+    def item_filename(self, item):
+        """
+        The filename an item will be saved as, if it can be known before downloading it.
+        Items whose files were completely written by a previous run are skipped.
+
+        """
+        return None
+
+    def item_host(self, item):
+        """The host an item is downloaded from. Each host has its own budget of failures in a row."""
+        return None
+
     def distribute_items(self, items, expected_downloads=-1):
+        """Put items on a queue shared by all threads. Failed items are put back on it to be retried."""
         self._expected = expected_downloads
-        split_items = [[] for i in range(self._thread_count)]
-        for i, item in enumerate(items):
-            split_items[i % self._thread_count].append(item)
+        self._scheduler = retry_scheduler.RetryScheduler(items, max_attempts=self.max_attempts,
+            backoff=self.retry_backoff, max_backoff=self.retry_backoff_max, host_budget=self.host_error_budget)
+
+    def resumed(self):
+        return self._resumed
+
+    def file_index(self, filename):
+        return self._items_by_filename.get(filename)
 
-        self._thread_items = split_items
+    def _skip_completed(self):
+        if self._scheduler is None:
+            return
+
+        # The directory is only known once the plugin has started downloading, so we can't do this any earlier.
+        if self.resume_check is not None:
+            stored = self.resume_check()
+        else:
+            # Without a DownloadManager, ask our own sink, or the manifest in our directory if files go there.
+            sink = self.sink()
+            if sink is not None and not sink.resumable:
+                stored = sink.stored().__contains__
+            else:
+                manifest = Manifest.open(os.path.join(download_directory(), self.directory()),
+                    book_identity(self, self.source_url))
+                stored = manifest.is_complete if len(manifest) else None
+
+        def is_complete(item):
+            filename = self.item_filename(item)
+            if filename is None:
+                return False
+            self._items_by_filename[filename] = item
+            return stored is not None and stored(filename)
+
+        self._resumed = self._scheduler.discard(is_complete)
+        # Count them as downloaded so that progress and the expected number of downloads still add up.
+        self.download_counter += self._resumed
+        if self._resumed:
+            self.logger.info("Resuming download. Skipping {} file(s) that were already downloaded.".format(self._resumed))
+
+    def _download_scheduled(self):
+        """The thread target used when items have been distributed."""
+        scheduler = self._scheduler
+        while not self.stop_event.is_set():
+            try:
+                item = scheduler.get(timeout=0.25)
+            except queue.Empty:
+                continue
+
+            if item is retry_scheduler.FINISHED:
+                return
+
+            if events.enabled():
+                self._fetching.started = time.monotonic()
+            thread = threading.current_thread()
+            with self._active_lock:
+                self._active[thread] = (item, None)
+            try:
+                with self.stats.request(), metrics.fetch_seconds.time(), trace.tagged(item=item), \
+                        trace.span("download item", "download"):
+                    self.download_item(item)
+            except Exception as e:
+                if self._finish_item(thread) and not self._failed(item, e):
+                    return
+            else:
+                if self._finish_item(thread):
+                    scheduler.succeeded(item, self.item_host(item))
+
+            if thread in self._abandoned:
+                # A new thread has taken our place.
+                with self._active_lock:
+                    self._abandoned.discard(thread)
+                return
+
+    def _finish_item(self, thread):
+        """Whether the item 'thread' was working on is still its own to report on."""
+        with self._active_lock:
+            self._active.pop(thread, None)
+            return thread not in self._abandoned
+
+    def _failed(self, item, error):
+        """Report a failed attempt at an item. Returns False if the whole download has to stop."""
+        scheduler = self._scheduler
+        host = self.item_host(item)
+        state = scheduler.failed(item, host)
+        if state == retry_scheduler.HOST_EXHAUSTED:
+            self.logger.critical("Host '{}' has failed more than {} times in a row. Aborting!"
+                .format(host, self.host_error_budget))
+            self.stop_event.set()
+            return False
+        elif state == retry_scheduler.GAVE_UP:
+            self.logger.error("Failed to download item {}. Giving up after {} attempts: {}"
+                .format(item, self.max_attempts, error))
+            metrics.retries.inc(labels=("gave_up",))
+            events.emit("gave_up", url=self.source_url, item=str(item), error=str(error))
+        else:
+            self.logger.warning("Failed to download item {} (attempt {}/{}). Retrying later: {}"
+                .format(item, scheduler.attempts(item), self.max_attempts, error))
+            metrics.retries.inc(labels=("retried",))
+            events.emit("retry", url=self.source_url, item=str(item), attempt=scheduler.attempts(item),
+                max_attempts=self.max_attempts, error=str(error))
+        return True
+
+    def _check_stalled(self):
+        """
+        Give the items of threads that have been stuck on them for longer than stall_timeout
+        to new threads. Threads can't be killed, so the stalled ones are left to time out on
+        their own, and whatever they get after that is thrown away.
+
+        """
+        if not self.stall_timeout or self._scheduler is None:
+            return
+
+        now = time.monotonic()
+        with self._active_lock:
+            stalled = [(thread, item, now - started) for thread, (item, started) in self._active.items()
+                if started is not None and now - started > self.stall_timeout]
+            for thread, item, elapsed in stalled:
+                del self._active[thread]
+                self._abandoned.add(thread)
+
+        for thread, item, elapsed in stalled:
+            host = self.item_host(item)
+            self.logger.warning("Thread '{}' has made no progress on item {} from host '{}' in {:.0f} seconds. "
+                "Giving it to another thread.".format(thread.name, item, host, elapsed))
+            events.emit("stalled", url=self.source_url, item=str(item), host=host, thread=thread.name,
+                seconds=round(elapsed, 1))
+            if not self._failed(item, "Stalled for {:.0f} seconds.".format(elapsed)):
+                return
+            self._start_thread(self._download_scheduled)
 
     def _start_threads(self):
-        """Distribute items to threads as equally as possible, then start threads."""
-        # Start threads.
+        """Start the threads, which will either pull distributed items from the queue or run download_many()."""
+        target = self.download_many if self._scheduler is None else self._download_scheduled
         for i in range(self._thread_count):
-            if self._thread_items is None:
-                args = ()
-            else:
-                args = (self._thread_items[i],)
-            self._threads.append(threading.Thread(target=self.download_many, args=args))
-            self._threads[i].start()
+            self._start_thread(target)
             time.sleep(0.1)
 
+    def _start_thread(self, target):
+        thread = threading.Thread(target=target, name="{}-{}".format(self.name, len(self._threads)))
+        self._threads.append(thread)
+        thread.start()
+
     def _done(self):
         if self._expected == -1:
             # expected_downloads not set, so we're not done until threads die.
@@ -95,11 +347,12 @@ class ThreadedDownloaderPlugin(BasePlugin):
         elif self.download_counter > self._expected:
             raise RuntimeError("Got more downloads than expected.")
         else:
-            return self.download_counter == self._expected
+            return self.download_counter == self._expected - len(self.failed_items)
 
     def _are_threads_alive(self):
+        # Stalled threads can stay stuck for a while, but have already been replaced.
         for thread in self._threads:
-            if thread.is_alive():
+            if thread.is_alive() and thread not in self._abandoned:
                 return True
 
         return False
@@ -1,4 +1,8 @@
+import contextlib
+import threading
 import logging
+import signal
+import time
 import sys
 
 from shutil import get_terminal_size
@@ -21,58 +25,174 @@ class StdoutStreamHandler(logging.StreamHandler):
         self.stream = sys.stdout
         super().emit(record)
 
+# The terminal's width, cached since looking it up on every update adds up. It's refreshed
+# whenever the terminal is resized, or every now and then if we can't tell when that happens.
+_columns = None
+_columns_checked = 0
+_resize_watched = False
+
+def _on_resize(signum, frame, previous=None):
+    global _columns
+    _columns = None
+    if callable(previous):
+        previous(signum, frame)
+
+def watch_resize():
+    """
+    Refresh the cached terminal width whenever the terminal is resized. Signal handlers can
+    only be set from the main thread, so this does nothing when called from any other.
+
+    """
+    global _resize_watched
+    if _resize_watched or not hasattr(signal, "SIGWINCH") or threading.current_thread() is not threading.main_thread():
+        return
+
+    previous = signal.getsignal(signal.SIGWINCH)
+    signal.signal(signal.SIGWINCH, lambda signum, frame: _on_resize(signum, frame, previous))
+    _resize_watched = True
+
+def terminal_columns():
+    global _columns, _columns_checked
+    if _columns is None or (not _resize_watched and time.monotonic() - _columns_checked > 1.0):
+        _columns = get_terminal_size().columns
+        _columns_checked = time.monotonic()
+
+    return _columns
+
 class LineReservePrinter:
     """
     Can be used with the 'with' keyword. It hooks stdout and "reserves" the last line
     to whatever it wants by doing some trickery with a carriage return.
 
+    Setting 'line' and calling flush() doesn't draw anything by itself. Instead, the line is
+    redrawn by a thread of its own at most 'fps' times per second, so that whoever updates it
+    doesn't have to wait on the terminal. If the output isn't a terminal, the line is printed
+    on its own every 'summary_interval' seconds instead, if it changed since last time.
+
+    Ask for input inside 'with printer.paused():', or the line is drawn over the prompt.
+
     """
+    fps = 10
+    summary_interval = 10.0
+
     def __init__(self, file):
-        self.line = ""
+        self._line = ""
         self._file = file
+        self._tty = hasattr(file, "isatty") and file.isatty()
+        # Several threads might be logging and updating the line at once.
+        self._lock = threading.RLock()
+        self._dirty = False
+        # Length of the line currently on the screen, so it can be cleared.
+        self._shown = 0
+        self._stop = threading.Event()
+        self._ticker = None
+        self._paused = False
         self._save_stderr = None
         self._save_stdout = None
 
+    @property
+    def line(self):
+        return self._line
+
+    @line.setter
+    def line(self, line):
+        self._line = line
+        self._dirty = True
+
     def __enter__(self):
+        if self._tty:
+            watch_resize()
         self._save_stderr = sys.stderr
         self._save_stdout = sys.stdout
         sys.stdout = self
         sys.stderr = self
+        self._ticker = threading.Thread(target=self._tick, name="progress", daemon=True)
+        self._ticker.start()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stop.set()
+        self._ticker.join()
         self._done()
         sys.stderr = self._save_stderr
         sys.stdout = self._save_stdout
 
     def write(self, data):
-        if not data.rstrip("\n"):
-            return
-        
+        with self._lock:
+            if self._paused:
+                # Likely an input() prompt, which has to stay on the same line as the answer.
+                self._file.write(data)
+                self._file.flush()
+                return
+
+            if data.rstrip("\n"):
+                self._write(data)
+
+    def _write(self, data):
         f = self._file
-        cols = get_terminal_size().columns
-        # Clear the last line.
-        f.write("\r" + " " * (cols-1))
-        f.flush()
-        # Return and write the data.
-        out = "\r" + data
-        if not out.endswith("\n"):
-            out += "\n"
-        f.write(out)
-        
-        # Write our string.
-        f.write(self.line + "\r")
+        if not data.endswith("\n"):
+            data += "\n"
+        if self._tty:
+            # Clear the last line, then write the data. The line is drawn again on the next tick.
+            f.write("\r" + " " * self._shown + "\r" + data)
+            self._shown = 0
+            self._dirty = True
+        else:
+            f.write(data)
         f.flush()
 
     def flush(self):
-        cols = get_terminal_size().columns
-        self._file.write("\r" + " " * (cols-1) + "\r" + self.line + "\r")
-        self._file.flush()
+        # Drawing happens on the next tick. Summaries are only printed if the line changed.
+        if self._tty:
+            self._dirty = True
+
+    def _tick(self):
+        interval = 1 / max(0.1, self.fps) if self._tty else self.summary_interval
+        while not self._stop.wait(interval):
+            self._render()
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Clear the line and stop drawing it until the block is done. Writes are passed through as they are."""
+        with self._lock:
+            self._clear()
+            self._paused = True
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._paused = False
+                self._dirty = True
+
+    def _render(self):
+        with self._lock:
+            if not self._dirty or self._paused:
+                return
+            self._dirty = False
+
+            f = self._file
+            if self._tty:
+                # Anything wider than the terminal would wrap and leave a mess.
+                line = self._line[:terminal_columns() - 1]
+                f.write("\r" + line + " " * max(0, self._shown - len(line)) + "\r")
+                self._shown = len(line)
+            elif self._line.strip():
+                f.write(self._line.strip() + "\n")
+            f.flush()
+
+    def _clear(self):
+        if self._tty and self._shown:
+            self._file.write("\r" + " " * self._shown + "\r")
+            self._shown = 0
+            self._file.flush()
 
     def _done(self):
-        f = self._file
-        f.write("\r" + " " * (get_terminal_size().columns-1) + "\r")
-        f.flush()
+        with self._lock:
+            if self._tty:
+                self._clear()
+            else:
+                # Print the final state of the line if it hasn't been already.
+                self._render()
 
 UNKNOWN_TOTAL = -1
 
@@ -97,6 +217,14 @@ class ProgressBar:
         self._units = units
         self._singular = singular
 
+    @property
+    def current(self):
+        return self._current
+
+    @property
+    def total(self):
+        return self._total
+
     def update(self, amount):
         if self._total == UNKNOWN_TOTAL:
             self._current = max(0, self._current + amount)
@@ -137,7 +265,7 @@ class ProgressBar:
     def _bar(self):
         ratio = self._current / self._total
         if not self._width:
-            width = round(get_terminal_size().columns / 4)
+            width = round(terminal_columns() / 4)
         else:
             width = self._width
         fulls = round(ratio * width)
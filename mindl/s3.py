@@ -0,0 +1,324 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import xml.etree.ElementTree as ET
+import concurrent.futures
+import threading
+import requests
+import hashlib
+import logging
+import queue
+import hmac
+import time
+import os
+
+from urllib.parse import quote, urlsplit
+
+from .plugins.utils.retry_scheduler import backoff_delay
+from .sinks import StorageSink
+from .writer_pool import WriteResult
+
+"""
+A minimal client for S3-compatible object stores, along with a sink that uploads
+downloaded files as objects and a file-like object that streams into a multipart
+upload, which can be used with archive sinks.
+
+Requests are signed with AWS Signature Version 4 if credentials are available, and
+use path-style URLs (i.e. endpoint/bucket/key) so that it works with self-hosted
+stores and local stand-ins as well. All requests go through a single session with a
+connection pool large enough for every concurrent upload, so connections are reused.
+Requests that time out or fail in a way that might not happen again are retried, with
+the same backoff downloads get.
+
+"""
+
+# Parts can't be smaller than this, except for the last one.
+MIN_PART_SIZE = 5 * 1024 * 1024
+EMPTY_SHA256 = hashlib.sha256(b"").hexdigest()
+
+class S3Error(Exception):
+    """Raised when the object store responds with an error. 'status' is the status code."""
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+    @property
+    def retriable(self):
+        return self.status is not None and (self.status >= 500 or self.status in (408, 429))
+
+class S3Client:
+    # Seconds to wait for a connection, and then for the store to send anything at all, before a request fails.
+    connect_timeout = 10
+    read_timeout = 60
+    # Number of times a request is attempted, and the base and maximum delay in seconds between attempts.
+    max_attempts = 5
+    retry_backoff = 1.0
+    retry_backoff_max = 30.0
+
+    def __init__(self, endpoint, bucket, access_key=None, secret_key=None, region=None, concurrency=8, jobs=1):
+        """Up to 'jobs' downloads share the client, each uploading up to 'concurrency' files or parts at once."""
+        self.logger = logging.getLogger("mindl")
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key if access_key is not None else os.environ.get("AWS_ACCESS_KEY_ID")
+        self.secret_key = secret_key if secret_key is not None else os.environ.get("AWS_SECRET_ACCESS_KEY")
+        self.region = region or os.environ.get("AWS_DEFAULT_REGION", "us-east-1")
+        self.concurrency = concurrency
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(1, concurrency * max(1, jobs)))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    @classmethod
+    def from_url(cls, url, endpoint=None, **kwargs):
+        """
+        Create a client from an 's3://bucket/prefix' URL. Returns the client and the prefix.
+        The endpoint defaults to the AWS_ENDPOINT_URL environment variable, then AWS itself.
+
+        """
+        parts = urlsplit(url)
+        if parts.scheme != "s3" or not parts.netloc:
+            raise ValueError("Object store URLs should look like 's3://bucket/prefix'.")
+
+        endpoint = endpoint or os.environ.get("AWS_ENDPOINT_URL") or "https://s3.amazonaws.com"
+        return cls(endpoint, parts.netloc, **kwargs), parts.path.strip("/")
+
+    def url(self, key):
+        return "{}/{}/{}".format(self.endpoint, quote(self.bucket), quote(key, safe="/~"))
+
+    def request(self, method, key, params=None, data=b"", headers=None):
+        query = "&".join("{}={}".format(quote(k, safe="-_.~"), quote(str(v), safe="-_.~"))
+            for k, v in sorted((params or {}).items()))
+        url = self.url(key) + ("?" + query if query else "")
+        payload_hash = hashlib.sha256(data).hexdigest() if data else EMPTY_SHA256
+
+        attempts = max(1, self.max_attempts)
+        for attempt in range(1, attempts + 1):
+            # Signatures expire, so every attempt gets its own.
+            attempt_headers = dict(headers or {})
+            if self.access_key and self.secret_key:
+                self._sign(method, url, query, attempt_headers, payload_hash)
+            try:
+                r = self.session.request(method, url, data=data, headers=attempt_headers,
+                    timeout=(self.connect_timeout, self.read_timeout))
+                if r.status_code >= 300:
+                    raise S3Error("{} {} failed with status code {}: {}".format(method, url, r.status_code,
+                        r.text[:200]), r.status_code)
+            except (requests.ConnectionError, requests.Timeout, S3Error) as e:
+                if (isinstance(e, S3Error) and not e.retriable) or attempt == attempts:
+                    raise
+                delay = backoff_delay(attempt, self.retry_backoff, self.retry_backoff_max)
+                self.logger.warning("{} {} failed (attempt {}/{}). Retrying in {:.1f} seconds: {}".format(method,
+                    url, attempt, attempts, delay, e))
+                time.sleep(delay)
+            else:
+                return r
+
+    def _sign(self, method, url, query, headers, payload_hash):
+        parts = urlsplit(url)
+        amz_date = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        date = amz_date[:8]
+        headers["Host"] = parts.netloc
+        headers["X-Amz-Date"] = amz_date
+        headers["X-Amz-Content-Sha256"] = payload_hash
+
+        names = sorted(k.lower() for k in headers)
+        lowered = {k.lower(): str(v).strip() for k, v in headers.items()}
+        canonical_headers = "".join("{}:{}\n".format(name, lowered[name]) for name in names)
+        signed_headers = ";".join(names)
+        canonical_request = "\n".join((method, parts.path or "/", query, canonical_headers,
+            signed_headers, payload_hash))
+
+        scope = "{}/{}/s3/aws4_request".format(date, self.region)
+        string_to_sign = "\n".join(("AWS4-HMAC-SHA256", amz_date, scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest()))
+
+        key = ("AWS4" + self.secret_key).encode()
+        for part in (date, self.region, "s3", "aws4_request"):
+            key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+        signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+        headers["Authorization"] = "AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}".format(
+            self.access_key, scope, signed_headers, signature)
+
+    def put_object(self, key, data):
+        return self.request("PUT", key, data=data)
+
+    def create_multipart_upload(self, key):
+        r = self.request("POST", key, params={"uploads": ""})
+        return self._find(r.text, "UploadId")
+
+    def upload_part(self, key, upload_id, number, data):
+        r = self.request("PUT", key, params={"partNumber": number, "uploadId": upload_id}, data=data)
+        return r.headers.get("ETag", "")
+
+    def complete_multipart_upload(self, key, upload_id, etags):
+        body = "<CompleteMultipartUpload>{}</CompleteMultipartUpload>".format("".join(
+            "<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>".format(number, etag)
+            for number, etag in sorted(etags.items())))
+        self.request("POST", key, params={"uploadId": upload_id}, data=body.encode())
+
+    def abort_multipart_upload(self, key, upload_id):
+        self.request("DELETE", key, params={"uploadId": upload_id})
+
+    @staticmethod
+    def _find(text, tag):
+        # Ignore namespaces, since not every implementation uses the same one.
+        for elem in ET.fromstring(text).iter():
+            if elem.tag.rsplit("}", 1)[-1] == tag:
+                return elem.text
+
+        raise S3Error("Missing '{}' in the response.".format(tag))
+
+class MultipartUpload:
+    """
+    A write-only file-like object that uploads whatever is written to it as a multipart
+    upload. Parts are uploaded concurrently in the background as soon as they're full,
+    with at most 'concurrency' parts in memory at any given time.
+
+    """
+    def __init__(self, client, key, part_size=8 * 1024 * 1024, concurrency=4):
+        self.client = client
+        self.key = key
+        self._part_size = max(MIN_PART_SIZE, part_size)
+        self._buffer = bytearray()
+        self._etags = {}
+        self._futures = []
+        self._slots = threading.BoundedSemaphore(max(1, concurrency))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency))
+        self._upload_id = client.create_multipart_upload(key)
+        self._closed = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self._part_size:
+            self._upload(bytes(self._buffer[:self._part_size]))
+            del self._buffer[:self._part_size]
+
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload(self, data):
+        # Blocks if too many parts are already being uploaded, to keep memory usage in check.
+        self._slots.acquire()
+        number = len(self._futures) + 1
+
+        def upload():
+            try:
+                self._etags[number] = self.client.upload_part(self.key, self._upload_id, number, data)
+            finally:
+                self._slots.release()
+
+        self._futures.append(self._executor.submit(upload))
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+
+        try:
+            # The last part is allowed to be smaller than the minimum, and there's always at least one part.
+            if self._buffer or not self._futures:
+                self._upload(bytes(self._buffer))
+                self._buffer = bytearray()
+            for future in self._futures:
+                future.result()
+            self.client.complete_multipart_upload(self.key, self._upload_id, self._etags)
+        except:
+            self.client.abort_multipart_upload(self.key, self._upload_id)
+            raise
+        finally:
+            self._executor.shutdown()
+
+class S3Sink(StorageSink):
+    """
+    Uploads every file as its own object, keyed by its directory relative to 'base'.
+    Uploads happen concurrently over the client's shared connections.
+
+    """
+    def __init__(self, client, prefix, base, directory):
+        self.logger = logging.getLogger("mindl")
+        self.client = client
+        self._prefix = prefix
+        self._base = base
+        self.path = directory
+        self._completed = queue.Queue()
+        self._pending = 0
+        self._cond = threading.Condition()
+        self._slots = threading.BoundedSemaphore(max(1, client.concurrency))
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, client.concurrency))
+
+    def key(self, directory, filename):
+        relative = os.path.relpath(directory, self._base).replace(os.sep, "/")
+        parts = [p for p in (self._prefix, relative if relative != "." else "", filename) if p]
+        return "/".join(parts)
+
+    def submit(self, directory, filename, data):
+        self._upload(directory, filename, data, True)
+
+    def add_data(self, name, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._upload(self.path, name, data, False)
+
+    def _upload(self, directory, filename, data, report):
+        self._slots.acquire()
+        with self._cond:
+            self._pending += 1
+
+        def upload():
+            try:
+                self.client.put_object(self.key(directory, filename), data)
+            except Exception as e:
+                if report:
+                    self._completed.put(WriteResult(directory, filename, len(data), None, e))
+                else:
+                    self.logger.error("Failed to upload '{}': {}".format(filename, e))
+            else:
+                if report:
+                    self._completed.put(WriteResult(directory, filename, len(data),
+                        hashlib.sha1(data).hexdigest(), None))
+            finally:
+                self._slots.release()
+                with self._cond:
+                    self._pending -= 1
+                    self._cond.notify_all()
+
+        self._executor.submit(upload)
+
+    def completed(self):
+        while True:
+            try:
+                yield self._completed.get_nowait()
+            except queue.Empty:
+                return
+
+    def flush(self):
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown()
@@ -0,0 +1,293 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import concurrent.futures
+import collections
+import contextlib
+import threading
+import logging
+import queue
+import sys
+
+from . import events, metrics, trace
+from .download_manager import DownloadCancelled, DownloadManager
+from .library import Library
+from .progress_bar import LineReservePrinter
+from .transfer_stats import TransferStats
+
+class BookStatus:
+    """Receives updates about a single download. Pass one to BookScheduler.submit() to follow it."""
+    def started(self, dm):
+        pass
+
+    def progress(self, dm):
+        pass
+
+    def finished(self, dm, error=None):
+        """Called when the download is over. 'dm' is None if the plugin couldn't even be created."""
+        pass
+
+class BookScheduler:
+    """
+    Runs downloads for several URLs, each with its own DownloadManager. With more than one
+    job (or if 'threaded' is True), downloads run on their own threads, sharing a single
+    progress line that combines all of them. With a single job, downloads run one after
+    the other on the calling thread, just like they would on their own.
+
+    Creating a plugin instance usually means logging in and getting the list of pages
+    before a single file is downloaded. To keep that off the critical path, up to 'prefetch'
+    plugin instances are created in the background ahead of time, while earlier downloads
+    are still running. When running a single job, a download only waits for the ones after
+    it to be submitted (so they can be prefetched) until run_pending() is called, which the
+    caller should do whenever it has nothing else to submit right away.
+
+    Use it with the 'with' keyword, which waits for every submitted download to finish. If
+    the block raises (e.g. on Ctrl-C), downloads that haven't started are dropped and the
+    running ones cancelled instead. Either way, a download failing is logged rather than
+    raised, so that it doesn't take the others with it.
+
+    """
+    def __init__(self, jobs=1, prefetch=0, threaded=None):
+        self.jobs = max(1, jobs)
+        self.prefetch = max(0, prefetch)
+        self._threaded = self.jobs > 1 if threaded is None else threaded
+        self.logger = logging.getLogger("mindl")
+        self._queue = queue.Queue(maxsize=max(1, self.prefetch))
+        # Downloads waiting their turn when running a single job. Each is (book, url).
+        self._pending = collections.deque()
+        self._prefetcher = None
+        if self.prefetch:
+            self._prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=self.prefetch)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._active = []
+        self._statuses = {}
+        self._submitted = 0
+        self._finished = 0
+        self._failed = 0
+        self._dropped = 0 # Downloads cancelled before they started.
+        self._files = 0 # Files stored by finished downloads.
+        self._printer = None
+        self._cancelling = False
+
+    @property
+    def parallel(self):
+        return self._threaded
+
+    @property
+    def failed(self):
+        """The number of downloads that failed or were cancelled."""
+        with self._lock:
+            return self._failed + self._dropped
+
+    def __enter__(self):
+        if self.parallel:
+            self._printer = LineReservePrinter(sys.stdout).__enter__()
+            for i in range(self.jobs):
+                thread = threading.Thread(target=self._worker, name="book-{}".format(i), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.cancel()
+        elif not self.parallel:
+            self.run_pending()
+
+        if self._prefetcher is not None:
+            self._prefetcher.shutdown(wait=exc_type is None)
+
+        if self.parallel:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+            self._printer.__exit__(exc_type, exc_val, exc_tb)
+        if self.parallel or self._submitted > 1:
+            self.logger.info("Finished {} of {} downloads with a total of {} files.{}{}".format(
+                self._finished - self._failed, self._submitted, self._files,
+                " {} failed.".format(self._failed) if self._failed else "",
+                " {} were cancelled before they started.".format(self._dropped) if self._dropped else ""))
+
+    def prompting(self):
+        """Returns a context to ask for input in, so the progress line isn't drawn over the prompt."""
+        return self._printer.paused() if self._printer is not None else contextlib.nullcontext()
+
+    def submit(self, plugin_class, url, status=None):
+        """Download 'url' with an instance of 'plugin_class'. Blocks while every job is busy."""
+        self._submitted += 1
+        # Either a future of the plugin instance being created in the background, or something to create it later.
+        if self._prefetcher is not None:
+            book = self._prefetcher.submit(plugin_class, url)
+        else:
+            book = lambda: plugin_class(url)
+
+        if self.parallel:
+            self._queue.put((book, url, status))
+        else:
+            self._pending.append((book, url, status))
+            while len(self._pending) > self.prefetch:
+                self._run_logged(*self._pending.popleft())
+
+    def run_pending(self):
+        """Start every download that's waiting its turn, rather than waiting for more to be submitted first."""
+        while self._pending:
+            self._run_logged(*self._pending.popleft())
+
+    def cancel(self):
+        """Drop every download that hasn't started yet and cancel the running ones. Called from any thread."""
+        with self._lock:
+            self._cancelling = True
+            active = list(self._active)
+        self.drop_pending()
+        if active:
+            self.logger.info("Cancelling {} running downloads...".format(len(active)))
+        for dm in active:
+            dm.cancel()
+
+    def drop_pending(self):
+        """
+        Cancel every download that hasn't started yet, e.g. when shutting down. Each one's
+        BookStatus is told it finished with DownloadCancelled. Returns how many were dropped.
+
+        """
+        dropped = list(self._pending)
+        self._pending.clear()
+        while True:
+            try:
+                dropped.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        for book, url, status in dropped:
+            if isinstance(book, concurrent.futures.Future):
+                book.cancel()
+            if status is not None:
+                status.finished(None, DownloadCancelled("The download was cancelled before it started."))
+        with self._lock:
+            self._dropped += len(dropped)
+        return len(dropped)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+
+            self._run_logged(*job)
+
+    def _run_logged(self, book, url, status=None):
+        try:
+            self._run(book, url, status)
+        except DownloadCancelled:
+            self.logger.info("The download of '{}' was cancelled.".format(url))
+            with self._lock:
+                self._failed += 1
+        except (Exception, SystemExit):
+            # Plugins exit when they can't go on, but that shouldn't take the other downloads with it.
+            self.logger.exception("The download of '{}' failed.".format(url))
+            with self._lock:
+                self._failed += 1
+
+    def _run(self, book, url, status=None):
+        status = status or BookStatus()
+        try:
+            with trace.span("open book", "book", url=url):
+                plugin = book.result() if isinstance(book, concurrent.futures.Future) else book()
+        except BaseException as e:
+            status.finished(None, e)
+            raise
+
+        if self.parallel:
+            dm = DownloadManager(plugin, printer=self._printer, on_progress=self._progress, url=url)
+        else:
+            dm = DownloadManager(plugin, url=url)
+
+        with self._lock:
+            self._active.append(dm)
+            self._statuses[dm] = status
+            cancelling = self._cancelling
+        if cancelling:
+            # Started just as everything was being cancelled.
+            dm.cancel()
+        status.started(dm)
+        events.emit("book_start", url=url, plugin=plugin.name)
+        metrics.active_downloads.inc()
+        try:
+            with trace.tagged(url=url), trace.span("download book", "book"):
+                dm.start_download()
+                dm.finalize()
+            self._record(plugin, url, dm)
+        except BaseException as e:
+            status.finished(dm, e)
+            self._book_end(dm, e)
+            raise
+        else:
+            status.finished(dm)
+            self._book_end(dm)
+        finally:
+            metrics.active_downloads.dec()
+            with self._lock:
+                self._active.remove(dm)
+                del self._statuses[dm]
+                self._finished += 1
+                self._files += dm.count
+
+    def _book_end(self, dm, error=None):
+        metrics.books.inc(labels=("done" if error is None else "failed",))
+        if events.enabled():
+            current, total = dm.progress()
+            events.emit("book_end", url=dm.url, plugin=dm.plugin.name, files=current, total=total, path=dm.path,
+                error=None if error is None else str(error) or type(error).__name__, stats=dm.stats.to_dict())
+
+    def _record(self, plugin, url, dm):
+        # Only books where every file made it count as downloaded.
+        current, total = dm.progress()
+        if plugin.partial or not current or (total != -1 and current < total):
+            return
+
+        try:
+            Library.open(DownloadManager.base_directory).record(plugin, url, current, dm.path, dm.hashes)
+        except Exception:
+            self.logger.exception("Failed to add '{}' to the library.".format(url))
+
+    def _progress(self, dm, filename):
+        with self._lock:
+            files = self._files
+            current = 0
+            total = 0
+            for active in self._active:
+                done, expected = active.progress()
+                files += active.count
+                if expected != -1:
+                    current += done
+                    total += expected
+            line = "  Downloads: {}/{} done, {} active | {} files".format(self._finished, self._submitted,
+                len(self._active), files)
+            if total:
+                line += " | Active: {}/{} ({}%)".format(current, total, round(100 * current / total))
+            rate = TransferStats.total.describe()
+            if rate:
+                line += " | " + rate
+            status = self._statuses.get(dm)
+        if status is not None:
+            status.progress(dm)
+        self._printer.line = line + " | Last: " + filename
+        self._printer.flush()
@@ -0,0 +1,103 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+"""
+Splits a list of URLs between several mindl processes without them having to talk to
+each other. Every URL is assigned to a shard by hashing what identifies the book it
+points to, so each process can be given the same list and will only download its share,
+the same book always ends up on the same shard, and two URLs for the same book can't end
+up being downloaded twice on different shards.
+
+"""
+
+def normalize_url(url):
+    """
+    Rewrite the parts of a URL that don't change what it points to the same way every time:
+    http becomes https, the host is lowercased without a leading "www.", the query is sorted
+    and the fragment is dropped.
+
+    """
+    try:
+        parts = urlsplit(url.strip())
+    except ValueError:
+        return url.strip()
+
+    scheme = parts.scheme.lower()
+    if scheme == "http":
+        scheme = "https"
+    netloc = parts.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+class Shard:
+    def __init__(self, index, count):
+        """'index' goes from 1 to 'count'."""
+        if count < 1 or not 1 <= index <= count:
+            raise ValueError("The shard has to be between 1 and the number of shards.")
+        self.index = index
+        self.count = count
+
+    @classmethod
+    def parse(cls, text):
+        """Parse a shard written as 'i/n', e.g. '2/4' for the second of four shards."""
+        try:
+            index, count = (int(x) for x in text.split("/"))
+        except ValueError:
+            raise ValueError("The shard '{}' is not in the right format. Please use 'i/n', e.g. '1/4'.".format(text))
+
+        return cls(index, count)
+
+    def __str__(self):
+        return "{}/{}".format(self.index, self.count)
+
+    def of(self, key):
+        """The shard 'key' belongs to. Python's hash() is randomized per process, so we can't use that."""
+        digest = hashlib.sha1(key.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big") % self.count + 1
+
+    def owns(self, key):
+        return self.of(key) == self.index
+
+def shard_key(pm, url):
+    """
+    What a URL is sharded by: the content ID given by the plugin that handles it, or the
+    normalized URL if there's no such plugin.
+
+    """
+    handlers = pm.find_handlers(url)
+    if handlers:
+        plugin = handlers[0][0]
+        try:
+            content_id = plugin.content_id(url)
+        except Exception:
+            pass
+        else:
+            # Plugins that can't tell books apart any better use the URL itself, which has to be
+            # normalized so that two ways of writing the same URL still end up on the same shard.
+            if content_id == url:
+                content_id = normalize_url(url)
+            return "{}:{}".format(plugin.name, content_id)
+
+    return normalize_url(url)
@@ -0,0 +1,405 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import tarfile
+import hashlib
+import logging
+import os.path
+import zipfile
+import struct
+import queue
+import zlib
+import time
+import io
+import os
+
+from . import memory_profile, trace
+from .manifest import Manifest
+from .writer_pool import WriterPool, WriteResult, TEMP_SUFFIX
+
+"""
+Storage sinks are where downloaded files end up. The download manager submits files to
+a sink as they come in, and reads back which ones have been stored through completed(),
+which is what progress and the resume manifest are based on.
+
+Plugins can pick their own sink by overriding BasePlugin.sink(), usually by calling
+mindl.open_sink(), which takes care of whether things go to the local filesystem or an
+object store.
+
+"""
+
+# ID of the zip extra field a ZipSink tags files with, holding the identity of the book.
+IDENTITY_FIELD = 0x6c6d
+
+class StorageSink:
+    # Whether or not files can be checked individually by a manifest to resume downloads.
+    resumable = False
+    # Files stored by referring to identical content instead of storing it again, and how many bytes that saved.
+    linked_files = 0
+    saved_bytes = 0
+
+    def submit(self, directory, filename, data):
+        """Queue a downloaded file to be stored."""
+        raise NotImplementedError("'submit' needs to be implemented.")
+
+    def add_data(self, name, data):
+        """Queue an extra file (e.g. metadata) to be stored. Does not show up in completed()."""
+        raise NotImplementedError("'add_data' needs to be implemented.")
+
+    def add_file(self, path, name=None):
+        with open(path, "rb") as f:
+            self.add_data(name or os.path.basename(path), f.read())
+
+    def completed(self):
+        """Yield a WriteResult for every submitted file stored since the last call."""
+        return iter([])
+
+    def stored(self):
+        """
+        The filenames a previous run of the same download already stored, for sinks that can tell
+        without a manifest. Empty if there aren't any, or if the sink can't tell.
+
+        """
+        return {}
+
+    def flush(self):
+        """Wait for every queued file to be stored."""
+        pass
+
+    def close(self, finished=True):
+        """
+        Flush and release whatever the sink holds on to. Calling it more than once is fine.
+        'finished' is False if the download didn't get every file, in which case what was
+        stored is left for a later run to pick up, if the sink can do that.
+
+        """
+        pass
+
+class DirectorySink(StorageSink):
+    """Writes files to a local directory using a WriterPool, hardlinking duplicates if given a DedupStore."""
+    resumable = True
+
+    def __init__(self, directory, threads=4, fsync_every=0, dedup=None):
+        self.path = directory
+        self._writer = WriterPool(threads=threads, fsync_every=fsync_every, dedup=dedup)
+
+    @property
+    def linked_files(self):
+        return self._writer.linked_files
+
+    @property
+    def saved_bytes(self):
+        return self._writer.saved_bytes
+
+    def submit(self, directory, filename, data):
+        self._writer.submit(directory, filename, data)
+
+    def add_data(self, name, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._writer.submit(self.path, name, data, report=False)
+
+    def completed(self):
+        return self._writer.completed()
+
+    def flush(self):
+        self._writer.flush()
+
+    def close(self, finished=True):
+        self._writer.close()
+
+class ArchiveSink(StorageSink):
+    """
+    Appends files to an archive as they arrive instead of writing them to a directory
+    and archiving it afterwards, which means every byte is only written once.
+
+    Writing happens on its own thread, since archives have to be written sequentially. If
+    a path is given, the archive is written to a temporary file and renamed once closed.
+    Otherwise it's written to 'fileobj', which only needs write() and close() (e.g. an
+    upload to an object store), and 'path' is only used for display purposes.
+
+    """
+    def __init__(self, path, fileobj=None, prefix="", max_pending=64):
+        self.logger = logging.getLogger("mindl")
+        self.path = path
+        self._prefix = prefix
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._completed = queue.Queue()
+        self._count = 0
+        self._closed = False
+
+        if fileobj is None:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                self.logger.info("Creating non-existent directory '{}'.".format(directory))
+                os.makedirs(directory, exist_ok=True)
+            self._fileobj = self._open_file(path + TEMP_SUFFIX)
+            self._local = True
+        else:
+            self._fileobj = fileobj
+            self._local = False
+
+        self._open_archive(self._fileobj)
+        self._thread = threading.Thread(target=self._run, name="archive-writer", daemon=True)
+        self._thread.start()
+
+    def _open_file(self, temp_path):
+        return open(temp_path, "wb")
+
+    def _open_archive(self, fileobj):
+        raise NotImplementedError("'_open_archive' needs to be implemented.")
+
+    def _add(self, name, data, submitted=True):
+        """Add a file to the archive. 'submitted' is False for extra files from add_data()."""
+        raise NotImplementedError("'_add' needs to be implemented.")
+
+    def _close_archive(self):
+        raise NotImplementedError("'_close_archive' needs to be implemented.")
+
+    def submit(self, directory, filename, data):
+        """Queue a file to be added to the archive. The directory is ignored, as it's all going in the archive."""
+        memory_profile.held("archive queue", len(data))
+        self._queue.put((self._prefix + filename, filename, data))
+
+    def add_data(self, name, data):
+        """Queue a file to be added to the archive as is, without any prefix or progress being reported."""
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        memory_profile.held("archive queue", len(data))
+        self._queue.put((name, None, data))
+
+    def completed(self):
+        while True:
+            try:
+                yield self._completed.get_nowait()
+            except queue.Empty:
+                return
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self, finished=True):
+        """
+        Finish the archive. If it's local and nothing was ever added to it, it's removed instead.
+        If the download didn't finish, a local archive is left at its temporary path, where a
+        ZipSink for the same download can pick it up again.
+
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        self._queue.put(None)
+        self._thread.join()
+        self._close_archive()
+        self._fileobj.close()
+        if self._local:
+            if not self._count:
+                os.remove(self.path + TEMP_SUFFIX)
+            elif finished:
+                os.replace(self.path + TEMP_SUFFIX, self.path)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+
+                name, filename, data = job
+                memory_profile.held("archive queue", -len(data))
+                try:
+                    with trace.span("write", "io", file=name, size=len(data)), \
+                            memory_profile.stage("write", filename or name):
+                        self._add(name, data, filename is not None)
+                except Exception as e:
+                    if filename is not None:
+                        self._completed.put(WriteResult(self.path, filename, len(data), None, e))
+                    else:
+                        self.logger.exception("Failed to add '{}' to the archive.".format(name))
+                    continue
+
+                self._count += 1
+                if filename is not None:
+                    self._completed.put(WriteResult(self.path, filename, len(data),
+                        hashlib.sha1(data).hexdigest(), None))
+            finally:
+                self._queue.task_done()
+
+class ZipSink(ArchiveSink):
+    """
+    Streams files into a zip archive. Images are already compressed, so files are
+    stored as is by default.
+
+    Given the identity of the book (see manifest.book_identity()), a local archive can be
+    resumed. Submitted files are tagged with the identity in an extra field, and if a run of
+    the same download left the archive unfinished, the files in it are kept and show up in
+    stored(). If that run never got to write the archive's central directory (e.g. it was
+    killed), whatever files made it to disk intact are salvaged from their local headers.
+
+    """
+    def __init__(self, path, fileobj=None, prefix="", compression=zipfile.ZIP_STORED, identity=None, **kwargs):
+        self._compression = compression
+        self._identity = identity
+        self._tag = b""
+        if identity is not None:
+            tag = identity.encode("utf-8")[:0xffff - 4]
+            self._tag = struct.pack("<HH", IDENTITY_FIELD, len(tag)) + tag
+        # Files kept from an unfinished archive, by filename, with their sizes.
+        self._stored = {}
+        super().__init__(path, fileobj=fileobj, prefix=prefix, **kwargs)
+
+    def stored(self):
+        return self._stored
+
+    def _open_file(self, temp_path):
+        if self._identity is not None and Manifest.enabled and os.path.isfile(temp_path):
+            self._stored = self._recover(temp_path)
+            if self._stored:
+                self.logger.info("Picking up the unfinished archive '{}'.".format(temp_path))
+                self._count = len(self._stored)
+                return open(temp_path, "r+b")
+
+        return open(temp_path, "wb")
+
+    def _recover(self, temp_path):
+        """
+        Keep the files an unfinished run of the same download left in the archive at 'temp_path',
+        leaving it ready to be appended to. Returns the files by filename, or an empty dict if
+        the archive has to be started over.
+
+        """
+        try:
+            with zipfile.ZipFile(temp_path) as archive:
+                infos = archive.infolist()
+        except (zipfile.BadZipFile, OSError):
+            infos = None
+        if infos and all(_identity(info.extra) == self._identity for info in infos):
+            return {info.filename[len(self._prefix):]: info.file_size for info in infos}
+
+        # Either it was never finished, or it has extra files in it that will be added again. Either
+        # way, it has to be written again with only our files. That can't happen if it's for another book.
+        stored = {}
+        rewritten = temp_path + TEMP_SUFFIX
+        with zipfile.ZipFile(rewritten, mode="w") as archive:
+            for info, data in _intact_entries(temp_path):
+                identity = _identity(info.extra)
+                if identity is None:
+                    continue
+                elif identity != self._identity:
+                    stored = {}
+                    break
+                archive.writestr(info, data)
+                stored[info.filename[len(self._prefix):]] = info.file_size
+
+        if stored:
+            os.replace(rewritten, temp_path)
+        else:
+            os.remove(rewritten)
+        return stored
+
+    def _open_archive(self, fileobj):
+        # Works fine with unseekable streams, in which case sizes and CRCs go in data descriptors.
+        self._zip = zipfile.ZipFile(fileobj, mode="a" if self._stored else "w", compression=self._compression)
+
+    def _add(self, name, data, submitted=True):
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        info.compress_type = self._compression
+        if submitted:
+            info.extra = self._tag
+        self._zip.writestr(info, data)
+
+    def _close_archive(self):
+        self._zip.close()
+
+class TarSink(ArchiveSink):
+    """Streams files into an uncompressed tar archive."""
+    def _open_archive(self, fileobj):
+        self._tar = tarfile.open(fileobj=fileobj, mode="w|", format=tarfile.PAX_FORMAT)
+
+    def _add(self, name, data, submitted=True):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = time.time()
+        self._tar.addfile(info, io.BytesIO(data))
+
+    def _close_archive(self):
+        self._tar.close()
+
+def _identity(extra):
+    """The identity a ZipSink tagged a file with, from its extra field. None if it wasn't tagged."""
+    while len(extra) >= 4:
+        field, size = struct.unpack("<HH", extra[:4])
+        if field == IDENTITY_FIELD:
+            return extra[4:4 + size].decode("utf-8", "replace")
+        extra = extra[4 + size:]
+
+    return None
+
+def _intact_entries(path):
+    """
+    Yield a (ZipInfo, data) tuple for every intact file in the zip archive at 'path'. If it
+    has no central directory, files are read from their local headers up to the first one
+    that isn't complete.
+
+    """
+    try:
+        archive = zipfile.ZipFile(path)
+    except zipfile.BadZipFile:
+        pass
+    else:
+        with archive:
+            for info in archive.infolist():
+                yield info, archive.read(info)
+        return
+
+    with open(path, "rb") as f:
+        while True:
+            header = f.read(zipfile.sizeFileHeader)
+            if len(header) < zipfile.sizeFileHeader:
+                return
+            (signature, _, _, flags, method, mod_time, mod_date, crc, compressed_size, size, name_length,
+                extra_length) = struct.unpack(zipfile.structFileHeader, header)
+            # Files whose sizes come after their data can't be told apart from what follows them.
+            if signature != zipfile.stringFileHeader or flags & 0x08 or \
+                    method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+                return
+
+            name = f.read(name_length)
+            extra = f.read(extra_length)
+            data = f.read(compressed_size)
+            if len(data) < compressed_size:
+                return
+            if method == zipfile.ZIP_DEFLATED:
+                try:
+                    data = zlib.decompress(data, -15)
+                except zlib.error:
+                    return
+            if len(data) != size or zlib.crc32(data) != crc:
+                return
+
+            info = zipfile.ZipInfo(name.decode("utf-8" if flags & 0x800 else "cp437"), date_time=(
+                (mod_date >> 9) + 1980, (mod_date >> 5) & 0xf, mod_date & 0x1f,
+                mod_time >> 11, (mod_time >> 5) & 0x3f, (mod_time & 0x1f) * 2))
+            info.compress_type = method
+            info.extra = extra
+            yield info, data
+
+# Archive formats that can be passed to open_sink().
+ARCHIVES = {"zip": (".zip", ZipSink), "tar": (".tar", TarSink)}
@@ -0,0 +1,131 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import atexit
+import json
+import time
+import os
+
+"""
+Records what every thread is doing as spans in the trace event format, so a run can be
+opened in a timeline viewer (chrome://tracing, or https://ui.perfetto.dev) to see where
+the time goes: stragglers, threads waiting on each other or on the GIL, idle gaps.
+
+Use 'with trace.span("name", "category", key=value):' around anything worth seeing. Spans
+are also tagged with whatever the thread is working on, set with trace.tagged(), e.g. the
+page being downloaded. Until start() is called, span() returns a shared object that does
+nothing, so spans can be left in hot paths.
+
+"""
+
+# Every span as (name, category, start, end, thread ID, args), or None when not tracing.
+_spans = None
+_path = None
+_origin = 0.0
+# Thread names by ID, for the viewer to label threads with.
+_threads = {}
+_local = threading.local()
+
+class _NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+_NULL = _NullSpan()
+
+class _Span:
+    def __init__(self, name, category, args):
+        self._name = name
+        self._category = category
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._args["error"] = exc_type.__name__
+        record(self._name, self._category, self._start, time.perf_counter(), **self._args)
+
+class _Tags:
+    def __init__(self, tags):
+        self._tags = tags
+
+    def __enter__(self):
+        self._previous = getattr(_local, "tags", None)
+        _local.tags = dict(self._previous or {}, **self._tags)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.tags = self._previous
+
+def start(path):
+    """Start tracing. The trace is written to 'path' at exit."""
+    global _spans, _path, _origin
+    _path = path
+    _origin = time.perf_counter()
+    _spans = []
+    atexit.register(write)
+
+def enabled():
+    return _spans is not None
+
+def span(name, category="", **args):
+    if _spans is None:
+        return _NULL
+    return _Span(name, category, args)
+
+def tagged(**tags):
+    """Tag every span the current thread records inside the block, e.g. with the page it's working on."""
+    if _spans is None:
+        return _NULL
+    return _Tags(tags)
+
+def record(name, category, start, end, **args):
+    """Record a span that started and ended at the given time.perf_counter() values."""
+    spans = _spans
+    if spans is None:
+        return
+
+    thread = threading.get_native_id()
+    if thread not in _threads:
+        _threads[thread] = threading.current_thread().name
+    tags = getattr(_local, "tags", None)
+    if tags:
+        args = dict(tags, **args)
+    # Appending to a list is atomic, so there's no need for a lock.
+    spans.append((name, category, start, end, thread, args))
+
+def write():
+    """Write everything recorded so far to the file given to start()."""
+    if _spans is None:
+        return
+
+    pid = os.getpid()
+    events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread, "args": {"name": name}}
+              for thread, name in list(_threads.items())]
+    for name, category, start, end, thread, args in list(_spans):
+        events.append({"name": name, "cat": category, "ph": "X", "pid": pid, "tid": thread,
+                       "ts": round((start - _origin) * 1e6, 1), "dur": round((end - start) * 1e6, 1),
+                       "args": args})
+
+    with open(_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False, default=str)
@@ -0,0 +1,172 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import math
+import time
+
+from .dedup import format_size
+
+class _Rate:
+    """The rate at which a counter goes up, both over the last sample and as an EWMA."""
+    def __init__(self):
+        self.current = 0.0
+        self.average = None
+        self._last = 0
+
+    def sample(self, value, elapsed, weight):
+        self.current = (value - self._last) / elapsed
+        self._last = value
+        if self.average is None:
+            self.average = self.current
+        else:
+            self.average += weight * (self.current - self.average)
+
+class TransferStats:
+    """
+    Counts what a download has fetched and written, and measures how fast that's going.
+
+    'received_bytes' are the bytes a plugin got from the network (or, for plugins that
+    don't report those, the size of the files it handed over), 'written_bytes' and
+    'written_files' what the sink has stored, and 'in_flight' the number of requests a
+    plugin is waiting on right now. Every update is also added to 'parent', so
+    TransferStats.total covers everything downloaded by this process.
+
+    Rates are per second, both over the last sample and as an exponentially weighted
+    moving average whose weights halve every 'half_life' seconds. They're sampled when
+    read, but at most every 'sample_interval' seconds, so reading them often is cheap
+    and doesn't make them noisy.
+
+    """
+    half_life = 5.0
+    sample_interval = 0.5
+
+    # Set to the process-wide instance below.
+    total = None
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.received_bytes = 0
+        self.written_bytes = 0
+        self.written_files = 0
+        self.in_flight = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._sampled = self.started
+        self._received = _Rate()
+        self._written = _Rate()
+        self._files = _Rate()
+
+    def received(self, size):
+        with self._lock:
+            self.received_bytes += size
+        if self.parent is not None:
+            self.parent.received(size)
+
+    def written(self, size, files=1):
+        with self._lock:
+            self.written_bytes += size
+            self.written_files += files
+        if self.parent is not None:
+            self.parent.written(size, files)
+
+    def request(self):
+        """Use as 'with stats.request():' around a request to count it as in flight."""
+        return _InFlight(self)
+
+    def _add_in_flight(self, amount):
+        with self._lock:
+            self.in_flight += amount
+        if self.parent is not None:
+            self.parent._add_in_flight(amount)
+
+    def _sample(self):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._sampled
+            if elapsed < self.sample_interval:
+                return
+            self._sampled = now
+            weight = 1 - math.pow(0.5, elapsed / self.half_life)
+            self._received.sample(self.received_bytes, elapsed, weight)
+            self._written.sample(self.written_bytes, elapsed, weight)
+            self._files.sample(self.written_files, elapsed, weight)
+
+    def rates(self):
+        """
+        A dictionary of the rates of 'received' and 'written' bytes and of 'files', each
+        as a (last sample, average) tuple. The average is None until the first sample.
+
+        """
+        self._sample()
+        return {"received": (self._received.current, self._received.average),
+                "written": (self._written.current, self._written.average),
+                "files": (self._files.current, self._files.average)}
+
+    def eta(self, remaining_files):
+        """Seconds left to write 'remaining_files' at the average rate, or None if it can't be told yet."""
+        self._sample()
+        rate = self._files.average
+        if remaining_files < 0 or not rate:
+            return None
+
+        return remaining_files / rate
+
+    def to_dict(self, remaining_files=-1):
+        rates = self.rates()
+        return {"received_bytes": self.received_bytes, "written_bytes": self.written_bytes,
+                "written_files": self.written_files, "in_flight": self.in_flight,
+                "elapsed": time.monotonic() - self.started,
+                "received_rate": rates["received"][0], "received_rate_avg": rates["received"][1],
+                "written_rate": rates["written"][0], "written_rate_avg": rates["written"][1],
+                "files_rate": rates["files"][0], "files_rate_avg": rates["files"][1],
+                "eta": self.eta(remaining_files)}
+
+    def describe(self, remaining_files=-1):
+        """A short summary for progress lines, e.g. '1.2 MiB/s, 3 in flight, ETA 1:05'."""
+        received = self.rates()["received"][1]
+        if received is None:
+            return ""
+
+        out = "{}/s".format(format_size(int(received)))
+        if self.in_flight:
+            out += ", {} in flight".format(self.in_flight)
+        eta = self.eta(remaining_files)
+        if eta is not None:
+            out += ", ETA {}".format(format_duration(eta))
+        return out
+
+class _InFlight:
+    def __init__(self, stats):
+        self._stats = stats
+
+    def __enter__(self):
+        self._stats._add_in_flight(1)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._stats._add_in_flight(-1)
+
+TransferStats.total = TransferStats()
+
+def format_duration(seconds):
+    """Format a number of seconds as 'h:mm:ss', or 'm:ss' under an hour."""
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+    return "{}:{:02d}".format(minutes, seconds)
@@ -0,0 +1,105 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import hashlib
+import logging
+import queue
+import sys
+
+# Put in the queue once every source has been read.
+_END = object()
+
+class UrlFeed:
+    """
+    Reads URLs from the command line and from files on a background thread, one line at a
+    time, and hands them out through a bounded queue. A file named '-' is stdin, so URLs can
+    be piped in by another process while downloads are already running. The reader blocks
+    whenever the queue is full, so memory usage doesn't depend on how many URLs there are.
+
+    If 'dedup' is True, URLs that have already come up are skipped. Only a small hash of
+    each URL is kept to tell, not the URL itself.
+
+    Iterate over it to get the URLs. If set, 'on_idle' is called whenever the next URL
+    isn't ready yet, before waiting for it, so that whoever is iterating can get started on
+    what it already has.
+
+    """
+    def __init__(self, urls=(), files=(), dedup=False, maxsize=1024):
+        self.logger = logging.getLogger("mindl")
+        self.dedup = dedup
+        self.duplicates = 0
+        self.count = 0
+        self.on_idle = None
+        self._urls = list(urls)
+        self._files = list(files)
+        self._seen = set()
+        self._queue = queue.Queue(maxsize=max(1, maxsize))
+        self._thread = threading.Thread(target=self._run, name="url-feed", daemon=True)
+        self._thread.start()
+
+    @property
+    def many(self):
+        """Whether or not there might be more than a single URL."""
+        return bool(self._files) or len(self._urls) > 1
+
+    def __iter__(self):
+        while True:
+            if self.on_idle is not None and self._queue.empty():
+                self.on_idle()
+            url = self._queue.get()
+            if url is _END:
+                return
+            self.count += 1
+            yield url
+
+    def _is_duplicate(self, url):
+        if not self.dedup:
+            return False
+
+        digest = hashlib.blake2b(url.encode("utf-8"), digest_size=16).digest()
+        if digest in self._seen:
+            self.duplicates += 1
+            return True
+
+        self._seen.add(digest)
+        return False
+
+    def _put(self, line):
+        url = line.strip()
+        if url and not self._is_duplicate(url):
+            self._queue.put(url)
+
+    def _run(self):
+        try:
+            for url in self._urls:
+                self._put(url)
+
+            for path in self._files:
+                try:
+                    if path == "-":
+                        for line in sys.stdin:
+                            self._put(line)
+                    else:
+                        with open(path, encoding="UTF-8") as f:
+                            for line in f:
+                                self._put(line)
+                except (OSError, UnicodeDecodeError) as e:
+                    self.logger.error("Could not read URLs from '{}': {}".format(path, e))
+        finally:
+            self._queue.put(_END)
@@ -0,0 +1,233 @@
+# mindl - A plugin-based downloading tool.
+# Copyright (C) 2016 Mino <mino@minomino.org>
+
+# This file is part of mindl.
+
+# mindl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# mindl is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with mindl. If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import hashlib
+import logging
+import os.path
+import queue
+import time
+import os
+
+from collections import namedtuple
+
+from . import memory_profile, metrics, trace
+
+# Suffix of files that are still being written to.
+TEMP_SUFFIX = ".part"
+
+# What comes out of WriterPool.completed(). If the write failed, 'error' is the exception.
+WriteResult = namedtuple("WriteResult", ["directory", "filename", "size", "sha1", "error"])
+
+class WriterPool:
+    """
+    Writes files on a pool of threads so that slow storage (e.g. network filesystems)
+    doesn't hold up whoever is producing the data.
+
+    Files are written to a temporary file first, then renamed to their final name, so a
+    file with its final name is always complete. If fsync_every is set, files are fsynced
+    in batches of that many files before being renamed, and only reported as completed
+    once they are, after the directories they were renamed in have been synced too. This
+    keeps whatever reads completed() in step with what's actually on disk.
+
+    If a DedupStore is given, files with the same content as one that's already been
+    written are hardlinked to it instead of being written again.
+
+    """
+    def __init__(self, threads=4, fsync_every=0, max_pending=64, dedup=None):
+        self.logger = logging.getLogger("mindl")
+        self._fsync_every = max(0, fsync_every)
+        self._dedup = dedup
+        # Files linked by the dedup store instead of being written, and how many bytes that saved.
+        self.linked_files = 0
+        self.saved_bytes = 0
+        self._stats_lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max(1, max_pending))
+        self._completed = queue.Queue()
+        self._directories = set()
+        self._directories_lock = threading.Lock()
+        # Files written but not yet fsynced, as (directory, filename, size, sha1, sha256, report).
+        self._batch = []
+        self._batch_lock = threading.Lock()
+        self._threads = []
+        for i in range(max(1, threads)):
+            thread = threading.Thread(target=self._run, name="writer-{}".format(i), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, directory, filename, data, report=True):
+        """
+        Queue a file to be written. Blocks if too many files are already waiting to be written.
+        If 'report' is False, the write will not show up in completed() and errors are only logged.
+
+        """
+        metrics.write_queue.inc()
+        memory_profile.held("write queue", len(data))
+        self._queue.put((directory, filename, data, report, time.perf_counter()))
+
+    def completed(self):
+        """Yield the results of every write that has completed since the last call."""
+        while True:
+            try:
+                yield self._completed.get_nowait()
+            except queue.Empty:
+                return
+
+    def flush(self):
+        """Wait for every queued file to be written and synced."""
+        self._queue.join()
+        self._sync_batch(force=True)
+
+    def close(self):
+        """Wait for every queued file to be written and synced, then stop the threads."""
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._sync_batch(force=True)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+
+                directory, filename, data, report, submitted = job
+                metrics.write_queue.dec()
+                memory_profile.held("write queue", -len(data))
+                try:
+                    # How long it waited for a writer is worth seeing next to the write itself.
+                    with trace.span("write", "io", file=filename, size=len(data),
+                            queued_ms=round((time.perf_counter() - submitted) * 1000, 3)), \
+                            memory_profile.stage("write", filename):
+                        self._write(directory, filename, data, report)
+                except Exception as e:
+                    self._report(WriteResult(directory, filename, len(data), None, e), report)
+            finally:
+                self._queue.task_done()
+
+    def _ensure_directory(self, directory):
+        # Checking the filesystem can be slow, so we remember which directories we've made.
+        with self._directories_lock:
+            if directory in self._directories:
+                return
+            if not os.path.isdir(directory):
+                self.logger.info("Creating non-existent directory '{}'.".format(directory))
+                os.makedirs(directory, exist_ok=True)
+            self._directories.add(directory)
+
+    def _report(self, result, report):
+        if report:
+            self._completed.put(result)
+        elif result.error is not None:
+            self.logger.error("Failed to write '{}': {}".format(os.path.join(result.directory, result.filename),
+                result.error))
+
+    def _write(self, directory, filename, data, report):
+        self._ensure_directory(directory)
+        sha1 = hashlib.sha1(data).hexdigest()
+        path = os.path.join(directory, filename)
+
+        sha256 = None
+        if self._dedup is not None:
+            sha256 = hashlib.sha256(data).hexdigest()
+            # Linked files already exist on disk, so there's nothing to sync.
+            if self._dedup.link(sha256, len(data), path + TEMP_SUFFIX):
+                os.replace(path + TEMP_SUFFIX, path)
+                with self._stats_lock:
+                    self.linked_files += 1
+                    self.saved_bytes += len(data)
+                self._report(WriteResult(directory, filename, len(data), sha1, None), report)
+                return
+
+        with open(path + TEMP_SUFFIX, "wb") as f:
+            f.write(data)
+            if self._fsync_every == 1:
+                f.flush()
+                os.fsync(f.fileno())
+
+        if self._fsync_every > 1:
+            with self._batch_lock:
+                self._batch.append((directory, filename, len(data), sha1, sha256, report))
+            self._sync_batch()
+        else:
+            os.replace(path + TEMP_SUFFIX, path)
+            if self._fsync_every == 1:
+                self._sync_directory(directory)
+            self._written(path, len(data), sha256)
+            self._report(WriteResult(directory, filename, len(data), sha1, None), report)
+
+    @staticmethod
+    def _sync_directory(directory):
+        """Make renames in 'directory' durable. Windows can't open directories, nor does it need to."""
+        if os.name == "nt":
+            return
+
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _written(self, path, size, sha256):
+        # Only index files once they have their final name, so nothing gets linked to a temporary file.
+        if sha256 is not None:
+            try:
+                self._dedup.add(sha256, size, path)
+            except Exception:
+                self.logger.exception("Failed to add '{}' to the dedup index.".format(path))
+
+    def _sync_batch(self, force=False):
+        with self._batch_lock:
+            if not self._batch or (not force and len(self._batch) < self._fsync_every):
+                return
+            batch, self._batch = self._batch, []
+
+        with trace.span("sync batch", "io", files=len(batch)):
+            renamed = []
+            for directory, filename, size, sha1, sha256, report in batch:
+                path = os.path.join(directory, filename)
+                try:
+                    # Windows only lets us sync files we can write to.
+                    fd = os.open(path + TEMP_SUFFIX, os.O_RDWR)
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        os.close(fd)
+                    os.replace(path + TEMP_SUFFIX, path)
+                except Exception as e:
+                    self._report(WriteResult(directory, filename, size, None, e), report)
+                else:
+                    renamed.append((directory, filename, size, sha1, sha256, report))
+
+            # The renames only count once the directories have been synced, so that's when files are reported.
+            failed = {}
+            for directory in {entry[0] for entry in renamed}:
+                try:
+                    self._sync_directory(directory)
+                except OSError as e:
+                    failed[directory] = e
+
+            for directory, filename, size, sha1, sha256, report in renamed:
+                if directory in failed:
+                    self._report(WriteResult(directory, filename, size, None, failed[directory]), report)
+                else:
+                    self._written(os.path.join(directory, filename), size, sha256)
+                    self._report(WriteResult(directory, filename, size, sha1, None), report)
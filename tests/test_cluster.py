@@ -0,0 +1,130 @@
+import threading
+import zipfile
+import time
+import os
+
+import pytest
+
+from mindl.base_plugin import BasePlugin
+from mindl.cluster import Coordinator, JobQueue, Worker, DONE, FAILED, RE_PART
+from mindl.download_manager import DownloadManager
+from mindl.library import Library
+from mindl.plugin_manager import PluginManager
+
+class Handlers:
+    """Stands in for the plugin manager, with every dummy:// URL handled by 'plugin' and nothing else handled at all."""
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def find_handlers(self, url):
+        return [(self.plugin, None)] if url.startswith("dummy://") else []
+
+def dummy_in_parts():
+    """The dummy plugin, with the page range in the names of parts of a book like BinB plugins."""
+    dummy = PluginManager().find_handlers("dummy://")[0][0]
+
+    class Parts(dummy):
+        def directory(self):
+            if not hasattr(self, "_directory"):
+                super().directory()
+                if self.partial:
+                    self._directory += " (p{}-{})".format(self.first, self.last)
+            return self._directory
+
+    return Parts
+
+@pytest.fixture
+def cluster(monkeypatch, tmp_path):
+    """Starts a coordinator for a queue on localhost, and returns its queue and a function to run workers for it."""
+    monkeypatch.setattr(Worker, "poll_interval", 0.05)
+    monkeypatch.setattr(BasePlugin, "keep_sessions", BasePlugin.keep_sessions)
+    monkeypatch.setattr(DownloadManager, "base_directory", str(tmp_path / "downloads"))
+    coordinators = []
+
+    def start(split_pages=0, max_attempts=3, heartbeat_timeout=30.0):
+        queue = JobQueue(str(tmp_path / "jobs.sqlite"), max_attempts=max_attempts)
+        coordinator = Coordinator(queue, split_pages=split_pages, heartbeat_timeout=heartbeat_timeout,
+            exit_when_done=False)
+        threading.Thread(target=coordinator.serve, args=(("127.0.0.1", 0),), daemon=True).start()
+        while coordinator._server is None:
+            time.sleep(0.01)
+        coordinators.append(coordinator)
+        url = "127.0.0.1:{}".format(coordinator._server.server_address[1])
+
+        def work(n=4, count=2):
+            # Every worker runs until the coordinator has nothing left.
+            options = [(None, "n", str(n)), (None, "length", "0.02"), (None, "chatter", "0")]
+            workers = [threading.Thread(target=Worker(url, Handlers(dummy_in_parts()), "worker-{}".format(i),
+                options=options).run, daemon=True) for i in range(count)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join(30)
+            assert not any(worker.is_alive() for worker in workers)
+
+        return queue, url, work
+
+    yield start
+    for coordinator in coordinators:
+        coordinator._server.shutdown()
+        coordinator.queue.close()
+
+def test_jobs_are_spread_over_the_workers(cluster):
+    queue, url, work = cluster()
+    ids = [queue.add("dummy://{}".format(i)) for i in range(6)]
+    work()
+
+    jobs = queue.jobs()
+    assert [job["state"] for job in jobs] == [DONE] * 6
+    assert [job["files"] for job in jobs] == [4] * 6
+    assert {job["worker"] for job in jobs} == {"worker-0", "worker-1"}
+
+def test_jobs_of_lost_workers_go_back_in_the_queue(cluster):
+    queue, url, work = cluster(heartbeat_timeout=0.5)
+    lost = queue.add("dummy://lost")
+    # A worker that died right after getting the job.
+    assert queue.lease("ghost")["id"] == lost
+    other = queue.add("dummy://other")
+    work()
+
+    jobs = dict((job["id"], job) for job in queue.jobs())
+    assert jobs[lost]["state"] == DONE
+    assert jobs[lost]["attempts"] == 2
+    assert jobs[lost]["worker"] != "ghost"
+    assert jobs[other]["state"] == DONE
+    # Hearing from the lost worker again doesn't change a thing.
+    assert not Worker(url, None, "ghost")._post("/complete", {"worker": "ghost", "job": lost, "files": 0})["ok"]
+    assert [job["state"] for job in queue.jobs() if job["id"] == lost] == [DONE]
+
+def test_jobs_fail_after_max_attempts(cluster):
+    queue, url, work = cluster(max_attempts=2)
+    broken = queue.add("nothing://1")
+    fine = queue.add("dummy://2")
+    work()
+
+    jobs = dict((job["id"], job) for job in queue.jobs())
+    assert jobs[broken]["state"] == FAILED
+    assert jobs[broken]["attempts"] == 2
+    assert "No plugins can handle the URL" in jobs[broken]["error"]
+    assert jobs[fine]["state"] == DONE
+
+def test_split_books_are_merged(cluster, monkeypatch):
+    monkeypatch.setattr(DownloadManager, "archive", "zip")
+    queue, url, work = cluster(split_pages=5)
+    book = queue.add("dummy://big")
+    work(n=12)
+
+    jobs = queue.jobs()
+    assert [(job["state"], job["files"]) for job in jobs if job["id"] == book] == [(DONE, 12)]
+    parts = [job for job in jobs if job["parent"] == book]
+    assert [(part["page_start"], part["page_end"], part["state"]) for part in parts] == \
+        [(1, 5, DONE), (6, 10, DONE), (11, 12, DONE)]
+    assert [part["files"] for part in parts] == [5, 5, 2]
+
+    path = RE_PART.sub("", parts[0]["path"])
+    assert not any(os.path.exists(part["path"]) for part in parts)
+    with zipfile.ZipFile(path) as merged:
+        assert merged.testzip() is None
+        assert sorted(merged.namelist(), key=lambda name: int(name.split(".")[0])) == \
+            ["{}.txt".format(page) for page in range(1, 13)]
+    assert Library.open(DownloadManager.base_directory).find(dummy_in_parts(), "dummy://big")["path"] == path
@@ -0,0 +1,69 @@
+import threading
+import socket
+import time
+import os
+
+import pytest
+
+from mindl.base_plugin import BasePlugin
+from mindl.daemon import Daemon, remove_stale_socket, RUNNING, DONE, CANCELLED
+from mindl.download_manager import DownloadManager
+from mindl.library import Library
+from mindl.plugin_manager import PluginManager
+
+def test_finished_jobs_are_forgotten(monkeypatch):
+    monkeypatch.setattr(Daemon, "keep_finished", 3)
+    # The daemon turns this on for every plugin.
+    monkeypatch.setattr(BasePlugin, "keep_sessions", BasePlugin.keep_sessions)
+    daemon = Daemon(PluginManager())
+    jobs = []
+    for i in range(10):
+        job = daemon.submit("dummy://{}".format(i))
+        jobs.append(job)
+        if i < 8:
+            job.finished(None)
+
+    # The 3 most recently finished jobs are kept, and so are the ones still queued.
+    assert sorted(daemon.jobs) == [job.id for job in jobs[5:]]
+
+def test_shutting_down_cancels_jobs_that_have_not_started(monkeypatch, tmp_path):
+    monkeypatch.setattr(BasePlugin, "keep_sessions", BasePlugin.keep_sessions)
+    monkeypatch.setattr(DownloadManager, "base_directory", str(tmp_path))
+    monkeypatch.setattr(Library, "enabled", False)
+    daemon = Daemon(PluginManager(), jobs=1, prefetch=0)
+    dispatcher = threading.Thread(target=daemon._dispatch, daemon=True)
+    with daemon._scheduler:
+        # One job runs, one waits in the scheduler, one waits to be handed to it and the rest wait in the daemon.
+        jobs = [daemon.submit("dummy://{}".format(i), options={"n": 4, "length": 0.2, "chatter": 0})
+                for i in range(5)]
+        dispatcher.start()
+        while jobs[0].state != RUNNING:
+            time.sleep(0.01)
+        daemon._shut_down(dispatcher)
+
+    assert not dispatcher.is_alive()
+    assert [job.state for job in jobs] == [DONE] + [CANCELLED] * 4
+
+@pytest.mark.skipif(not hasattr(socket, "AF_UNIX"), reason="needs Unix sockets")
+def test_only_stale_sockets_are_removed(tmp_path):
+    path = str(tmp_path / "mindl.sock")
+    remove_stale_socket(path)
+
+    with open(path, "w") as f:
+        f.write("not a socket")
+    with pytest.raises(OSError):
+        remove_stale_socket(path)
+    assert os.path.exists(path)
+    os.remove(path)
+
+    listening = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listening.bind(path)
+    listening.listen(1)
+    with pytest.raises(OSError):
+        remove_stale_socket(path)
+    assert os.path.exists(path)
+
+    # Nothing listens on it once it's closed, the same as after a crash.
+    listening.close()
+    remove_stale_socket(path)
+    assert not os.path.exists(path)
@@ -0,0 +1,68 @@
+import hashlib
+import os
+
+import pytest
+
+from mindl.dedup import DedupStore
+
+@pytest.fixture
+def store(tmp_path):
+    store = DedupStore.open(str(tmp_path))
+    yield store
+    store.close()
+
+def write(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+def test_identical_files_are_linked(store, tmp_path):
+    data = b"credits page" * 100
+    sha256 = write(tmp_path / "a", data)
+    store.add(sha256, len(data), str(tmp_path / "a"))
+
+    assert store.link(sha256, len(data), str(tmp_path / "b"))
+    assert os.path.samefile(tmp_path / "a", tmp_path / "b")
+    assert (store.linked_files, store.saved_bytes) == (1, len(data))
+
+    # Adding the copy again keeps the first file indexed.
+    store.add(sha256, len(data), str(tmp_path / "b"))
+    os.remove(tmp_path / "b")
+    assert store.link(sha256, len(data), str(tmp_path / "c"))
+    assert (store.linked_files, store.saved_bytes) == (2, 2 * len(data))
+
+def test_unknown_content_is_not_linked(store, tmp_path):
+    assert not store.link(hashlib.sha256(b"new").hexdigest(), 3, str(tmp_path / "a"))
+    assert not os.path.exists(tmp_path / "a")
+    assert (store.linked_files, store.saved_bytes) == (0, 0)
+
+@pytest.mark.parametrize("change", ["delete", "overwrite"])
+def test_stale_entries_are_dropped(store, tmp_path, change):
+    data = b"ad page" * 100
+    sha256 = write(tmp_path / "a", data)
+    store.add(sha256, len(data), str(tmp_path / "a"))
+    if change == "delete":
+        os.remove(tmp_path / "a")
+    else:
+        write(tmp_path / "a", b"something else")
+
+    assert not store.link(sha256, len(data), str(tmp_path / "b"))
+    assert not os.path.exists(tmp_path / "b")
+    assert (store.linked_files, store.saved_bytes) == (0, 0)
+
+    # Whatever is written next takes its place in the index.
+    write(tmp_path / "b", data)
+    store.add(sha256, len(data), str(tmp_path / "b"))
+    assert store.link(sha256, len(data), str(tmp_path / "c"))
+    assert os.path.samefile(tmp_path / "b", tmp_path / "c")
+
+def test_the_index_is_kept_on_disk(tmp_path):
+    data = b"page" * 100
+    store = DedupStore.open(str(tmp_path))
+    sha256 = write(tmp_path / "a", data)
+    store.add(sha256, len(data), str(tmp_path / "a"))
+    store.close()
+
+    store = DedupStore.open(str(tmp_path))
+    assert store.link(sha256, len(data), str(tmp_path / "b"))
+    store.close()
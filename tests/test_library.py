@@ -0,0 +1,64 @@
+import os
+
+import pytest
+
+from mindl.base_plugin import BasePlugin
+from mindl.library import Library
+
+class ById(BasePlugin):
+    name = "ById"
+
+    @classmethod
+    def content_id(cls, url):
+        return url.split("id=", 1)[-1]
+
+class Other(ById):
+    name = "Other"
+
+@pytest.fixture
+def library(tmp_path):
+    library = Library.open(str(tmp_path / "downloads"))
+    yield library
+    library.close()
+
+def test_recorded_books_are_found_by_content_id(library, tmp_path):
+    book = tmp_path / "downloads" / "Book"
+    book.mkdir()
+    assert not library.has(ById, "https://example.com/read?id=1")
+    library.record(ById, "https://example.com/read?id=1", 20, str(book), {"1.jpg": "0" * 40})
+
+    # Any URL for the same book will do, but only for the same plugin.
+    found = library.find(ById, "https://www.example.com/read?ref=x&id=1")
+    assert (found["url"], found["pages"], found["path"]) == ("https://example.com/read?id=1", 20, str(book))
+    assert library.has(ById, "https://example.com/read?id=1")
+    assert not library.has(ById, "https://example.com/read?id=2")
+    assert not library.has(Other, "https://example.com/read?id=1")
+
+def test_deleted_books_are_downloaded_again(library, tmp_path):
+    book = tmp_path / "downloads" / "Book.zip"
+    book.write_bytes(b"zip")
+    library.record(ById, "https://example.com/read?id=1", 20, str(book), {})
+    library.record(ById, "https://example.com/read?id=2", 20, "s3://bucket/Book 2", {})
+    os.remove(str(book))
+
+    assert not library.has(ById, "https://example.com/read?id=1")
+    # Object stores can't be checked, so those books are assumed to be there.
+    assert library.find(ById, "https://example.com/read?id=2")["path"] == "s3://bucket/Book 2"
+
+def test_paths_are_recorded_as_absolute(library, tmp_path, monkeypatch):
+    (tmp_path / "downloads" / "Book").mkdir()
+    monkeypatch.chdir(str(tmp_path))
+    library.record(ById, "https://example.com/read?id=1", 20, os.path.join("downloads", "Book"), {})
+
+    # Still found from anywhere else.
+    monkeypatch.chdir(str(tmp_path / "downloads"))
+    assert library.find(ById, "https://example.com/read?id=1")["path"] == str(tmp_path / "downloads" / "Book")
+
+def test_books_are_still_recorded_when_disabled(library, tmp_path, monkeypatch):
+    monkeypatch.setattr(Library, "enabled", False)
+    (tmp_path / "downloads" / "Book").mkdir()
+    library.record(ById, "https://example.com/read?id=1", 20, str(tmp_path / "downloads" / "Book"), {})
+    assert not library.has(ById, "https://example.com/read?id=1")
+
+    monkeypatch.setattr(Library, "enabled", True)
+    assert library.has(ById, "https://example.com/read?id=1")
@@ -0,0 +1,25 @@
+import logging
+
+from mindl import log_listener
+
+class Collect(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        super().__init__(level)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+def test_records_reach_the_handlers_of_parent_loggers():
+    logger = logging.getLogger("test_log_listener")
+    logger.propagate = False
+    handler = Collect(logging.INFO)
+    log_listener.add_handler(logger, handler)
+
+    logger.info("parent")
+    logging.getLogger("test_log_listener.child").info("child")
+    logging.getLogger("test_log_listener.child.grandchild").warning("grandchild")
+    logging.getLogger("test_log_listener.child").debug("too low")
+    # Everything logged before flush() returns has been handled.
+    log_listener.flush()
+    assert handler.messages == ["parent", "child", "grandchild"]
@@ -0,0 +1,88 @@
+import hashlib
+import os
+
+import pytest
+
+from mindl.manifest import Manifest, MANIFEST_FILENAME
+
+def write(directory, filename, data):
+    with open(os.path.join(directory, filename), "wb") as f:
+        f.write(data)
+    return len(data), hashlib.sha1(data).hexdigest()
+
+def reopen(manifest):
+    manifest.close()
+    return Manifest.open(manifest.directory, manifest.identity)
+
+@pytest.fixture
+def manifest(tmp_path):
+    # Tests reopen it, so close whatever instance is open by the end.
+    yield Manifest.open(str(tmp_path), "Book:1")
+    Manifest.open(str(tmp_path)).close()
+
+def test_recorded_files_are_complete(manifest, tmp_path):
+    manifest.record("1.jpg", *write(str(tmp_path), "1.jpg", b"page 1"), index=0)
+    manifest.record("2.jpg", *write(str(tmp_path), "2.jpg", b"page 2"), index=1)
+    manifest = reopen(manifest)
+
+    assert len(manifest) == 2
+    assert manifest.is_complete("1.jpg") and manifest.is_complete("2.jpg")
+    assert not manifest.is_complete("3.jpg")
+
+def test_changed_files_are_not_complete(manifest, tmp_path):
+    for page in range(1, 5):
+        manifest.record("{}.jpg".format(page), *write(str(tmp_path), "{}.jpg".format(page), b"page"))
+    # Cut short, gone, and written over with something the same size.
+    write(str(tmp_path), "1.jpg", b"pa")
+    os.remove(str(tmp_path / "2.jpg"))
+    write(str(tmp_path), "3.jpg", b"PAGE")
+    os.utime(str(tmp_path / "3.jpg"), ns=(0, 0))
+    # Only touched, with the content left as it was.
+    os.utime(str(tmp_path / "4.jpg"), ns=(0, 0))
+
+    manifest = reopen(manifest)
+    assert [manifest.is_complete("{}.jpg".format(page)) for page in range(1, 5)] == [False, False, False, True]
+
+def test_manifest_for_another_book_is_replaced(manifest, tmp_path):
+    manifest.record("1.jpg", *write(str(tmp_path), "1.jpg", b"page 1"))
+    manifest.close()
+
+    other = Manifest.open(str(tmp_path), "Book:2")
+    assert not len(other) and not other.is_complete("1.jpg")
+    other.record("2.jpg", *write(str(tmp_path), "2.jpg", b"page 2"))
+    other.close()
+
+    # The first book's entries are gone for good.
+    manifest = Manifest.open(str(tmp_path), "Book:1")
+    assert not len(manifest)
+    manifest.close()
+    manifest = Manifest.open(str(tmp_path), "Book:2")
+    assert len(manifest) == 1 and "2.jpg" in manifest
+
+def test_line_cut_short_is_skipped_and_not_appended_to(manifest, tmp_path):
+    manifest.record("1.jpg", *write(str(tmp_path), "1.jpg", b"page 1"))
+    manifest.record("2.jpg", *write(str(tmp_path), "2.jpg", b"page 2"))
+    manifest.close()
+    path = str(tmp_path / MANIFEST_FILENAME)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 10)
+
+    manifest = Manifest.open(str(tmp_path), "Book:1")
+    assert manifest.is_complete("1.jpg") and not manifest.is_complete("2.jpg")
+    manifest.record("2.jpg", *write(str(tmp_path), "2.jpg", b"page 2"))
+    manifest = reopen(manifest)
+    assert manifest.is_complete("1.jpg") and manifest.is_complete("2.jpg")
+
+def test_disabled_manifests_are_started_over(manifest, tmp_path, monkeypatch):
+    manifest.record("1.jpg", *write(str(tmp_path), "1.jpg", b"page 1"))
+    manifest.close()
+
+    monkeypatch.setattr(Manifest, "enabled", False)
+    manifest = Manifest.open(str(tmp_path), "Book:1")
+    assert not manifest.is_complete("1.jpg")
+    manifest.record("2.jpg", *write(str(tmp_path), "2.jpg", b"page 2"))
+    manifest.close()
+
+    monkeypatch.setattr(Manifest, "enabled", True)
+    manifest = Manifest.open(str(tmp_path), "Book:1")
+    assert len(manifest) == 1 and "2.jpg" in manifest
@@ -0,0 +1,40 @@
+import subprocess
+import textwrap
+import sys
+
+from mindl.plugin_manager import PluginManager
+
+def test_finding_plugins_is_lazy():
+    # In a fresh interpreter, since whatever else the tests import would show up too.
+    code = textwrap.dedent("""
+        import sys
+        from mindl.plugin_manager import PluginManager
+
+        heavy = {"selenium", "requests", "PIL"}
+        def imported():
+            return sorted(set(m.split(".")[0] for m in sys.modules) & heavy)
+
+        assert not imported(), "Imported before even starting: {}".format(imported())
+        pm = PluginManager()
+        assert pm.entries, "No plugins were found."
+        assert not any(entry.loaded for entry in pm.entries if entry.patterns is not None)
+        assert pm.find_handlers("dummy://test")[0][0].name == "Dummy"
+        assert pm.find_handlers("https://example.com/") is None
+        list(pm.route(["https://booklive.jp/bviewer/?cid=123_4", "nonsense"]))
+        assert not imported(), "Finding plugins imported: {}".format(imported())
+    """)
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+def test_every_bundled_pattern_is_indexed():
+    assert not PluginManager()._unkeyed
+
+def test_routing():
+    routes = dict((url, [entry.name for entry in entries]) for url, entries in PluginManager().route([
+        "dummy://test", "https://booklive.jp/bviewer/?cid=123_4", "http://www.animatebookstore.com/bookview/?u0=1&cid=2",
+        "https://br.ebookjapan.jp/br/reader/viewer/view.html?x", "https://booklive.jp/other", "nonsense"]))
+
+    assert routes == {"dummy://test": ["Dummy"], "https://booklive.jp/bviewer/?cid=123_4": ["BookLive"],
+        "http://www.animatebookstore.com/bookview/?u0=1&cid=2": ["AnimateBookstore"],
+        "https://br.ebookjapan.jp/br/reader/viewer/view.html?x": ["eBookJapan"],
+        "https://booklive.jp/other": [], "nonsense": []}
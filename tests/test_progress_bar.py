@@ -0,0 +1,73 @@
+import threading
+import signal
+import time
+import sys
+
+import pytest
+
+from mindl import progress_bar
+from mindl.progress_bar import LineReservePrinter
+
+class FakeTerminal:
+    def __init__(self):
+        self.written = []
+        self._lock = threading.Lock()
+
+    def isatty(self):
+        return True
+
+    def write(self, data):
+        with self._lock:
+            self.written.append(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        with self._lock:
+            written, self.written = "".join(self.written), []
+        return written
+
+def test_line_is_not_drawn_over_a_prompt(monkeypatch):
+    monkeypatch.setattr(LineReservePrinter, "fps", 100)
+    terminal = FakeTerminal()
+    with LineReservePrinter(terminal) as printer:
+        printer.line = "downloading"
+        printer.flush()
+        time.sleep(0.1)
+        assert "downloading" in terminal.take()
+
+        with printer.paused():
+            # The line was cleared, and input()'s prompt goes out as it is, with no line break.
+            terminal.take()
+            sys.stdout.write("  Username: ")
+            printer.line = "still downloading"
+            printer.flush()
+            time.sleep(0.1)
+            assert terminal.take() == "  Username: "
+
+        time.sleep(0.1)
+        assert "still downloading" in terminal.take()
+
+def show_a_line():
+    with LineReservePrinter(FakeTerminal()):
+        pass
+
+@pytest.mark.skipif(not hasattr(signal, "SIGWINCH"), reason="needs SIGWINCH")
+def test_resizes_are_watched_from_the_main_thread_only(monkeypatch):
+    monkeypatch.setattr(progress_bar, "_resize_watched", False)
+    monkeypatch.setattr(progress_bar, "_columns", 80)
+    previous = signal.getsignal(signal.SIGWINCH)
+    try:
+        # Entering a printer on another thread, like a daemon job does, has to leave signals alone.
+        thread = threading.Thread(target=show_a_line)
+        thread.start()
+        thread.join()
+        assert signal.getsignal(signal.SIGWINCH) is previous
+
+        show_a_line()
+        assert progress_bar._resize_watched
+        signal.raise_signal(signal.SIGWINCH)
+        assert progress_bar._columns is None
+    finally:
+        signal.signal(signal.SIGWINCH, previous)
@@ -0,0 +1,72 @@
+import queue
+
+import pytest
+
+from mindl.plugins.utils.retry_scheduler import (RetryScheduler, FINISHED, RETRY, GAVE_UP,
+    HOST_EXHAUSTED)
+
+def test_backoff_is_exponential_with_jitter_in_the_upper_half():
+    scheduler = RetryScheduler(["a"], max_attempts=10, backoff=1.0, max_backoff=5.0)
+    for attempt, full in enumerate([1, 2, 4, 5, 5], 1):
+        assert scheduler.failed("a") == RETRY
+        assert scheduler.attempts("a") == attempt
+        for i in range(50):
+            assert full / 2 <= scheduler.retry_delay("a") <= full
+
+def test_failed_items_are_retried_after_their_backoff():
+    scheduler = RetryScheduler(["a", "b"], backoff=0.2)
+    assert scheduler.get(timeout=0) == "a"
+    assert scheduler.failed("a") == RETRY
+    # "a" isn't ready again until its backoff is over, so "b" goes first.
+    assert scheduler.get(timeout=0) == "b"
+    with pytest.raises(queue.Empty):
+        scheduler.get(timeout=0)
+    assert scheduler.get(timeout=1) == "a"
+
+def test_items_are_given_up_on_after_max_attempts():
+    scheduler = RetryScheduler(["a"], max_attempts=3, backoff=0)
+    assert [scheduler.failed(scheduler.get(timeout=1)) for i in range(3)] == [RETRY, RETRY, GAVE_UP]
+    assert scheduler.failed_items == ["a"]
+    assert scheduler.get(timeout=0) is FINISHED
+
+def test_host_budget_counts_failures_in_a_row():
+    scheduler = RetryScheduler(range(100), max_attempts=5, backoff=0, host_budget=3)
+    # Plenty of failures over the whole download, but never more than 3 in a row.
+    for i in range(20):
+        for j in range(3):
+            assert scheduler.failed(scheduler.get(timeout=1), "host") == RETRY
+        scheduler.succeeded(scheduler.get(timeout=1), "host")
+    assert scheduler.host_errors("host") == 0
+
+    # Other hosts have budgets of their own.
+    for i in range(3):
+        assert scheduler.failed(scheduler.get(timeout=1), "host") == RETRY
+    assert scheduler.failed(scheduler.get(timeout=1), "other") == RETRY
+    assert scheduler.failed(scheduler.get(timeout=1), "host") == HOST_EXHAUSTED
+    assert scheduler.get(timeout=0) is FINISHED
+
+def test_no_host_budget():
+    scheduler = RetryScheduler(range(50), max_attempts=5, backoff=0, host_budget=0)
+    for i in range(100):
+        assert scheduler.failed(scheduler.get(timeout=1), "host") in (RETRY, GAVE_UP)
+
+def test_pending_items_are_accounted_for():
+    scheduler = RetryScheduler(range(6), max_attempts=1)
+    assert scheduler.discard(lambda item: item % 2) == 3
+    assert scheduler.get(timeout=0) == 0
+    assert scheduler.get(timeout=0) == 2
+    scheduler.succeeded(0)
+    scheduler.failed(2)
+    # Item 4 is still queued, so there's more to do.
+    assert scheduler.get(timeout=0) == 4
+    # And now it's in flight, so getting waits for it instead of finishing.
+    with pytest.raises(queue.Empty):
+        scheduler.get(timeout=0.1)
+    scheduler.succeeded(4)
+    assert scheduler.get(timeout=0) is FINISHED
+    assert scheduler.failed_items == [2]
+
+def test_close_finishes_early():
+    scheduler = RetryScheduler(range(3))
+    scheduler.close()
+    assert scheduler.get(timeout=0) is FINISHED
@@ -0,0 +1,151 @@
+import http.server
+import threading
+import zipfile
+import time
+import io
+
+from urllib.parse import urlsplit, parse_qs
+
+import pytest
+
+from mindl.s3 import S3Client, S3Error, S3Sink, MultipartUpload, MIN_PART_SIZE
+from mindl.sinks import ZipSink
+
+class StandIn(http.server.ThreadingHTTPServer):
+    """Just enough of an S3-compatible object store, which can fail or stall on purpose."""
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.objects = {}
+        self.uploads = {}
+        self.requests = 0
+        # Status codes to answer the next requests with, and seconds to stall the next ones for.
+        self.failures = []
+        self.stalls = []
+        self._lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def endpoint(self):
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, code, body=b"", headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        with server._lock:
+            server.requests += 1
+            failure = server.failures.pop(0) if server.failures else None
+            stall = server.stalls.pop(0) if server.stalls else 0
+        if stall:
+            time.sleep(stall)
+        if failure:
+            return self._reply(failure, b"<Error><Code>Injected</Code></Error>")
+
+        url = urlsplit(self.path)
+        query = parse_qs(url.query, keep_blank_values=True)
+        key = url.path
+        if self.command == "POST" and "uploads" in query:
+            upload_id = "upload-{}".format(len(server.uploads))
+            server.uploads[upload_id] = {}
+            return self._reply(200, "<InitiateMultipartUploadResult><UploadId>{}</UploadId>"
+                "</InitiateMultipartUploadResult>".format(upload_id).encode())
+        elif self.command == "PUT" and "partNumber" in query:
+            server.uploads[query["uploadId"][0]][int(query["partNumber"][0])] = data
+            return self._reply(200, headers=[("ETag", '"{}"'.format(query["partNumber"][0]))])
+        elif self.command == "POST" and "uploadId" in query:
+            parts = server.uploads.pop(query["uploadId"][0])
+            server.objects[key] = b"".join(parts[n] for n in sorted(parts))
+            return self._reply(200, b"<CompleteMultipartUploadResult/>")
+        elif self.command == "DELETE" and "uploadId" in query:
+            server.uploads.pop(query["uploadId"][0], None)
+            return self._reply(204)
+        elif self.command == "PUT":
+            server.objects[key] = data
+            return self._reply(200, headers=[("ETag", '"x"')])
+
+        self._reply(400)
+
+    do_PUT = do_POST = do_DELETE = _handle
+
+@pytest.fixture
+def store():
+    server = StandIn()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def client(store):
+    client = S3Client(store.endpoint, "bucket", access_key="key", secret_key="secret")
+    client.retry_backoff = 0.01
+    client.read_timeout = 0.5
+    return client
+
+def test_put_object_retries_server_errors(store, client):
+    store.failures = [503, 500]
+    client.put_object("a/b.txt", b"hello")
+
+    assert store.objects["/bucket/a/b.txt"] == b"hello"
+    assert store.requests == 3
+
+def test_stalled_request_times_out_and_is_retried(store, client):
+    store.stalls = [2]
+    started = time.monotonic()
+    client.put_object("stalled.txt", b"data")
+
+    assert store.objects["/bucket/stalled.txt"] == b"data"
+    assert time.monotonic() - started < 2
+
+def test_client_errors_are_not_retried(store, client):
+    store.failures = [403]
+    with pytest.raises(S3Error):
+        client.put_object("denied.txt", b"data")
+
+    assert store.requests == 1
+
+def test_gives_up_after_max_attempts(store, client):
+    client.max_attempts = 3
+    store.failures = [503] * 3
+    with pytest.raises(S3Error):
+        client.put_object("down.txt", b"data")
+
+    assert store.requests == 3
+
+def test_multipart_upload_of_an_archive(store, client):
+    pages = {"{:04d}.jpg".format(i): bytes([i]) * (MIN_PART_SIZE // 4) for i in range(10)}
+    # One part fails once along the way.
+    store.failures = [None, None, 503]
+    upload = MultipartUpload(client, "book.zip", part_size=MIN_PART_SIZE, concurrency=2)
+    sink = ZipSink("s3://bucket/book.zip", fileobj=upload, prefix="content/")
+    for name, data in pages.items():
+        sink.submit("", name, data)
+    sink.close()
+
+    with zipfile.ZipFile(io.BytesIO(store.objects["/bucket/book.zip"])) as archive:
+        assert {name: archive.read("content/" + name) for name in pages} == pages
+    assert not store.uploads
+
+def test_sink_uploads_every_file(store, client):
+    store.failures = [503]
+    sink = S3Sink(client, "prefix", "downloads", "downloads/Book")
+    for i in range(5):
+        sink.submit("downloads/Book", "{}.txt".format(i), str(i).encode())
+    sink.flush()
+
+    results = list(sink.completed())
+    assert sorted(r.filename for r in results if r.error is None) == ["{}.txt".format(i) for i in range(5)]
+    assert store.objects["/bucket/prefix/Book/3.txt"] == b"3"
+    sink.close()
@@ -0,0 +1,63 @@
+import threading
+import time
+
+import pytest
+
+from mindl.base_plugin import BasePlugin
+from mindl.download_manager import DownloadCancelled, DownloadManager
+from mindl.library import Library
+from mindl.plugin_manager import PluginManager
+from mindl.scheduler import BookScheduler, BookStatus
+
+class Broken:
+    """A plugin that can't get going, like one that exits when it can't find the book."""
+    def __init__(self, url):
+        raise SystemExit("No such book.")
+
+class Collect(BookStatus):
+    def __init__(self):
+        self.started_at = threading.Event()
+        self.error = "unfinished"
+
+    def started(self, dm):
+        self.started_at.set()
+
+    def finished(self, dm, error=None):
+        self.error = error
+
+@pytest.fixture
+def dummy(monkeypatch, tmp_path):
+    monkeypatch.setattr(BasePlugin, "keep_sessions", BasePlugin.keep_sessions)
+    monkeypatch.setattr(DownloadManager, "base_directory", str(tmp_path))
+    monkeypatch.setattr(Library, "enabled", False)
+    plugin_class = PluginManager().find_handlers("dummy://x")[0][0]
+    return plugin_class.configured
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_a_failed_book_does_not_stop_the_others(dummy, jobs):
+    statuses = [Collect() for i in range(3)]
+    with BookScheduler(jobs=jobs) as scheduler:
+        scheduler.submit(dummy({"n": 2, "length": 0, "chatter": 0}), "dummy://0", statuses[0])
+        scheduler.submit(Broken, "broken://1", statuses[1])
+        scheduler.submit(dummy({"n": 2, "length": 0, "chatter": 0}), "dummy://2", statuses[2])
+
+    assert statuses[0].error is None
+    assert isinstance(statuses[1].error, SystemExit)
+    assert statuses[2].error is None
+    assert scheduler.failed == 1
+
+def test_interrupting_cancels_running_downloads(dummy):
+    # Two running, and one waiting for a job to free up.
+    statuses = [Collect() for i in range(3)]
+    started = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        with BookScheduler(jobs=2) as scheduler:
+            for i, status in enumerate(statuses):
+                scheduler.submit(dummy({"n": 50, "length": 0.2, "chatter": 0}), "dummy://{}".format(i), status)
+            statuses[0].started_at.wait()
+            raise KeyboardInterrupt
+
+    # Each book would take 10 seconds to run through.
+    assert time.monotonic() - started < 3
+    assert all(isinstance(status.error, DownloadCancelled) for status in statuses)
+    assert scheduler.failed == 3
@@ -0,0 +1,39 @@
+from mindl.base_plugin import BasePlugin
+from mindl.shard import Shard, normalize_url, shard_key
+
+class Handlers:
+    """Stands in for the plugin manager, with every URL handled by 'plugin'."""
+    def __init__(self, plugin):
+        self.plugin = plugin
+
+    def find_handlers(self, url):
+        return [(self.plugin, None)] if self.plugin is not None else None
+
+class ByUrl(BasePlugin):
+    name = "ByUrl"
+
+class ById(BasePlugin):
+    name = "ById"
+
+    @classmethod
+    def content_id(cls, url):
+        return url.rsplit("/", 1)[-1]
+
+SAME_BOOK = ("https://www.example.com/read?id=12&vol=3",
+             "http://example.com/read?vol=3&id=12",
+             "HTTPS://WWW.Example.COM/read?id=12&vol=3#page-5")
+
+def test_normalize_url():
+    assert {normalize_url(url) for url in SAME_BOOK} == {"https://example.com/read?id=12&vol=3"}
+    assert normalize_url("https://example.com") == normalize_url("https://example.com/")
+    # The path is left alone, since servers can tell case apart.
+    assert normalize_url("https://example.com/Read") != normalize_url("https://example.com/read")
+
+def test_urls_for_the_same_book_share_a_key():
+    for plugin in (ByUrl, None):
+        keys = {shard_key(Handlers(plugin), url) for url in SAME_BOOK}
+        assert len(keys) == 1
+        assert len({Shard(1, 7).of(key) for key in keys}) == 1
+
+    # Content IDs given by a plugin are used as they are.
+    assert shard_key(Handlers(ById), "https://www.example.com/books/AbC") == "ById:AbC"
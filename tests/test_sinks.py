@@ -0,0 +1,76 @@
+import zipfile
+import os
+
+from mindl.sinks import ZipSink
+from mindl.writer_pool import TEMP_SUFFIX
+
+def store(sink, pages):
+    for page in pages:
+        sink.submit(None, "{}.jpg".format(page), "page {}".format(page).encode() * 100)
+    sink.flush()
+    list(sink.completed())
+
+def names(path):
+    with zipfile.ZipFile(path) as archive:
+        assert archive.testzip() is None
+        return archive.namelist()
+
+def test_unfinished_archive_is_picked_up(tmp_path):
+    path = str(tmp_path / "book.zip")
+    sink = ZipSink(path, prefix="content/", identity="Book:1")
+    store(sink, range(5))
+    sink.close(finished=False)
+    assert not os.path.exists(path)
+
+    sink = ZipSink(path, prefix="content/", identity="Book:1")
+    assert sorted(sink.stored()) == ["{}.jpg".format(page) for page in range(5)]
+    store(sink, range(5, 8))
+    sink.add_data("metadata.json", "{}")
+    sink.close()
+    assert sorted(names(path)) == sorted(["content/{}.jpg".format(page) for page in range(8)] + ["metadata.json"])
+    assert not os.path.exists(path + TEMP_SUFFIX)
+
+def test_files_are_salvaged_from_a_killed_run(tmp_path):
+    path = str(tmp_path / "book.zip")
+    sink = ZipSink(path, identity="Book:1")
+    store(sink, range(5))
+    sink.add_data("metadata.json", "{}")
+    sink.close(finished=False)
+
+    # Cut it off halfway through the last page, like a crash would, taking the central directory with it.
+    with zipfile.ZipFile(path + TEMP_SUFFIX) as archive:
+        cut = archive.getinfo("4.jpg").header_offset + 40
+    with open(path + TEMP_SUFFIX, "r+b") as f:
+        f.truncate(cut)
+
+    sink = ZipSink(path, identity="Book:1")
+    assert sorted(sink.stored()) == ["{}.jpg".format(page) for page in range(4)]
+    store(sink, [4])
+    sink.add_data("metadata.json", "{}")
+    sink.close()
+    # The metadata from the first run is dropped, rather than ending up in there twice.
+    assert sorted(names(path)) == ["{}.jpg".format(page) for page in range(5)] + ["metadata.json"]
+
+def test_archive_for_another_book_is_started_over(tmp_path):
+    path = str(tmp_path / "book.zip")
+    sink = ZipSink(path, identity="Book:1")
+    store(sink, range(3))
+    sink.close(finished=False)
+
+    sink = ZipSink(path, identity="Book:2")
+    assert not sink.stored()
+    store(sink, [7])
+    sink.close()
+    assert names(path) == ["7.jpg"]
+
+def test_nothing_is_picked_up_without_an_identity(tmp_path):
+    path = str(tmp_path / "book.zip")
+    sink = ZipSink(path)
+    store(sink, range(3))
+    sink.close(finished=False)
+
+    sink = ZipSink(path)
+    assert not sink.stored()
+    store(sink, [7])
+    sink.close()
+    assert names(path) == ["7.jpg"]
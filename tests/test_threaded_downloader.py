@@ -0,0 +1,46 @@
+import threading
+import collections
+import time
+
+from mindl.limits import Limiter
+from mindl.plugins.utils.threaded_downloader import ThreadedDownloaderPlugin
+
+class Slow(ThreadedDownloaderPlugin):
+    """Every item is a request taking 'length' seconds, of which only one can be made at a time."""
+    name = "Slow"
+    stall_timeout = 0.5
+    retry_backoff = 0.01
+
+    def __init__(self, items, length, threads=4, hang=()):
+        super().__init__(threads)
+        self.length = length
+        self.hang = set(hang)
+        self.limit = Limiter(1)
+        self.attempts = collections.Counter()
+        self._lock = threading.Lock()
+        self.distribute_items(range(items), expected_downloads=items)
+
+    def directory(self):
+        return "slow"
+
+    def sink(self):
+        return None
+
+    def download_item(self, item):
+        with self._lock:
+            self.attempts[item] += 1
+            first = self.attempts[item] == 1
+        with self.limit, self.in_flight():
+            time.sleep(self.length * (10 if first and item in self.hang else 1))
+        self.got_download(("{}.txt".format(item), b"x"))
+
+def test_threads_waiting_their_turn_are_not_stalled():
+    # Each thread waits well over stall_timeout for the limiter before its request goes out.
+    plugin = Slow(8, 0.2)
+    assert sorted(filename for filename, data in plugin.downloader()) == ["{}.txt".format(i) for i in range(8)]
+    assert set(plugin.attempts.values()) == {1}
+
+def test_stalled_requests_are_given_to_another_thread():
+    plugin = Slow(3, 0.1, threads=2, hang=[1])
+    assert sorted(filename for filename, data in plugin.downloader()) == ["0.txt", "1.txt", "2.txt"]
+    assert plugin.attempts[1] == 2
@@ -0,0 +1,65 @@
+import threading
+import time
+import sys
+import os
+
+from mindl.url_feed import UrlFeed
+
+class Lines:
+    """Stands in for stdin, counting how many lines have been read."""
+    def __init__(self, count):
+        self.count = count
+        self.read = 0
+
+    def __iter__(self):
+        for i in range(self.count):
+            self.read += 1
+            yield "https://example.com/{}\n".format(i)
+
+def test_reading_stops_while_the_queue_is_full(monkeypatch):
+    lines = Lines(100)
+    monkeypatch.setattr(sys, "stdin", lines)
+    feed = UrlFeed(files=["-"], maxsize=4)
+    time.sleep(0.1)
+    # What's in the queue, plus the line waiting to be put in it.
+    assert lines.read == 5
+
+    assert list(feed) == ["https://example.com/{}".format(i) for i in range(100)]
+    assert feed.count == 100
+
+def test_duplicates_are_skipped(tmp_path):
+    path = tmp_path / "urls.txt"
+    path.write_text("https://example.com/1\n\n  https://example.com/2  \nhttps://example.com/1\nhttps://example.com/3\n")
+    feed = UrlFeed(["https://example.com/3", "https://example.com/3"], [str(path), str(tmp_path / "missing.txt")],
+        dedup=True)
+    assert list(feed) == ["https://example.com/3", "https://example.com/1", "https://example.com/2"]
+    assert (feed.count, feed.duplicates) == (3, 3)
+    assert feed.many
+
+    # Without dedup, only the blank lines are left out.
+    feed = UrlFeed(["https://example.com/3", "https://example.com/3"], [str(path)])
+    assert len(list(feed)) == 6 and not feed.duplicates
+
+def test_urls_are_handed_out_as_they_are_piped_in(monkeypatch):
+    read, write = os.pipe()
+    with os.fdopen(read) as stdin, os.fdopen(write, "w") as pipe:
+        monkeypatch.setattr(sys, "stdin", stdin)
+        feed = UrlFeed(["https://example.com/0"], ["-"])
+        idle = threading.Event()
+        feed.on_idle = idle.set
+        urls = iter(feed)
+
+        # Whoever is iterating hears about it while the next URL is still on its way.
+        assert next(urls) == "https://example.com/0"
+        idle.clear()
+        received = []
+        reader = threading.Thread(target=lambda: received.extend(urls))
+        reader.start()
+        assert idle.wait(1)
+        pipe.write("https://example.com/1\n")
+        pipe.flush()
+        pipe.close()
+        # Reaching the end of stdin ends the feed.
+        reader.join(1)
+        assert not reader.is_alive()
+        assert received == ["https://example.com/1"]
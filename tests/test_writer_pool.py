@@ -0,0 +1,75 @@
+import hashlib
+import time
+import os
+
+from mindl import writer_pool
+from mindl.writer_pool import WriterPool, TEMP_SUFFIX
+
+def wait_for(pool, count, timeout=5):
+    results = []
+    deadline = time.monotonic() + timeout
+    while len(results) < count and time.monotonic() < deadline:
+        results.extend(pool.completed())
+        time.sleep(0.01)
+    return results
+
+def test_files_only_get_their_name_once_written(tmp_path, monkeypatch):
+    renames = []
+    replace = os.replace
+    def checked_replace(src, dst):
+        # The whole file is there before it's renamed, and nothing has the final name yet.
+        renames.append((src, dst, os.path.getsize(src), os.path.exists(dst)))
+        replace(src, dst)
+    monkeypatch.setattr(writer_pool.os, "replace", checked_replace)
+
+    pool = WriterPool(threads=2)
+    pool.submit(str(tmp_path), "1.jpg", b"x" * 1000)
+    pool.close()
+
+    path = str(tmp_path / "1.jpg")
+    assert renames == [(path + TEMP_SUFFIX, path, 1000, False)]
+    assert os.listdir(str(tmp_path)) == ["1.jpg"]
+    [result] = pool.completed()
+    assert result == (str(tmp_path), "1.jpg", 1000, hashlib.sha1(b"x" * 1000).hexdigest(), None)
+
+def test_files_are_synced_and_reported_in_batches(tmp_path, monkeypatch):
+    synced = []
+    fsync = os.fsync
+    def counted_fsync(fd):
+        synced.append(fd)
+        fsync(fd)
+    monkeypatch.setattr(writer_pool.os, "fsync", counted_fsync)
+
+    pool = WriterPool(threads=1, fsync_every=3)
+    for page in range(7):
+        pool.submit(str(tmp_path), "{}.jpg".format(page), b"page")
+    results = wait_for(pool, 6)
+    # The last file waits for two more to fill its batch, so it's neither reported nor renamed yet.
+    assert [result.filename for result in results] == ["{}.jpg".format(page) for page in range(6)]
+    assert not wait_for(pool, 1, timeout=0.2)
+    assert not os.path.exists(str(tmp_path / "6.jpg"))
+    assert os.path.exists(str(tmp_path / ("6.jpg" + TEMP_SUFFIX)))
+
+    pool.flush()
+    assert [result.filename for result in pool.completed()] == ["6.jpg"]
+    assert os.path.exists(str(tmp_path / "6.jpg"))
+    # Every file, and the directory once per batch.
+    assert len(synced) == 7 + (3 if os.name != "nt" else 0)
+    pool.close()
+
+def test_results_come_in_the_order_files_were_written(tmp_path):
+    pool = WriterPool(threads=1)
+    for page in range(20):
+        pool.submit(str(tmp_path / "book"), "{}.jpg".format(page), b"page")
+    pool.submit(str(tmp_path / "book"), "quiet.jpg", b"page", report=False)
+    pool.flush()
+    assert [result.filename for result in pool.completed()] == ["{}.jpg".format(page) for page in range(20)]
+    assert os.path.exists(str(tmp_path / "book" / "quiet.jpg"))
+
+    # Failed writes are reported with their error, without stopping the pool.
+    pool.submit(str(tmp_path / "book" / "0.jpg"), "1.jpg", b"page")
+    pool.submit(str(tmp_path / "book"), "20.jpg", b"page")
+    pool.close()
+    failed, written = pool.completed()
+    assert failed.filename == "1.jpg" and isinstance(failed.error, OSError)
+    assert written.filename == "20.jpg" and written.error is None